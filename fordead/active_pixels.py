@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Compressed representation of the active pixels of a tile, such as pixels inside the forest mask with a sufficient coverage to train the model.
+Data of active pixels is gathered as 1-D vectors along a "pixel" dimension, so computations skip inactive pixels, and scattered back in raster layout to be written.
+"""
+
+import numpy as np
+import xarray as xr
+from fordead.import_data import import_binary_raster
+
+class ActivePixels():
+    """
+    Index of the active pixels of a tile, in row-major order, with the coordinates of the tile used to scatter data back in raster layout.
+    """
+
+    def __init__(self, active):
+        """
+        Parameters
+        ----------
+        active : xarray DataArray
+            Binary array (y,x), True where pixels are active. A band dimension of size 1 is ignored.
+
+        """
+        if "band" in active.dims:
+            active = active.squeeze("band")
+        active = active.transpose("y", "x")
+        self.shape = active.shape
+        self.index = np.flatnonzero(np.asarray(active))
+        self.coords = {name : coord for name, coord in active.coords.items() if name != "band"}
+        self.crs = active.rio.crs
+
+    @property
+    def size(self):
+        """
+        Number of active pixels
+        """
+        return self.index.size
+
+    @property
+    def fraction(self):
+        """
+        Fraction of the pixels of the tile which are active
+        """
+        return self.size / max(1, self.shape[0]*self.shape[1])
+
+    def gather(self, data):
+        """
+        Gathers the values of active pixels
+
+        Parameters
+        ----------
+        data : xarray DataArray, xarray Dataset or numpy array
+            Data with dimensions y and x. Numpy arrays must have y and x as their last two dimensions.
+
+        Returns
+        -------
+        xarray DataArray, xarray Dataset or numpy array
+            Data where dimensions y and x are replaced by a last "pixel" dimension, containing the values of active pixels
+        """
+        if isinstance(data, xr.Dataset):
+            return xr.Dataset({name : self.gather(array) for name, array in data.items()})
+        if isinstance(data, xr.DataArray):
+            data = data.transpose(..., "y", "x")
+            coords = {name : coord for name, coord in data.coords.items() if not set(coord.dims) & {"y", "x"}}
+            return xr.DataArray(self.gather(data.values), coords = coords, dims = data.dims[:-2] + ("pixel",), attrs = data.attrs)
+        data = np.asarray(data)
+        return data.reshape(data.shape[:-2] + (-1,))[..., self.index]
+
+    def scatter(self, data, like = None, fill_value = 0):
+        """
+        Scatters the values of active pixels in raster layout
+
+        Parameters
+        ----------
+        data : xarray DataArray or xarray Dataset
+            Data with a "pixel" dimension, as returned by gather
+        like : xarray DataArray or xarray Dataset, optional
+            Data in raster layout giving the values of inactive pixels, which is not modified. If None, inactive pixels are filled with fill_value. The default is None.
+        fill_value : int or float, optional
+            Value of inactive pixels if like is None. The default is 0.
+
+        Returns
+        -------
+        xarray DataArray or xarray Dataset
+            Data where the "pixel" dimension is replaced by dimensions y and x
+        """
+        if isinstance(data, xr.Dataset):
+            return xr.Dataset({name : self.scatter(array, None if like is None else like[name], fill_value) for name, array in data.items()})
+        data = data.transpose(..., "pixel")
+        if like is None:
+            values = np.full(data.shape[:-1] + self.shape, fill_value, dtype = data.dtype)
+            coords = {name : coord for name, coord in data.coords.items() if "pixel" not in coord.dims}
+            raster = xr.DataArray(values, coords = {**coords, **self.coords}, dims = data.dims[:-1] + ("y", "x"), attrs = data.attrs)
+        else:
+            raster = like.transpose(..., "y", "x")
+            values = np.array(raster.values, order = "C", dtype = np.result_type(raster.dtype, data.dtype))
+            raster = raster.copy(data = values)
+        values.reshape(values.shape[:-2] + (-1,))[..., self.index] = data.values
+        return raster
+
+def import_active_mask(dict_paths, mask_names, chunks = None):
+    """
+    Imports the binary masks whose paths exist and combines them, pixels are active where all masks are True
+
+    Parameters
+    ----------
+    dict_paths : dict
+        Dictionnary containing the paths of the masks
+    mask_names : list
+        Keys of the masks in dict_paths, such as "forest_mask", "sufficient_coverage_mask" or "too_many_stress_periods_mask". Masks whose key is missing or whose file does not exist are ignored.
+    chunks : int, optional
+        Chunks used to import the masks. The default is None.
+
+    Returns
+    -------
+    xarray DataArray
+        Binary array, True where pixels are active, or None if none of the masks exist.
+
+    """
+    active_mask = None
+    for mask_name in mask_names:
+        if mask_name in dict_paths and dict_paths[mask_name].exists():
+            mask = import_binary_raster(dict_paths[mask_name], chunks = chunks)
+            active_mask = mask if active_mask is None else active_mask & mask
+    return active_mask
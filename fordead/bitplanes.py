@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Packed storage of binary time series (masks, anomalies), with 8 dates per byte along time.
+Bit k of plane p holds the value of date 8*p + k, planes are stored one after the other in a raw file which can be memory-mapped.
+"""
+
+import json
+from pathlib import Path
+import numpy as np
+import dask.array as da
+
+class PackedBitplanes():
+    """
+    Binary time series of a tile stored as packed bitplanes in a directory, in a raw file "planes.bin" of shape (number of planes, y, x) and a file "info.json" containing the dates and the shape.
+    Dates are appended in chronological order, and the planes can be memory-mapped so only the bytes of the windows and dates read are loaded.
+    """
+
+    def __init__(self, path):
+        """
+        Opens the bitplanes stored in a directory. If it does not exist or is empty, an empty store is created when the first date is appended.
+
+        Parameters
+        ----------
+        path : str
+            Path of the directory
+
+        """
+        self.path = Path(path)
+        self.planes_path = self.path / "planes.bin"
+        self.info_path = self.path / "info.json"
+        if self.info_path.exists():
+            with open(self.info_path) as info_file:
+                info = json.load(info_file)
+            self.dates = info["dates"]
+            self.shape = tuple(info["shape"])
+        else:
+            self.dates = []
+            self.shape = None
+
+    @property
+    def nb_planes(self):
+        return (len(self.dates) + 7) // 8
+
+    def planes(self, mode = "r"):
+        """
+        Memory-maps the planes
+
+        Parameters
+        ----------
+        mode : str, optional
+            "r" to read, "r+" to read and write. The default is "r".
+
+        Returns
+        -------
+        numpy memmap
+            Array of dtype uint8 of shape (number of planes, y, x)
+
+        """
+        return np.memmap(self.planes_path, dtype = np.uint8, mode = mode, shape = (self.nb_planes,) + self.shape)
+
+    def append(self, date, data, rows = slice(None), cols = slice(None), shape = None):
+        """
+        Appends the binary array of a date. If the date is already stored, its bits are overwritten.
+        The array can also be written window by window : the date is appended with its first window, the following windows overwrite the bits of the stored date.
+
+        Parameters
+        ----------
+        date : str
+            Date in the format "YYYY-MM-DD", must not be anterior to the last stored date
+        data : numpy array or xarray DataArray
+            2D binary array, or window of the binary array if rows and cols are given
+        rows : slice, optional
+            Rows of the window. The default is slice(None).
+        cols : slice, optional
+            Columns of the window. The default is slice(None).
+        shape : tuple, optional
+            Shape of the whole array, required to write a window in an empty store. If None, the shape of data is used. The default is None.
+
+        """
+        data = np.asarray(data, dtype = bool)
+        if data.ndim == 3: data = data.squeeze(0) #Rasters imported with a band dimension
+        if self.shape is None:
+            self.path.mkdir(parents = True, exist_ok = True)
+            self.shape = tuple(data.shape if shape is None else shape)
+            self.planes_path.write_bytes(b"")
+        window_shape = tuple(len(range(*window_slice.indices(size))) for window_slice, size in zip((rows, cols), self.shape))
+        if data.shape != window_shape or (shape is not None and tuple(shape) != self.shape):
+            raise ValueError("Array of shape " + str(data.shape) + " can't be stored with bitplanes of shape " + str(self.shape))
+
+        new_date = date not in self.dates
+        if not(new_date):
+            date_index = self.dates.index(date)
+        elif len(self.dates) > 0 and date < self.dates[-1]:
+            raise ValueError("Date " + date + " is anterior to the last stored date " + self.dates[-1] + ", dates can only be appended in chronological order")
+        else:
+            date_index = len(self.dates)
+            if date_index % 8 == 0: #New plane
+                with open(self.planes_path, "ab") as planes_file:
+                    planes_file.truncate((date_index // 8 + 1) * int(np.prod(self.shape)))
+            self.dates.append(date)
+
+        planes = self.planes("r+")
+        bit = np.uint8(1 << (date_index % 8))
+        plane = planes[date_index // 8, rows, cols]
+        np.bitwise_and(plane, ~bit, out = plane)
+        np.bitwise_or(plane, data.view(np.uint8) * bit, out = plane)
+        planes.flush()
+        del planes, plane
+
+        if new_date:
+            temporary_info_path = self.info_path.with_suffix(".tmp")
+            with open(temporary_info_path, "w") as info_file:
+                json.dump({"dates" : self.dates, "shape" : list(self.shape)}, info_file)
+            temporary_info_path.replace(self.info_path)
+
+    def read(self, dates = None, rows = slice(None), cols = slice(None)):
+        """
+        Unpacks a window of the stored binary arrays. Only the planes containing the requested dates are read.
+
+        Parameters
+        ----------
+        dates : list, optional
+            List of dates to read. If None, all dates are read. The default is None.
+        rows : slice, optional
+            Rows of the window. The default is slice(None).
+        cols : slice, optional
+            Columns of the window. The default is slice(None).
+
+        Returns
+        -------
+        numpy array
+            Boolean array of shape (dates, rows, cols)
+
+        """
+        date_indexes = np.arange(len(self.dates)) if dates is None else np.array([self.dates.index(date) for date in dates], dtype = int)
+        if len(date_indexes) == 0:
+            return np.zeros((0,) + np.empty(self.shape, dtype = bool)[rows, cols].shape, dtype = bool)
+        first_plane, last_plane = date_indexes.min() // 8, date_indexes.max() // 8
+        planes = self.planes()[first_plane:last_plane + 1, rows, cols]
+        unpacked = unpack_bitplanes(planes, (last_plane - first_plane + 1) * 8)
+        return unpacked[date_indexes - first_plane * 8]
+
+    def to_dask(self, dates = None, chunks = None):
+        """
+        Lazily unpacks the stored binary arrays as a dask array, each block only reads the planes and window it covers.
+
+        Parameters
+        ----------
+        dates : list, optional
+            List of dates to read. If None, all dates are read. The default is None.
+        chunks : int, optional
+            Chunk size along y and x. If None, a single chunk is used. The default is None.
+
+        Returns
+        -------
+        dask array
+            Boolean array of shape (dates, y, x), with a single chunk along dates
+
+        """
+        dates = list(self.dates) if dates is None else list(dates)
+        chunks = (len(dates),) + tuple(da.core.normalize_chunks(-1 if chunks is None else chunks, shape = self.shape))
+
+        def read_block(block_info = None):
+            (_, _), (row_start, row_stop), (col_start, col_stop) = block_info[None]["array-location"]
+            return self.read(dates, slice(row_start, row_stop), slice(col_start, col_stop))
+
+        return da.map_blocks(read_block, chunks = chunks, dtype = bool, meta = np.array((), dtype = bool))
+
+
+def unpack_bitplanes(planes, nb_dates):
+    """
+    Unpacks bitplanes into a boolean array
+
+    Parameters
+    ----------
+    planes : numpy array
+        Array of dtype uint8 of shape (number of planes, ...)
+    nb_dates : int
+        Number of dates to unpack
+
+    Returns
+    -------
+    numpy array
+        Boolean array of shape (nb_dates, ...)
+
+    """
+    return np.unpackbits(np.asarray(planes), axis = 0, count = nb_dates, bitorder = "little").view(bool)
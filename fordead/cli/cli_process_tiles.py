@@ -3,7 +3,8 @@
 Module grouping the full fordead process in one function and a corresponding command line.
 """
 import fordead
-from fordead.cli.utils import empty_to_none
+from fordead.cli.utils import empty_to_none, execution_options, pop_execution
+from fordead.execution import with_execution
 from fordead.steps.step1_compute_masked_vegetationindex import compute_masked_vegetationindex
 from fordead.steps.step2_train_model import train_model
 from fordead.steps.step3_dieback_detection import dieback_detection
@@ -21,6 +22,7 @@ import datetime
 import gc
 import geopandas as gpd
 import json
+import functools
 
 import click
 from click_option_group import optgroup
@@ -45,6 +47,7 @@ from click_option_group import optgroup
 @optgroup.option("--max_last_date_training", type = str, default = "2018-06-01", help = "Last date that can be used for training")
 @optgroup.option("--nb_min_date", type = int, default = 10, help = "Minimum number of valid dates reqquired for modelling the vegetation index")
 @optgroup.option("--correct_vi", is_flag=True, default = False, help = "If True, corrects vi using large scale median vi")
+@optgroup.option("--active_pixels", is_flag=True, default = False, help = "If activated, the forest mask is computed before the training, and the training and the detection only compute pixels inside the forest mask, on compressed vectors of those pixels")
 @optgroup.group("Step 3: dieback_detection arguments")
 @optgroup.option("-s", "--threshold_anomaly", type = float, default = 0.16, help = "Minimum threshold for anomaly detection")
 @optgroup.option("--max_nb_stress_periods", type=int, default=5, help="Maximum number of stress periods. If this number is reached, the pixel is masked in the too_many_stress_periods, thus removed from future exports. Only used if stress_index_mode is not None.")
@@ -64,13 +67,17 @@ from click_option_group import optgroup
 @optgroup.option("--path_dict_vi", type = click.Path(), default = None, help = "Path of text file to add vegetation index formula, if None, only built-in vegetation indices can be used")
 @optgroup.option('--threshold_list', multiple=True, default = [0.2, 0.265], help="List of thresholds used to classify the levels of dieback by discretising the confidence index")
 @optgroup.option('--classes_list', multiple=True, default = ["1-Faible anomalie","2-Moyenne anomalie","3-Forte anomalie"], help="List of class names for discretising the confidence index. If threshold_list has length n, classes_list must have length n+1.")
+@optgroup.group("Execution configuration")
+@functools.partial(execution_options, option = optgroup.option)
 def cli_process_tiles(**kwargs):
     """Apply full fordead processing to several tiles: compute_masked_vegetationindex > train_model > dieback_detection > compute_forest_mask > export_results
     """
     empty_to_none(kwargs, "ignored_period")
+    pop_execution(kwargs)
     # execute only if run as a script
     process_tiles(**kwargs)
 
+@with_execution
 def process_tiles(
         output_directory, 
         sentinel_directory, 
@@ -93,6 +100,7 @@ def process_tiles(
         max_last_date_training="2018-06-01", 
         nb_min_date=10,
         correct_vi=False, 
+        active_pixels=False,
 
         # dieback_detection arguments
         threshold_anomaly=0.16,
@@ -113,7 +121,10 @@ def process_tiles(
         results_frequency="ME", 
         multiple_files=False,
         threshold_list=[0.2, 0.265], 
-        classes_list=["1-Faible anomalie","2-Moyenne anomalie","3-Forte anomalie"]
+        classes_list=["1-Faible anomalie","2-Moyenne anomalie","3-Forte anomalie"],
+
+        # execution configuration
+        execution=None
         ):
     """
     Apply full fordead processing to several tiles: 
@@ -160,6 +171,9 @@ def process_tiles(
         Minimum number of valid dates to compute a vegetation index model for the pixel
     correct_vi : bool
         If True, corrects vi using large scale median vi.
+    active_pixels : bool
+        If True, the forest mask is computed before the training, and train_model and dieback_detection only compute pixels inside the forest mask with a sufficient coverage,
+        on compressed vectors of those pixels. Results exported by export_results are unchanged.
     
     ### dieback_detection arguments ###
     threshold_anomaly : float
@@ -211,9 +225,15 @@ def process_tiles(
     classes_list : list
         List of class names for discretising the confidence index.
         If threshold_list has length n, classes_list must have length n+1.
+
+    ### execution configuration ###
+    execution : ExecutionConfig or dict
+        Execution configuration of dask computations (scheduler, workers, chunks, memory budget), as described in fordead.execution.ExecutionConfig, used by every step.
+        With the 'distributed' scheduler, a single dask LocalCluster is started for all tiles. If None, the default threaded scheduler is used.
     """
     # save the input arguments of process_tiles
     process_args = locals().copy()
+    process_args["execution"] = execution.as_dict()
     start = datetime.datetime.now()
 
     sentinel_directory = Path(sentinel_directory)
@@ -265,19 +285,33 @@ def process_tiles(
                                        soil_detection = soil_detection,
                                        ignored_period = ignored_period,
                                        compress_vi = compress_vi,
-                                       path_dict_vi = path_dict_vi)
+                                       path_dict_vi = path_dict_vi,
+                                       execution = execution)
         with open(logpath, "a") as f:
             f.write("compute_masked_vegetationindex : " + str(time.time() - start_time) + "\n") ; start_time = time.time()
         gc.collect()
         
 
 # =====================================================================================================================
+        
+        forest_mask_args = dict(forest_mask_source = forest_mask_source,
+                                dep_path = dep_path,
+                                bdforet_dirpath = bdforet_dirpath,
+                                list_forest_type = list_forest_type,
+                                path_oso = path_oso,
+                                list_code_oso = list_code_oso,
+                                vector_path=vector_path,
+                                execution = execution)
+        if active_pixels: #The forest mask selects the pixels computed by the training and the detection
+            compute_forest_mask(data_directory = data_directory, **forest_mask_args)
             
         train_model(data_directory = data_directory,
                     min_last_date_training = min_last_date_training,
                     max_last_date_training = max_last_date_training,
                     nb_min_date = nb_min_date, 
-                    correct_vi = correct_vi)
+                    correct_vi = correct_vi,
+                    active_pixels = active_pixels,
+                    execution = execution)
         with open(logpath, "a") as f:
             f.write("train_model : " + str(time.time() - start_time) + "\n") ; start_time = time.time()
         gc.collect()
@@ -287,21 +321,15 @@ def process_tiles(
                           threshold_anomaly = threshold_anomaly, 
                           max_nb_stress_periods = max_nb_stress_periods,
                           stress_index_mode = stress_index_mode, 
-                          path_dict_vi = path_dict_vi)
+                          path_dict_vi = path_dict_vi,
+                          execution = execution)
         with open(logpath, "a") as f:
             f.write("dieback_detection : " + str(time.time() - start_time) + "\n") ; start_time = time.time()
         gc.collect()
         
 # =====================================================================================================================
 
-        compute_forest_mask(data_directory = data_directory,
-                            forest_mask_source = forest_mask_source,
-                            dep_path = dep_path,
-                            bdforet_dirpath = bdforet_dirpath,
-                            list_forest_type = list_forest_type,
-                            path_oso = path_oso,
-                            list_code_oso = list_code_oso,
-                            vector_path=vector_path)
+        compute_forest_mask(data_directory = data_directory, **forest_mask_args)
         
         with open(logpath, "a") as f:
             f.write("compute_forest_mask : " + str(time.time() - start_time) + "\n") ; start_time = time.time()
@@ -315,7 +343,8 @@ def process_tiles(
             frequency= results_frequency,
             multiple_files = multiple_files, 
             conf_threshold_list = threshold_list,
-            conf_classes_list = classes_list
+            conf_classes_list = classes_list,
+            execution = execution
             )
         with open(logpath, "a") as f:
             f.write("Exporting results : " + str(time.time() - start_time) + "\n\n") ; start_time = time.time()
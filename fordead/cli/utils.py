@@ -1,3 +1,6 @@
+import click
+from fordead.execution import ExecutionConfig
+
 
 def empty_to_none(x, option):
     """
@@ -26,4 +29,58 @@ def empty_to_none(x, option):
         x.pop(option)
     else:
         # convert tuple to list
-        x[option] = list(x[option])
\ No newline at end of file
+        x[option] = list(x[option])
+
+
+def _parse_chunks(ctx, param, value):
+    if value is None or value == "auto":
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise click.BadParameter("must be an integer or 'auto'")
+
+def execution_options(function, option = click.option):
+    """
+    Adds the options of the execution configuration to a click command.
+    The values of these options can then be replaced by an ExecutionConfig with pop_execution.
+
+    Parameters
+    ----------
+    function : function
+        Click command
+    option : function, optional
+        Decorator used to add each option. The default is click.option.
+
+    Returns
+    -------
+    function
+        Click command with the options of the execution configuration
+    """
+    options = [
+        option("--scheduler", type = str, default = "threads", help = "Dask scheduler, 'synchronous', 'threads' or 'processes' for local schedulers, 'distributed' to start a dask LocalCluster, or the address of the scheduler of a dask cluster (requires distributed)", show_default=True),
+        option("--dask_workers", type = int, default = None, help = "Number of threads or processes of local schedulers, or number of workers of the LocalCluster. If None, dask defaults are used.", show_default=True),
+        option("--threads_per_worker", type = int, default = None, help = "Number of threads of each worker of the LocalCluster. If None, dask defaults are used.", show_default=True),
+        option("--memory_limit", type = str, default = None, help = "Memory budget (ex : '4GB'), memory limit of each worker of the LocalCluster, also used to size chunks if chunks is 'auto'", show_default=True),
+        option("--chunks", type = str, default = None, callback = _parse_chunks, help = "Size in pixels of the chunks of rasters imported as dask arrays, 'auto' to let dask choose it, or 0 to use numpy arrays. If None, each step uses its default chunks.", show_default=True),
+        ]
+    for add_option in reversed(options):
+        function = add_option(function)
+    return function
+
+def pop_execution(x):
+    """
+    Replaces the options added by execution_options in the arguments of a click command with an "execution" argument containing the ExecutionConfig object.
+
+    Parameters
+    ----------
+    x : dict
+        Arguments of the click command
+
+    Returns
+    -------
+    None
+        The update of x is made by reference.
+    """
+    x["execution"] = ExecutionConfig(scheduler = x.pop("scheduler"), n_workers = x.pop("dask_workers"), threads_per_worker = x.pop("threads_per_worker"),
+                                     memory_limit = x.pop("memory_limit"), chunks = x.pop("chunks"))
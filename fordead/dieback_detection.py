@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
-from fordead.masking_vi import get_dict_vi
+from fordead.masking_vi import get_vi_registry
+import numpy as np
 import xarray as xr
 
 def detection_anomalies(vegetation_index, mask, predicted_vi, threshold_anomaly, vi, path_dict_vi = None):
@@ -15,32 +16,36 @@ def detection_anomalies(vegetation_index, mask, predicted_vi, threshold_anomaly,
         DataArray containing mask values.
     predicted_vi : array (x,y)
         Array containing the vegetation index predicted by the model
-    threshold_anomaly : float
-        Threshold used to compare predicted and calculated vegetation index.
+    threshold_anomaly : float or xarray DataArray
+        Threshold used to compare predicted and calculated vegetation index. 
+        A DataArray of several thresholds along a "threshold" dimension can be given, anomalies are then detected for each threshold and have this additional dimension.
     vi : str
         Name of the used vegetation index
-    path_dict_vi : str, optional
-        Path to a text file containing vegetation indices information, where is indicated whether the index rises of falls in case of forest dieback. See get_dict_vi documentation. The default is None.
+    path_dict_vi : str or VIRegistry, optional
+        Path to a text file containing vegetation indices information, where is indicated whether the index rises of falls in case of forest dieback. See get_dict_vi documentation. 
+        The registry returned by get_vi_registry can be given instead, to avoid checking the file for each date. The default is None.
 
 
     Returns
     -------
     anomalies : array (x,y) (bool)
-        Array, pixel value is True if an anomaly is detected.
+        Array, pixel value is True if an anomaly is detected, with a "threshold" dimension if several thresholds are given.
     diff_vi : array (x,y) (float)
         Array containing the difference between the vegetation index and its prediction
 
     """
 
-    dict_vi = get_dict_vi(path_dict_vi)
+    dieback_change_direction = get_vi_registry(path_dict_vi)[vi].dieback_change_direction
     
-    if dict_vi[vi]["dieback_change_direction"] == "+":
+    if dieback_change_direction == "+":
         diff_vi = (vegetation_index-predicted_vi)*(~mask)
-    elif dict_vi[vi]["dieback_change_direction"] == "-":
+    elif dieback_change_direction == "-":
         diff_vi = (predicted_vi - vegetation_index)*(~mask)
     else:
-        raise Exception("Unrecognized dieback_change_direction in " + path_dict_vi + " for vegetation index " + vi)
+        raise Exception("Unrecognized dieback_change_direction in " + str(path_dict_vi) + " for vegetation index " + vi)
     
+    if isinstance(threshold_anomaly, xr.DataArray):
+        threshold_anomaly = threshold_anomaly.astype(diff_vi.dtype) #Compared in the type of diff_vi, as a float threshold is
     anomalies = diff_vi > threshold_anomaly
     
     return anomalies.squeeze("Time").squeeze("band"), diff_vi.squeeze("Time").squeeze("band") #.squeeze("Time").squeeze("band")
@@ -143,5 +148,228 @@ def save_stress(stress_data, dieback_data, changing_pixels, diff_vi, mask, stres
     nb_changes = stress_data["nb_periods"]*2+dieback_data["state"] #Number of the change
     stress_data["date"] = stress_data["date"].where(~changing_pixels | (stress_data["date"]["change"] != nb_changes), dieback_data["first_date"])
     return stress_data.squeeze("band")
+
+def update_dieback_block(dieback, anomalies, masks, date_indexes, stress = None, diff_vi = None, stress_index_mode = None, block_pixels = 65536, ended_periods = None):
+    """
+    Updates dieback data, and stress data if given, with the anomalies of several successive dates. Results are identical to detection_dieback and save_stress called for each date.
+    The area is split into blocks of rows, and the dates of each block are scanned in chronological order, state arrays being updated in place, so arrays of the size of the area are neither created nor read again for each date.
+    Arrays can also contain the data of active pixels gathered as compressed vectors, with a single "pixel" dimension instead of y and x.
+    Dieback and stress data can have an additional dimension after the spatial dimensions, such as a "threshold" dimension to update the results of several thresholds of anomaly detection at once, in which case masks and diff_vi have this dimension with a size of 1.
+
+    Parameters
+    ----------
+    dieback : dict
+        Dictionnary of numpy arrays (y,x) "state", "first_date", "first_date_unconfirmed" and "count", as described in detection_dieback. Arrays are updated in place.
+    anomalies : numpy array (Time,y,x) (bool)
+        Array containing True where an anomaly is detected, for each date.
+    masks : numpy array (Time,y,x) (bool)
+        Array containing True where pixels are masked, for each date.
+    date_indexes : list of int
+        Index of each date
+    stress : dict, optional
+        Dictionnary of numpy arrays "date" (y,x,change), "nb_periods" (y,x), "cum_diff" (y,x,period) and "nb_dates" (y,x,period), as described in save_stress. Arrays are updated in place. If None, stress data is not updated. The default is None.
+    diff_vi : numpy array (Time,y,x) (float), optional
+        Difference between the vegetation index and its prediction for each date, only used if stress is not None. The default is None.
+    stress_index_mode : str, optional
+        Chosen stress index, "mean" or "weighted_mean", as described in save_stress. The default is None.
+    block_pixels : int, optional
+        Approximate number of pixels of each block of rows. The default is 65536.
+    ended_periods : list, optional
+        If not None, stress data is sparse, as described in fordead.stress_periods.initialize_sparse_stress_data, "cum_diff" and "nb_dates" only containing the current period of each pixel (y,x).
+        When a stress period ends, a tuple of arrays (pixel, period, start_date_index, end_date_index, cum_diff, nb_dates) is appended to the list, pixel being the position of the pixel in row-major order. The default is None.
+
+    Returns
+    -------
+    None.
+
+    """
+    if stress is not None and stress_index_mode not in ["mean", "weighted_mean"]:
+        raise Exception("Unrecognized stress_index_mode")
+    nb_rows = max(1, block_pixels // max(1, int(np.prod(anomalies.shape[2:]))))
+    for row_start in range(0, anomalies.shape[1], nb_rows):
+        rows = slice(row_start, row_start + nb_rows)
+        pixel_offset = row_start * int(np.prod(anomalies.shape[2:]))
+        state, count = dieback["state"][rows], dieback["count"][rows]
+        first_date, first_date_unconfirmed = dieback["first_date"][rows], dieback["first_date_unconfirmed"][rows]
+        for time_index, date_index in enumerate(date_indexes):
+            valid = ~masks[time_index, rows]
+            differs = anomalies[time_index, rows] != state
+            np.add(count, valid & differs, out = count)
+            np.copyto(count, 0, where = valid & ~differs)
+            changing_pixels = count == 3
+            
+            np.logical_xor(state, changing_pixels, out = state)
+            if ended_periods is not None:
+                ending = np.flatnonzero(changing_pixels & ~state)
+                start_date_index = first_date.ravel()[ending]
+            np.copyto(first_date, first_date_unconfirmed, where = changing_pixels)
+            np.copyto(count, 0, where = changing_pixels)
+            np.copyto(first_date_unconfirmed, date_index, where = valid & (count == 1))
+            
+            if ended_periods is not None:
+                block = {name : array[rows] for name, array in stress.items()}
+                if ending.size > 0:
+                    ended_periods.append((ending + pixel_offset, block["nb_periods"].ravel()[ending].astype(np.uint16) + 1, start_date_index, first_date.ravel()[ending],
+                                          block["cum_diff"].ravel()[ending], block["nb_dates"].ravel()[ending]))
+                _update_sparse_stress_block(block, state, count, changing_pixels, diff_vi[time_index, rows], valid, stress_index_mode)
+            elif stress is not None:
+                _update_stress_block({name : array[rows] for name, array in stress.items()}, state, count, first_date, changing_pixels, 
+                                     diff_vi[time_index, rows], valid, stress_index_mode)
+
+def _update_stress_block(stress, state, count, first_date, changing_pixels, diff_vi, valid, stress_index_mode):
+    """
+    Updates in place the stress data of a block of rows for a date, as save_stress does.
+    """
+    nb_periods = stress["nb_periods"]
+    np.add(nb_periods, changing_pixels & ~state, out = nb_periods)
     
+    #Only the current period, nb_periods+1, is updated, pixels with more periods than stored keep their values
+    max_nb_periods = stress["cum_diff"].shape[-1]
+    period = np.minimum(nb_periods, max_nb_periods - 1).astype(np.intp)[..., None]
+    current_period = nb_periods < max_nb_periods
+    potential_stressed_pixels = (count == 0) & ~state
     
+    nb_dates = np.take_along_axis(stress["nb_dates"], period, -1)[..., 0]
+    updated_nb_dates = np.where(potential_stressed_pixels, 0, nb_dates + valid)
+    np.put_along_axis(stress["nb_dates"], period, np.where(current_period, updated_nb_dates, nb_dates)[..., None], -1)
+    
+    cum_diff = np.take_along_axis(stress["cum_diff"], period, -1)[..., 0]
+    increment = diff_vi if stress_index_mode == "mean" else diff_vi*updated_nb_dates
+    updated_cum_diff = np.where(potential_stressed_pixels, 0, cum_diff + increment)
+    np.put_along_axis(stress["cum_diff"], period, np.where(current_period, updated_cum_diff, cum_diff)[..., None], -1)
+    
+    nb_changes = nb_periods*2 + state #Number of the change, changes coordinates start at 1
+    changed = np.nonzero(changing_pixels & (nb_changes >= 1) & (nb_changes <= stress["date"].shape[-1]))
+    stress["date"][changed + (nb_changes[changed].astype(np.intp) - 1,)] = first_date[changed]
+
+def _update_sparse_stress_block(stress, state, count, changing_pixels, diff_vi, valid, stress_index_mode):
+    """
+    Updates in place the sparse stress data of a block of rows for a date, only the sums of the current period being kept.
+    """
+    np.add(stress["nb_periods"], changing_pixels & ~state, out = stress["nb_periods"])
+    potential_stressed_pixels = (count == 0) & ~state
+    updated_nb_dates = np.where(potential_stressed_pixels, 0, stress["nb_dates"] + valid)
+    increment = diff_vi if stress_index_mode == "mean" else diff_vi*updated_nb_dates
+    np.copyto(stress["cum_diff"], np.where(potential_stressed_pixels, 0, stress["cum_diff"] + increment), casting = "same_kind")
+    np.copyto(stress["nb_dates"], updated_nb_dates, casting = "unsafe")
+
+def _spatial_dims(data):
+    """
+    Spatial dimensions of data, "pixel" for data of active pixels gathered as compressed vectors, or y and x
+    """
+    return ("pixel",) if "pixel" in data.dims else ("y", "x")
+
+def _spatial_array(data, dims, shape):
+    """
+    Values of a DataArray as a numpy array of its spatial dimensions followed by its other dimensions, without its dimensions of size 1
+    """
+    if isinstance(data, xr.DataArray):
+        data = data.transpose(*dims, ...)
+    return np.asarray(data).reshape(shape)
+
+class DiebackBatch():
+    """
+    Updates dieback and stress data by batches of dates. Anomalies, masks and differences between the vegetation index and its prediction are accumulated date by date, 
+    and once batch_size dates are accumulated, dieback and stress data are updated in place with update_dieback_block.
+    Results are identical to detection_dieback and save_stress called for each date.
+    """
+
+    def __init__(self, dieback_data, stress_data = None, stress_index_mode = None, batch_size = 8):
+        """
+        Parameters
+        ----------
+        dieback_data : xarray DataSet
+            Dieback data, as described in detection_dieback, with dimensions y and x, or with a "pixel" dimension for data of active pixels gathered as compressed vectors. 
+            It can have other dimensions, such as a "threshold" dimension, in which case added anomalies have those dimensions and masks and differences are shared by them. It is copied, and the copy is updated.
+        stress_data : xarray DataSet, optional
+            Stress data, as described in save_stress, or sparse stress data as described in fordead.stress_periods.initialize_sparse_stress_data, in which case the stress periods ended by the added dates are gathered in ended_periods.
+            It is copied, and the copy is updated if stress_index_mode is not None. The default is None.
+        stress_index_mode : str, optional
+            Chosen stress index, as described in save_stress. If None, stress data is not updated. The default is None.
+        batch_size : int, optional
+            Number of dates accumulated before dieback and stress data are updated. The default is 8.
+
+        """
+        self.dieback_data = self._copy(dieback_data)
+        self.stress_data = self._copy(stress_data) if stress_index_mode is not None else stress_data
+        self.stress_index_mode = stress_index_mode
+        self.batch_size = max(1, batch_size)
+        self.dims = _spatial_dims(self.dieback_data)
+        self.shape = self.dieback_data["state"].shape
+        self.mask_shape = self.shape[:len(self.dims)] + (1,)*(len(self.shape) - len(self.dims)) #Masks are shared by additional dimensions of dieback data
+        self.date_indexes = []
+        self.anomalies = self.masks = self.diff_vi = None
+        self.ended_periods = [] if stress_index_mode is not None and "date" not in stress_data else None
+
+    @staticmethod
+    def _copy(data):
+        if "band" in data.dims:
+            data = data.squeeze("band")
+        data = data.transpose(*_spatial_dims(data), ...)
+        return data.copy(data = {name : np.array(array) for name, array in data.items()})
+
+    @staticmethod
+    def _arrays(data):
+        return {name : array.values for name, array in data.items()}
+
+    def add(self, anomalies, mask, diff_vi, date_index):
+        """
+        Adds the results of a date, dieback and stress data are updated if batch_size dates are accumulated.
+
+        Parameters
+        ----------
+        anomalies : xarray DataArray (bool)
+            Array containing True where an anomaly is detected.
+        mask : xarray DataArray (bool)
+            Array containing True where pixels are masked, including pixels where the date was used for training.
+        diff_vi : xarray DataArray (float)
+            Difference between the vegetation index and its prediction.
+        date_index : int
+            Index of the date
+
+        """
+        if self.anomalies is None:
+            self.anomalies = np.empty((self.batch_size,) + self.shape, dtype = bool)
+            self.masks = np.empty((self.batch_size,) + self.mask_shape, dtype = bool)
+        if self.stress_index_mode is not None and self.diff_vi is None:
+            self.diff_vi = np.empty((self.batch_size,) + self.mask_shape, dtype = diff_vi.dtype)
+        time_index = len(self.date_indexes)
+        self.anomalies[time_index] = _spatial_array(anomalies, self.dims, self.shape)
+        self.masks[time_index] = _spatial_array(mask, self.dims, self.mask_shape)
+        if self.stress_index_mode is not None:
+            self.diff_vi[time_index] = _spatial_array(diff_vi, self.dims, self.mask_shape)
+        self.date_indexes.append(date_index)
+        if len(self.date_indexes) == self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Updates dieback and stress data with the accumulated dates.
+        """
+        nb_dates = len(self.date_indexes)
+        if nb_dates == 0:
+            return
+        stress = None
+        if self.stress_index_mode is not None:
+            cum_diff_dtype = np.result_type(self.stress_data["cum_diff"].dtype, self.diff_vi.dtype)
+            if cum_diff_dtype != self.stress_data["cum_diff"].dtype: #Same type promotion as save_stress
+                self.stress_data["cum_diff"] = self.stress_data["cum_diff"].astype(cum_diff_dtype)
+            stress = self._arrays(self.stress_data)
+        update_dieback_block(self._arrays(self.dieback_data), self.anomalies[:nb_dates], self.masks[:nb_dates], self.date_indexes, 
+                             stress = stress, diff_vi = self.diff_vi[:nb_dates] if stress is not None else None, stress_index_mode = self.stress_index_mode,
+                             ended_periods = self.ended_periods)
+        self.date_indexes = []
+
+    def result(self):
+        """
+        Updates dieback and stress data with the accumulated dates and returns them.
+
+        Returns
+        -------
+        dieback_data : xarray DataSet
+            Updated dieback data
+        stress_data : xarray DataSet
+            Updated stress data
+        """
+        self.flush()
+        return self.dieback_data, self.stress_data
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Execution configuration of the dask computations of the fordead steps : scheduler, workers, chunk sizes and memory budget.
+"""
+
+import contextlib
+import functools
+import inspect
+import dask
+from dask.utils import parse_bytes
+
+LOCAL_SCHEDULERS = ["synchronous", "threads", "processes"]
+
+class ExecutionConfig():
+    """
+    Execution configuration shared by the steps, used as a context manager around their computations.
+    Local schedulers only set the dask configuration, while "distributed" starts a dask LocalCluster and any other value is used as the address of the scheduler of an existing dask cluster (requires distributed).
+    The configuration can be entered several times, for example by process_tiles and by each step, the scheduler is only set or the cluster started by the first entry.
+    """
+
+    def __init__(self, scheduler = "threads", n_workers = None, threads_per_worker = None, memory_limit = None, chunks = None):
+        """
+        Parameters
+        ----------
+        scheduler : str, optional
+            "synchronous", "threads" or "processes" to use a local dask scheduler, "distributed" to start a dask LocalCluster, or the address of the scheduler of a dask cluster (ex : "tcp://10.0.0.1:8786"). The default is "threads".
+        n_workers : int, optional
+            Number of threads or processes of local schedulers, or number of workers of the LocalCluster. If None, dask defaults are used. The default is None.
+        threads_per_worker : int, optional
+            Number of threads of each worker of the LocalCluster. If None, dask defaults are used. The default is None.
+        memory_limit : str or int, optional
+            Memory budget, as a number of bytes or a string such as "4GB". It is the memory limit of each worker of the LocalCluster, and with chunks "auto", chunks are sized so each thread holds a fraction of it. The default is None.
+        chunks : int or str, optional
+            Size in pixels of the chunks along x and y of the rasters imported as dask arrays, "auto" to let dask choose it, or 0 to import rasters as numpy arrays and avoid the overhead of dask on small areas.
+            If None, each step uses its default chunks. The default is None.
+
+        """
+        self.scheduler = scheduler
+        self.n_workers = n_workers
+        self.threads_per_worker = threads_per_worker
+        self.memory_limit = memory_limit
+        self.chunks = chunks
+        self._depth = 0
+        self._stack = None
+
+    def as_dict(self):
+        """
+        Returns the arguments of the configuration as a dictionnary, from which it can be created again.
+        """
+        return {"scheduler" : self.scheduler, "n_workers" : self.n_workers, "threads_per_worker" : self.threads_per_worker, "memory_limit" : self.memory_limit, "chunks" : self.chunks}
+
+    def __repr__(self):
+        return "ExecutionConfig(" + ", ".join(key + "=" + repr(value) for key, value in self.as_dict().items()) + ")"
+
+    def get_chunks(self, default = None):
+        """
+        Chunks used to import rasters
+
+        Parameters
+        ----------
+        default : int, optional
+            Chunks used by the step if chunks were not configured. The default is None.
+
+        Returns
+        -------
+        int or str
+            Chunks to pass to the import functions, None to import numpy arrays
+
+        """
+        if self.chunks is None:
+            return default
+        return None if self.chunks == 0 else self.chunks
+
+    def dask_config(self):
+        """
+        Dask configuration set by the execution configuration
+
+        Returns
+        -------
+        dict
+            Dask configuration
+
+        """
+        config = {}
+        if self.scheduler in LOCAL_SCHEDULERS:
+            config["scheduler"] = self.scheduler
+            if self.n_workers is not None and self.scheduler != "synchronous":
+                config["num_workers"] = self.n_workers
+        if self.chunks == "auto" and self.memory_limit is not None:
+            # Each thread holds a few chunks at a time (inputs, intermediate results and outputs)
+            nb_threads = (self.n_workers or 1) * (self.threads_per_worker or 1)
+            config["array.chunk-size"] = parse_bytes(self.memory_limit) // (4 * nb_threads)
+        return config
+
+    def __enter__(self):
+        if self._depth == 0:
+            self._stack = contextlib.ExitStack()
+            if self.scheduler not in LOCAL_SCHEDULERS:
+                from dask.distributed import Client, LocalCluster
+                if self.scheduler == "distributed":
+                    cluster = self._stack.enter_context(LocalCluster(n_workers = self.n_workers, threads_per_worker = self.threads_per_worker,
+                                                                     memory_limit = "auto" if self.memory_limit is None else self.memory_limit))
+                    self._stack.enter_context(Client(cluster))
+                else:
+                    self._stack.enter_context(Client(self.scheduler))
+            self._stack.enter_context(dask.config.set(self.dask_config()))
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0:
+            self._stack.close()
+            self._stack = None
+        return False
+
+    def __getstate__(self):
+        # The cluster and client are not sent to other processes
+        state = self.__dict__.copy()
+        state["_depth"], state["_stack"] = 0, None
+        return state
+
+
+def get_execution(execution = None):
+    """
+    Returns the execution configuration to use
+
+    Parameters
+    ----------
+    execution : ExecutionConfig or dict, optional
+        Execution configuration, or dictionnary of the arguments of ExecutionConfig. If None, the default configuration is used. The default is None.
+
+    Returns
+    -------
+    ExecutionConfig
+
+    """
+    if execution is None:
+        return ExecutionConfig()
+    if isinstance(execution, dict):
+        return ExecutionConfig(**execution)
+    return execution
+
+def with_execution(function):
+    """
+    Decorator running a step inside its execution configuration, given as the "execution" argument of the step.
+    The configuration is passed to the step as an ExecutionConfig object.
+    """
+    signature = inspect.signature(function)
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        arguments = signature.bind(*args, **kwargs)
+        arguments.arguments["execution"] = get_execution(arguments.arguments.get("execution"))
+        with arguments.arguments["execution"]:
+            return function(*arguments.args, **arguments.kwargs)
+    return wrapper
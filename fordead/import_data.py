@@ -1,15 +1,27 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
+import pandas as pd
 import xarray as xr
 import rioxarray
+import rasterio
+from rasterio.windows import Window
+from rasterio.enums import Resampling
 import re
 # import datetime
 from pathlib import Path
 import pickle
+import warnings
 import shutil
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from itertools import islice
 from scipy import ndimage
 import geopandas as gp
+from functools import lru_cache
+from fordead.bitplanes import PackedBitplanes
+from fordead.stress_periods import stress_periods_to_dense, split_stress_periods, compute_stress_index
 
 
 # class sat_reader():
@@ -72,21 +84,11 @@ class Sat_catalog_theia(object):
         
         band_paths = self.paths["Sentinel"]
         
-        if extent is None:
-            stack_bands = [rioxarray.open_rasterio(band_paths[band]) for band in list_bands]
-        else:
-            stack_bands = [rioxarray.open_rasterio(band_paths[band],chunks = 1280).loc[dict(x=slice(extent[0]-20, extent[2]+20),y = slice(extent[3]+20,extent[1]-20))].compute() for band in list_bands]
-        crs = stack_bands[0].rio.crs
+        stack_bands = [open_raster_extent(band_paths[band], extent, margin = 20) for band in list_bands]
         #Resampling at 10m resolution
         for band_index in range(len(stack_bands)):
             if stack_bands[band_index].rio.resolution()==(20.0,-20.0):            
-                # stack_bands[band_index] = xr.DataArray(ndimage.zoom(stack_bands[band_index],zoom=[1,2.0,2.0],order=interpolation_order), 
-                #                                        coords=stack_bands[0].coords)
-                stack_bands[band_index] = xr.DataArray(ndimage.zoom(stack_bands[band_index],zoom=[1,2.0,2.0],order=interpolation_order), 
-                                                       coords={"band" : [1], 
-                                                               "y" : np.linspace(stack_bands[band_index].isel(x=0,y=0).y+5, stack_bands[band_index].isel(x=0,y=stack_bands[band_index].sizes["y"]-1).y-5, num=stack_bands[band_index].sizes["y"]*2),
-                                                               "x" : np.linspace(stack_bands[band_index].isel(x=0,y=0).x-5, stack_bands[band_index].isel(x=stack_bands[band_index].sizes["x"]-1,y=0).x+5, num=stack_bands[band_index].sizes["x"]*2)},
-                                                       dims=["band","y","x"]).rio.write_crs(crs)
+                stack_bands[band_index] = resample_20m_band(stack_bands[band_index], interpolation_order = interpolation_order)
             if extent is not None:
                 stack_bands[band_index] = clip_xarray(stack_bands[band_index], extent)
     
@@ -207,6 +209,8 @@ def retrieve_date_from_string(string):
     return formatted_date
 
 class TileInfo:
+    output_profile = None #Output profile of GeoTIFF files, also available on TileInfo objects saved before it was added
+    
     def __init__(self, data_directory):
         """
         Initialize TileInfo object. This object is meant to store all relevant information (paths to input and output data, parameters used, used SENTINEL dates)
@@ -260,8 +264,55 @@ class TileInfo:
         
         if path==None:
             path=self.data_directory / "TileInfo"
-        with open(path, 'wb') as f:
+        path = Path(path)
+        temporary_path = path.with_name("." + path.name + ".tmp") #Written then renamed, so an interruption does not leave a corrupted file
+        with open(temporary_path, 'wb') as f:
             pickle.dump(self, f)
+        temporary_path.replace(path)
+    
+    def save_checkpoint(self, key, state):
+        """
+        Saves the state of a step during its computation in the file at self.paths[key], along with the parameters of the TileInfo object, so the computation can be resumed if it is interrupted.
+        The file is replaced in a single operation, so it always contains a consistent state.
+
+        Parameters
+        ----------
+        key : str
+            Key of the path of the checkpoint in the dictionnary containing paths
+        state : dict
+            Objects needed to resume the computation, including the last computed date. They must be loaded in memory.
+
+        """
+        path = self.paths[key]
+        temporary_path = path.with_name("." + path.name + ".tmp")
+        with open(temporary_path, 'wb') as f:
+            pickle.dump({"parameters" : {parameter : value for parameter, value in self.parameters.items() if parameter != "Overwrite"}, "state" : state}, f, protocol = pickle.HIGHEST_PROTOCOL)
+        temporary_path.replace(path)
+    
+    def import_checkpoint(self, key):
+        """
+        Imports the state saved with save_checkpoint in the file at self.paths[key].
+        The checkpoint is ignored if it was saved with other parameters, in which case previous results must be computed again.
+        If it was saved with the current parameters, results of the interrupted computation were already computed with those parameters and can be kept even if the parameters differ from those of the saved TileInfo object.
+
+        Parameters
+        ----------
+        key : str
+            Key of the path of the checkpoint in the dictionnary containing paths
+
+        Returns
+        -------
+        dict
+            Saved state, or None if there is no checkpoint or if it was saved with other parameters.
+
+        """
+        if key not in self.paths or not self.paths[key].exists():
+            return None
+        with open(self.paths[key], 'rb') as f:
+            checkpoint = pickle.load(f)
+        if checkpoint["parameters"] != {parameter : value for parameter, value in self.parameters.items() if parameter != "Overwrite"}:
+            return None
+        return checkpoint["state"]
     
     def print_info(self):
         """
@@ -349,7 +400,8 @@ class TileInfo:
         Parameters
         ----------
         path_dir : str
-            Directory containing files with filenames containing dates in the format YYYY-MM-DD, YYYY_MM_DD, YYYYMMDD, DD-MM-YYYY, DD_MM_YYYY or DDMMYYYY
+            Directory containing files with filenames containing dates in the format YYYY-MM-DD, YYYY_MM_DD, YYYYMMDD, DD-MM-YYYY, DD_MM_YYYY or DDMMYYYY, 
+            or path of a time-stacked cube (.zarr), in which case all dates of the cube are linked to its path.
     
         Returns
         -------
@@ -358,9 +410,12 @@ class TileInfo:
     
         """
         path_dir=Path(path_dir)
+        if is_cube(path_dir): #All dates are stored in a single time-stacked cube
+            self.paths[key] = {date : path_dir for date in get_cube_dates(path_dir)}
+            return
         dict_datepaths={}
         for path in path_dir.glob("*"):
-            if not bool(re.search(r"(\.xml|\.tsv|\.json|\.log)", str(path))): #To ignore temporary files
+            if not bool(re.search(r"(\.xml|\.tsv|\.json|\.log)", str(path))) and not path.name.startswith("."): #To ignore temporary and hidden files
                 formatted_date=retrieve_date_from_string(path.stem)
                 if formatted_date is not None: #To ignore files or directories with no dates which might be in the same directory
                     dict_datepaths[formatted_date] = path
@@ -419,7 +474,8 @@ class TileInfo:
                     # First date was introduced in v1.9.0.
                     # if start_date_train is the default, 
                     # it is added without activating overwrite
-                    if not(parameter=="start_date_train" and parameters[parameter]=="2015-01-01"):
+                    # The same goes for output_format, stress_output_format and active_pixels, introduced later, and for dtype if float64 is used as in previous versions.
+                    if not(parameter=="start_date_train" and parameters[parameter]=="2015-01-01") and not(parameter=="output_format" and parameters[parameter]=="files") and not(parameter=="stress_output_format" and parameters[parameter]=="rasters") and not(parameter=="active_pixels" and parameters[parameter]==False) and not(parameter=="dtype" and parameters[parameter]=="float64"):
                         self.parameters["Overwrite"]=True
             self.parameters.update(parameters)
             
@@ -481,18 +537,24 @@ class TileInfo:
 
         
         
-def get_cloudiness(path_cloudiness, dict_path_bands, sentinel_source: str):
+def get_cloudiness(path_cloudiness, dict_path_bands, sentinel_source: str, decimation = 4, n_workers = 1):
     """
-    Imports, computes and stores cloudiness for all dates
+    Imports, computes and stores cloudiness for all dates.
+    Cloudiness is stored in a persistent SQLite index (path_cloudiness with the suffix ".sqlite") where each scene is identified by the name of its mask file and the modification time of the files used, so only new or modified scenes are computed.
+    If cloudiness was stored by a previous version as a TileInfo object in path_cloudiness, it is imported into the index.
     
     Parameters
     ----------
     path_cloudiness : str
-        Path where the TileInfo object storing cloudiness information for each date is saved and imported from.
+        Path of the cloudiness index, without the ".sqlite" suffix.
     dict_path_bands : dict
         Dictionnary where keys are dates, values are another dictionnary where keys are bands and values are their paths (`dict_path_bands["YYYY-MM-DD"]["Mask"]` -> Path to the mask)
     sentinel_source : str
         'theia', 'scihub' or 'peps'
+    decimation : int, optional
+        Decimation factor of the reads, cloudiness is computed on rasters whose size is divided by this factor, using overviews if they exist. If 1, full resolution rasters are read and cloudiness is exact. Cloudiness computed at full resolution is also used for other decimation factors. The default is 4.
+    n_workers : int, optional
+        Number of threads used to compute cloudiness of several dates in parallel. The default is 1.
 
     Returns
     -------
@@ -500,23 +562,83 @@ def get_cloudiness(path_cloudiness, dict_path_bands, sentinel_source: str):
         Dictionnary where keys are dates and values the cloudiness percentage
 
     """
-    path_cloudiness= Path(path_cloudiness)
-    cloudiness = TileInfo(path_cloudiness.parent)
-    if path_cloudiness.exists():
+    path_cloudiness = Path(path_cloudiness)
+    path_index = path_cloudiness.with_name(path_cloudiness.name + ".sqlite")
+    new_index = not(path_index.exists())
+    index = sqlite3.connect(path_index, timeout = 60)
+    index.execute("CREATE TABLE IF NOT EXISTS cloudiness (scene_id TEXT, decimation INTEGER, date TEXT, mtime REAL, cloudiness REAL, PRIMARY KEY (scene_id, decimation))")
+    
+    scenes = {date : (Path(dict_path_bands[date]["Mask"]).name, get_cloudiness_mtime(dict_path_bands[date], sentinel_source)) for date in dict_path_bands}
+    
+    if new_index and path_cloudiness.is_file(): #Import of cloudiness computed by previous versions at full resolution
         try:
-            cloudiness=cloudiness.import_info(path_cloudiness)
-        except:
-            path_cloudiness.unlink()
-    if not(hasattr(cloudiness, 'perc_cloud')):
-        cloudiness.perc_cloud={}
-    for date in dict_path_bands:
-        if not(date in cloudiness.perc_cloud):
-            cloudiness.perc_cloud[date] = get_date_cloudiness_perc(dict_path_bands[date], sentinel_source)
-            
-    cloudiness.save_info(path_cloudiness)
-    return cloudiness.perc_cloud
+            legacy_cloudiness = TileInfo(path_cloudiness.parent).import_info(path_cloudiness).perc_cloud
+            index.executemany("INSERT OR REPLACE INTO cloudiness VALUES (?, 1, ?, ?, ?)",
+                              [(scenes[date][0], date, scenes[date][1], legacy_cloudiness[date]) for date in legacy_cloudiness if date in scenes])
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, KeyError) as error:
+            warnings.warn("Cloudiness stored by a previous version in " + str(path_cloudiness) + " could not be imported, it is computed again : " + repr(error))
+    
+    cloudiness = {}
+    for date, (scene_id, mtime) in scenes.items():
+        stored = index.execute("SELECT cloudiness FROM cloudiness WHERE scene_id = ? AND mtime = ? AND decimation IN (1, ?) ORDER BY decimation LIMIT 1", (scene_id, mtime, decimation)).fetchone()
+        if stored is not None:
+            cloudiness[date] = stored[0]
+    
+    missing_dates = [date for date in dict_path_bands if date not in cloudiness]
+    with ThreadPoolExecutor(max_workers = max(n_workers, 1)) as executor: #Reads release the GIL
+        for date, date_cloudiness in zip(missing_dates, executor.map(lambda date : get_date_cloudiness_perc(dict_path_bands[date], sentinel_source, decimation), missing_dates)):
+            cloudiness[date] = date_cloudiness
+    index.executemany("INSERT OR REPLACE INTO cloudiness VALUES (?, ?, ?, ?, ?)",
+                      [(scenes[date][0], decimation, date, scenes[date][1], cloudiness[date]) for date in missing_dates])
+    index.commit()
+    index.close()
+    
+    return {date : cloudiness[date] for date in dict_path_bands}
+
+def get_cloudiness_mtime(date_paths, sentinel_source: str):
+    """
+    Returns the last modification time of the files used to compute the cloudiness of a Sentinel-2 date
+
+    Parameters
+    ----------
+    date_paths : dict
+        Dictionnary where keys are bands and values are their paths
+    sentinel_source : str
+        'theia', 'scihub' or 'peps'
+
+    Returns
+    -------
+    float
+        Modification time
+
+    """
+    used_bands = ["Mask", "B11"] if sentinel_source.lower() == "theia" else ["Mask"]
+    return max(Path(date_paths[band]).stat().st_mtime for band in used_bands)
 
-def get_date_cloudiness_perc(date_paths, sentinel_source: str):
+def read_decimated(path, decimation = 1):
+    """
+    Reads a raster with its size divided by a decimation factor, using nearest neighbour resampling. GDAL uses overviews if they exist.
+
+    Parameters
+    ----------
+    path : str
+        Path of the raster
+    decimation : int, optional
+        Decimation factor, if 1 the raster is read at full resolution. The default is 1.
+
+    Returns
+    -------
+    numpy array
+        Array of shape (band, y, x)
+
+    """
+    with rasterio.open(path) as raster:
+        if decimation == 1:
+            return raster.read()
+        out_shape = (raster.count, -(-raster.height // decimation), -(-raster.width // decimation))
+        return raster.read(out_shape = out_shape, resampling = Resampling.nearest)
+
+def get_date_cloudiness_perc(date_paths, sentinel_source: str, decimation = 1):
     """
     Computes cloudiness percentage of a Sentinel-2 date from the source mask (THEIA CLM or PEPS, scihub SCL)
     A 20m resolution band is necessary for THEIA data to determine swath cover. B11 is used but could be replaced with another 20m band.
@@ -529,6 +651,8 @@ def get_date_cloudiness_perc(date_paths, sentinel_source: str):
         DESCRIPTION.
     sentinel_source : str
         'theia', 'scihub' or 'peps'
+    decimation : int, optional
+        Decimation factor of the reads, if 1 cloudiness is computed at full resolution. The default is 1.
 
     Returns
     -------
@@ -540,15 +664,13 @@ def get_date_cloudiness_perc(date_paths, sentinel_source: str):
     sentinel_source = sentinel_source.lower()
 
     if sentinel_source=="theia":
-        tile_mask_info = xr.Dataset({"mask": rioxarray.open_rasterio(date_paths["Mask"]),
-                                     "swath_cover": rioxarray.open_rasterio(date_paths["B11"])})
-        NbPixels = (tile_mask_info["swath_cover"]!=-10000).sum()
-        NbCloudyPixels = (tile_mask_info["mask"]>0).sum()
+        NbPixels = np.count_nonzero(read_decimated(date_paths["B11"], decimation)!=-10000)
+        NbCloudyPixels = np.count_nonzero(read_decimated(date_paths["Mask"], decimation)>0)
 
     elif sentinel_source=="scihub" or sentinel_source=="peps":
-        cloud_mask = rioxarray.open_rasterio(date_paths["Mask"])
-        NbPixels = (cloud_mask!=0).sum()
-        NbCloudyPixels = (~cloud_mask.isin([4,5])).sum()
+        cloud_mask = read_decimated(date_paths["Mask"], decimation)
+        NbPixels = np.count_nonzero(cloud_mask!=0)
+        NbCloudyPixels = np.count_nonzero(~np.isin(cloud_mask, [4,5]))
     
     if NbPixels==0: #If outside of satellite swath
         return 2.0
@@ -588,7 +710,7 @@ def get_raster_metadata(raster_path = None,raster = None, extent_shape_path = No
         
         extent_shape = extent_shape.to_crs(raster.rio.crs)
         extent = extent_shape.total_bounds
-        raster = raster.loc[dict(x=slice(extent[0], extent[2]),y = slice(extent[3],extent[1]))]
+        raster = clip_xarray(raster, extent)
         
     raster_meta = {"dims" : raster.dims,
                    "coords" : raster.coords,
@@ -621,6 +743,138 @@ def clip_xarray(array, extent):
     """
     return array.loc[dict(x=slice(extent[0], extent[2]),y = slice(extent[3],extent[1]))]
 
+def get_extent_window(transform, shape, extent, margin = 0):
+    """
+    Converts an extent to the window of a raster containing the pixels whose centers are inside the extent, which are the pixels selected by clip_xarray.
+
+    Parameters
+    ----------
+    transform : affine.Affine
+        Transform of the raster
+    shape : tuple
+        Shape (y, x) of the raster
+    extent : list or 1D array
+        Extent [xmin,ymin, xmax,ymax]
+    margin : float, optional
+        Margin added around the extent, in the units of the coordinate reference system. Used to read 20m resolution bands with enough pixels to cover the extent after resampling to 10m. The default is 0.
+
+    Returns
+    -------
+    rasterio.windows.Window
+        Window of the raster, clipped to its limits
+
+    """
+    window = rasterio.windows.from_bounds(extent[0] - margin, extent[1] - margin, extent[2] + margin, extent[3] + margin, transform = transform)
+    row_start = min(max(int(np.ceil(window.row_off - 0.5)), 0), shape[0])
+    row_stop = min(max(int(np.floor(window.row_off + window.height - 0.5)) + 1, row_start), shape[0])
+    col_start = min(max(int(np.ceil(window.col_off - 0.5)), 0), shape[1])
+    col_stop = min(max(int(np.floor(window.col_off + window.width - 0.5)) + 1, col_start), shape[1])
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+def open_raster_extent(raster_path, extent = None, margin = 0, chunks = None):
+    """
+    Opens a raster and selects the window covering an extent, so only the blocks of this window are read when the data is loaded.
+
+    Parameters
+    ----------
+    raster_path : str
+        Path of the raster
+    extent : list or 1D array, optional
+        Extent [xmin,ymin, xmax,ymax]. If None, the whole raster is opened. The default is None.
+    margin : float, optional
+        Margin added around the extent, in the units of the coordinate reference system. The default is 0.
+    chunks : int, optional
+        Chunks for import as dask array, applied to the selected window. If None, data is lazily loaded. The default is None.
+
+    Returns
+    -------
+    raster : xarray DataArray
+        Raster with dimensions band, y and x, with the data not loaded yet.
+
+    """
+    raster = rioxarray.open_rasterio(raster_path, chunks = chunks if extent is None else None)
+    if extent is not None:
+        (row_start, row_stop), (col_start, col_stop) = get_extent_window(raster.rio.transform(), (raster.sizes["y"], raster.sizes["x"]), extent, margin).toranges()
+        raster = raster.isel(y = slice(row_start, row_stop), x = slice(col_start, col_stop))
+        if chunks is not None:
+            raster = raster.chunk({"band" : 1, "y" : chunks, "x" : chunks})
+    return raster
+
+def upsample_nearest(data, factor = 2, row_offset = 0, col_offset = 0, shape = None):
+    """
+    Upsamples the two last dimensions of an array by an integer factor using nearest neighbour, by replicating pixels. 
+    Gives the same result as scipy's ndimage.zoom with order 0, but much faster and only computes the pixels in the requested shape.
+
+    Parameters
+    ----------
+    data : numpy array
+        Array with at least two dimensions, the last two being y and x
+    factor : int, optional
+        Upsampling factor. The default is 2.
+    row_offset : int, optional
+        Index of the first row of the upsampled array to return. The default is 0.
+    col_offset : int, optional
+        Index of the first column of the upsampled array to return. The default is 0.
+    shape : tuple, optional
+        Number of rows and columns of the upsampled array to return. If None, the whole upsampled array from the offsets is returned. The default is None.
+
+    Returns
+    -------
+    numpy array
+        Upsampled array
+
+    """
+    if shape is None:
+        shape = (data.shape[-2]*factor - row_offset, data.shape[-1]*factor - col_offset)
+    return data.take(get_upsampling_indices(shape[0], factor, row_offset), axis = -2).take(get_upsampling_indices(shape[1], factor, col_offset), axis = -1)
+
+@lru_cache(maxsize = 32)
+def get_upsampling_indices(size, factor, offset):
+    """
+    Returns the index of the source pixel for each pixel of an upsampled dimension. The result is cached as it only depends on the geometry.
+    """
+    indices = (np.arange(size) + offset) // factor
+    indices.flags.writeable = False
+    return indices
+
+@lru_cache(maxsize = 32)
+def get_resampled_coords(first, last, num):
+    """
+    Returns the coordinates of a resampled dimension, as used by import_resampled_sen_stack. The result is cached as it is the same for all bands and dates of a tile.
+    """
+    coords = np.linspace(first, last, num=num)
+    coords.flags.writeable = False
+    return coords
+
+def resample_20m_band(band, interpolation_order = 0):
+    """
+    Resamples a band from 20m to 10m resolution. With interpolation_order = 0, pixels are replicated without interpolation.
+
+    Parameters
+    ----------
+    band : xarray DataArray
+        Band at 20m resolution with dimensions band, y and x, opened with rioxarray.open_rasterio
+    interpolation_order : int, optional
+        Order of interpolation as used in scipy's ndimage.zoom (0 = nearest neighbour, 1 = linear, 2 = bi-linear, 3 = cubic). The default is 0.
+
+    Returns
+    -------
+    xarray DataArray
+        Band at 10m resolution with dimensions band, y and x
+
+    """
+    if interpolation_order == 0:
+        data = upsample_nearest(band.values, 2)
+    else:
+        data = ndimage.zoom(band,zoom=[1,2.0,2.0],order=interpolation_order)
+    y = band.y.values
+    x = band.x.values
+    return xr.DataArray(data, 
+                        coords={"band" : [1], 
+                                "y" : get_resampled_coords(float(y[0])+5, float(y[-1])-5, band.sizes["y"]*2),
+                                "x" : get_resampled_coords(float(x[0])-5, float(x[-1])+5, band.sizes["x"]*2)},
+                        dims=["band","y","x"]).rio.write_crs(band.rio.crs)
+
 def import_resampled_sen_stack(band_paths, list_bands, interpolation_order = 0, extent = None):
     """
     Imports and resamples the bands as an xarray
@@ -645,21 +899,11 @@ def import_resampled_sen_stack(band_paths, list_bands, interpolation_order = 0,
     #Importing data from files
     
     
-    if extent is None:
-        stack_bands = [rioxarray.open_rasterio(band_paths[band]) for band in list_bands]
-    else:
-        stack_bands = [rioxarray.open_rasterio(band_paths[band],chunks = 1280).loc[dict(x=slice(extent[0]-20, extent[2]+20),y = slice(extent[3]+20,extent[1]-20))].compute() for band in list_bands]
-    crs = stack_bands[0].rio.crs
+    stack_bands = [open_raster_extent(band_paths[band], extent, margin = 20) for band in list_bands]
     #Resampling at 10m resolution
     for band_index in range(len(stack_bands)):
         if stack_bands[band_index].rio.resolution()==(20.0,-20.0):            
-            # stack_bands[band_index] = xr.DataArray(ndimage.zoom(stack_bands[band_index],zoom=[1,2.0,2.0],order=interpolation_order), 
-            #                                        coords=stack_bands[0].coords)
-            stack_bands[band_index] = xr.DataArray(ndimage.zoom(stack_bands[band_index],zoom=[1,2.0,2.0],order=interpolation_order), 
-                                                   coords={"band" : [1], 
-                                                           "y" : np.linspace(stack_bands[band_index].isel(x=0,y=0).y.values+5, stack_bands[band_index].isel(x=0,y=stack_bands[band_index].sizes["y"]-1).y.values-5, num=stack_bands[band_index].sizes["y"]*2),
-                                                           "x" : np.linspace(stack_bands[band_index].isel(x=0,y=0).x.values-5, stack_bands[band_index].isel(x=stack_bands[band_index].sizes["x"]-1,y=0).x.values+5, num=stack_bands[band_index].sizes["x"]*2)},
-                                                   dims=["band","y","x"]).rio.write_crs(crs)
+            stack_bands[band_index] = resample_20m_band(stack_bands[band_index], interpolation_order = interpolation_order)
         if extent is not None:
             stack_bands[band_index] = clip_xarray(stack_bands[band_index], extent)
 
@@ -670,9 +914,162 @@ def import_resampled_sen_stack(band_paths, list_bands, interpolation_order = 0,
 
     return concatenated_stack_bands
 
+def get_block_windows(raster_path, raster_meta, window_size = 1024):
+    """
+    Splits the area described by raster_meta into windows aligned to the internal blocks of a raster, so each block is only read once.
+    The window size is rounded up to a multiple of the block size of the raster.
+
+    Parameters
+    ----------
+    raster_path : str
+        Path of a raster on the same grid as raster_meta, whose blocks are used for alignment (usually a 10m band).
+    raster_meta : dict
+        Dictionnary containing metadata of the area to split, as returned by get_raster_metadata.
+    window_size : int, optional
+        Approximate size in pixels of the side of the windows. The default is 1024.
+
+    Returns
+    -------
+    windows : list of rasterio.windows.Window
+        Windows covering the area, with offsets relative to the area described by raster_meta.
+
+    """
+    with rasterio.open(raster_path) as src:
+        block_height, block_width = src.block_shapes[0]
+        row_offset, col_offset = [int(round(offset)) for offset in ~src.transform * (raster_meta["transform"].c, raster_meta["transform"].f)][::-1]
+    
+    height, width = raster_meta["sizes"]["y"], raster_meta["sizes"]["x"]
+    window_height = int(np.ceil(window_size / block_height)) * block_height
+    window_width = int(np.ceil(window_size / block_width)) * block_width
+    
+    #Window limits are placed on block limits of the source raster
+    row_limits = np.unique(np.clip(np.arange(0, row_offset + height + window_height, window_height) - row_offset, 0, height))
+    col_limits = np.unique(np.clip(np.arange(0, col_offset + width + window_width, window_width) - col_offset, 0, width))
+    
+    return [Window(col_start, row_start, col_stop - col_start, row_stop - row_start) for row_start, row_stop in zip(row_limits[:-1], row_limits[1:]) for col_start, col_stop in zip(col_limits[:-1], col_limits[1:])]
+
+def open_sen_bands(band_paths, list_bands, raster_meta, interpolation_order = 0):
+    """
+    Opens the bands of a date to be imported window by window with import_resampled_sen_window. 
+    Bands are opened without loading the data, except bands at 20m resolution when interpolation_order is not 0 : 
+    as the interpolation of scipy's ndimage.zoom depends on the size of the interpolated array, they are loaded and resampled at 10m resolution over the whole area, as in import_resampled_sen_stack.
+
+    Parameters
+    ----------
+    band_paths : dict
+        Dictionnary where keys are bands and values are their paths
+    list_bands : list
+        List of bands to be opened
+    raster_meta : dict
+        Dictionnary containing metadata of the 10m resolution area, as returned by get_raster_metadata.
+    interpolation_order : int, optional
+        Order of interpolation as used in scipy's ndimage.zoom (0 = nearest neighbour, 1 = linear, 2 = bi-linear, 3 = cubic). The default is 0.
+
+    Returns
+    -------
+    sen_bands : dict
+        Dictionnary where keys are bands and values are the bands as xarray DataArrays with dimensions band, y and x.
+
+    """
+    sen_bands = {band : rioxarray.open_rasterio(band_paths[band]) for band in list_bands}
+    if interpolation_order != 0:
+        for band in list_bands:
+            if sen_bands[band].rio.resolution() == (20.0,-20.0):
+                sen_bands[band] = import_resampled_sen_stack(band_paths, [band], interpolation_order = interpolation_order, extent = raster_meta["extent"])
+    return sen_bands
+
+def import_resampled_sen_window(sen_bands, list_bands, window, raster_meta):
+    """
+    Imports a window of the bands and resamples bands at 20m resolution at 10m resolution by nearest neighbour.
+    The result is identical to the corresponding window of import_resampled_sen_stack, with the interpolation order used in open_sen_bands.
+
+    Parameters
+    ----------
+    sen_bands : dict
+        Dictionnary where keys are bands and values are the bands as returned by open_sen_bands.
+    list_bands : list
+        List of bands to be imported
+    window : rasterio.windows.Window
+        Window to import, with offsets relative to the area described by raster_meta
+    raster_meta : dict
+        Dictionnary containing metadata of the 10m resolution area, as returned by get_raster_metadata.
+
+    Returns
+    -------
+    concatenated_stack_bands : xarray
+        3D xarray with dimensions x,y and band
+
+    """
+    (row_start, row_stop), (col_start, col_stop) = window.toranges()
+    transform = raster_meta["transform"]
+    resolution = transform.a
+    
+    stack_bands = []
+    for band in list_bands:
+        band_transform = sen_bands[band].rio.transform()
+        factor = int(round(band_transform.a / resolution))
+        #Position of the window in the band, in number of pixels at 10m resolution
+        band_col, band_row = [int(round(position*factor)) for position in ~band_transform * (transform.c + col_start*resolution, transform.f - row_start*resolution)]
+        if factor == 1:
+            stack_bands.append(sen_bands[band].isel(y = slice(band_row, band_row + row_stop - row_start), x = slice(band_col, band_col + col_stop - col_start)).load())
+        else:
+            first_row, first_col = band_row // factor, band_col // factor
+            last_row = -(-(band_row + row_stop - row_start) // factor)
+            last_col = -(-(band_col + col_stop - col_start) // factor)
+            data = sen_bands[band].isel(band = 0, y = slice(first_row, last_row), x = slice(first_col, last_col)).values
+            data = upsample_nearest(data, factor, row_offset = band_row - first_row*factor, col_offset = band_col - first_col*factor, shape = (row_stop - row_start, col_stop - col_start))
+            stack_bands.append(xr.DataArray(data[np.newaxis], dims = ["band","y","x"]).rio.write_crs(sen_bands[band].rio.crs))
+        #Coordinates of the 10m grid are used for all bands
+        stack_bands[-1] = stack_bands[-1].assign_coords(band = [1],
+                                                        y = raster_meta["coords"]["y"].values[row_start:row_stop],
+                                                        x = raster_meta["coords"]["x"].values[col_start:col_stop])
+    
+    concatenated_stack_bands= xr.concat(stack_bands,dim="band")
+    concatenated_stack_bands.coords["band"] = list_bands
+    concatenated_stack_bands.attrs["nodata"] = 0
+    
+    return concatenated_stack_bands
 
         
-def import_binary_raster(raster_path,chunks = None):
+def prefetch(load, keys, depth = 2):
+    """
+    Loads data for each key in background threads, with up to depth keys loaded in advance while the data of the current key is used.
+    At most depth + 1 loaded items are held in memory at the same time.
+
+    Parameters
+    ----------
+    load : function
+        Function taking a key as argument and returning the loaded data. It must read the data, not only open it lazily.
+    keys : list
+        Keys whose data is loaded, in order.
+    depth : int, optional
+        Number of keys loaded in advance. If 0, data is loaded in the calling thread when it is needed. The default is 2.
+
+    Yields
+    ------
+    key : 
+        Key
+    data : 
+        Data returned by load(key)
+
+    """
+    if depth <= 0:
+        for key in keys:
+            yield key, load(key)
+        return
+    
+    with ThreadPoolExecutor(max_workers = depth) as executor:
+        remaining = iter(keys)
+        pending = deque((key, executor.submit(load, key)) for key in islice(remaining, depth))
+        while len(pending) > 0:
+            key, future = pending.popleft()
+            data = future.result()
+            for next_key in islice(remaining, 1):
+                pending.append((next_key, executor.submit(load, next_key)))
+            yield key, data
+            del data
+
+def import_binary_raster(raster_path,chunks = None, extent = None):
     """
     Imports forest mask
 
@@ -682,6 +1079,8 @@ def import_binary_raster(raster_path,chunks = None):
         Path of the forest mask binary raster.
     chunks : int, optional
         Chunks for import as dask array. If None, data is imported as xarray. The default is None.
+    extent : list or 1D array, optional
+        Extent used for cropping [xmin,ymin, xmax,ymax], only the corresponding window is read. If None, there is no cropping. The default is None.
 
     Returns
     -------
@@ -689,7 +1088,7 @@ def import_binary_raster(raster_path,chunks = None):
         Binary array containing True if pixels are inside the region of interest.
 
     """
-    raster = rioxarray.open_rasterio(raster_path,chunks = chunks).squeeze("band")
+    raster = open_raster_extent(raster_path, extent, chunks = chunks).squeeze("band")
     # raster=raster.rename({"band" : "Mask"})
     return raster.astype(bool)
 
@@ -727,6 +1126,18 @@ def import_stackedmaskedVI(tuile,min_date = None, max_date=None,chunks = None):
         
         
         
+    mask_bitplanes = PackedBitplanes(tuile.paths["mask_bitplanes"]) if "mask_bitplanes" in tuile.paths else None
+    if mask_bitplanes is not None and not set(dates).issubset(mask_bitplanes.dates): #Bitplanes are not up to date
+        mask_bitplanes = None
+    
+    if len(dates) > 0 and is_cube(tuile.paths["VegetationIndex"][dates[0]]):
+        cube = import_cube(tuile.paths["VegetationIndex"][dates[0]], dates = dates, chunks = chunks)
+        stack_vi = cube["vegetation_index"].chunk({"Time": -1,"x" : chunks,"y" : chunks})
+        if mask_bitplanes is not None:
+            return stack_vi, import_bitplanes_stack(mask_bitplanes, dates, stack_vi, chunks).chunk({"Time": -1,"x" : chunks,"y" : chunks})
+        stack_masks = cube["mask"].chunk({"Time": -1,"x" : chunks,"y" : chunks})
+        return stack_vi, stack_masks
+        
 # =============================================================================
     list_vi=[xr.open_dataset(tuile.paths["VegetationIndex"][date], chunks = chunks, engine = "rasterio") for date in dates]
     stack_vi=xr.concat(list_vi,dim="Time")
@@ -749,6 +1160,9 @@ def import_stackedmaskedVI(tuile,min_date = None, max_date=None,chunks = None):
     # stack_vi=stack_vi.squeeze("band")
     # stack_vi=stack_vi.chunk({"Time": -1,"x" : chunks,"y" : chunks})    
 
+    if mask_bitplanes is not None:
+        return stack_vi["Band1"], import_bitplanes_stack(mask_bitplanes, dates, stack_vi["Band1"], chunks).chunk({"Time": -1,"x" : chunks,"y" : chunks})
+
     list_mask=[rioxarray.open_rasterio(tuile.paths["Masks"][date],chunks =chunks) for date in dates]
     stack_masks=xr.concat(list_mask,dim="Time")
     stack_masks=stack_masks.assign_coords(Time=dates).astype(bool)
@@ -861,6 +1275,7 @@ def import_stress_data(dict_paths, chunks = None):
     ----------
     dict_paths : dict
         Dictionnary containg the keys "dates_stress", "cum_diff_stress", "nb_dates_stress" and "nb_periods_stress" whose values are the paths to the corresponding stress data file.
+        If it contains the key "stress_periods_table" and the table of stress periods exists, stress data is computed from the table and the "nb_periods_stress" raster.
     chunks : int, optional
         Chunk size for import as dask array. The default is None.
 
@@ -869,6 +1284,11 @@ def import_stress_data(dict_paths, chunks = None):
     stress_data : xarray DataSet or dask DataSet
         DataSet containing four DataArrays, "date" containing the date index of each pixel state change, "nb_periods" containing the total number of stress periods detected for each pixel, "cum_diff" containing for each stress period the sum of the difference between the vegetation index and its prediction, multiplied by the weight if stress_index_mode is "weighted_mean", and "nb_dates" containing the number of valid dates of each stress period.
     """
+    if "stress_periods_table" in dict_paths and dict_paths["stress_periods_table"].exists():
+        stress_periods = import_stress_periods(dict_paths["stress_periods_table"])
+        nb_periods_stress = rioxarray.open_rasterio(dict_paths["nb_periods_stress"]).squeeze("band").load()
+        stress_data = stress_periods_to_dense(stress_periods, nb_periods_stress, stress_periods.attrs["max_nb_stress_periods"])
+        return stress_data.chunk({"x" : chunks, "y" : chunks}) if chunks is not None else stress_data
     
     dates_stress = rioxarray.open_rasterio(dict_paths["dates_stress"],chunks = chunks).rename({"band": "change"})
     cum_diff = rioxarray.open_rasterio(dict_paths["cum_diff_stress"],chunks = chunks).rename({"band": "period"})
@@ -892,6 +1312,42 @@ def import_stress_data(dict_paths, chunks = None):
 
     return stress_data
 
+def import_stress_periods(path):
+    """
+    Imports the table of stress periods
+
+    Parameters
+    ----------
+    path : str
+        Path of the Parquet file written by fordead.writing_data.write_stress_periods
+
+    Returns
+    -------
+    stress_periods : pandas DataFrame
+        Table with a row for each stress period of each pixel, with columns "pixel" (position of the pixel in row-major order), "period", "start_date_index", "end_date_index", "cum_diff" and "nb_dates".
+        Current periods have an end_date_index of 0. The maximum number of stress periods is in stress_periods.attrs["max_nb_stress_periods"].
+    """
+    return pd.read_parquet(path)
+
+def import_sparse_stress_data(dict_paths):
+    """
+    Imports the table of stress periods and splits it into ended stress periods and sparse stress data, used to continue the detection
+
+    Parameters
+    ----------
+    dict_paths : dict
+        Dictionnary containg the keys "stress_periods_table" and "nb_periods_stress" whose values are the paths to the table of stress periods and to the raster of the number of stress periods.
+
+    Returns
+    -------
+    ended_periods : pandas DataFrame
+        Table of ended stress periods
+    stress_data : xarray DataSet
+        Sparse stress data, as described in fordead.stress_periods.initialize_sparse_stress_data
+    """
+    nb_periods_stress = rioxarray.open_rasterio(dict_paths["nb_periods_stress"]).squeeze("band", drop = True)
+    return split_stress_periods(import_stress_periods(dict_paths["stress_periods_table"]), nb_periods_stress)
+
 def import_stress_index(path, chunks = None):
     """
     Imports the stress index of all stress periods
@@ -909,6 +1365,8 @@ def import_stress_index(path, chunks = None):
         DataSet containing the value of the stress index for each pixel and each stress period.
     """
     stress_index = rioxarray.open_rasterio(path,chunks = chunks).rename({"band": "period"})
+    if stress_index.attrs.get("scale_factor", 1) != 1: #Stress index stored as small integers with the quantize option of the output profile
+        stress_index = rioxarray.open_rasterio(path,chunks = chunks, mask_and_scale = True).rename({"band": "period"})
     # stress_index = rioxarray.open_rasterio(path,chunks = chunks).to_array(dim = "period").squeeze("band")
 
     stress_index = stress_index.assign_coords({"period" : range(1,stress_index.period.size+1)})
@@ -916,6 +1374,28 @@ def import_stress_index(path, chunks = None):
 
     return stress_index 
 
+def get_stress_index(dict_paths, stress_data, stress_index_mode):
+    """
+    Imports the stress index of all stress periods if it was written, else computes it from stress data, for example when stress periods are stored in a table.
+
+    Parameters
+    ----------
+    dict_paths : dict
+        Dictionnary containing the key "stress_index" whose value is the path to the stress index raster stack.
+    stress_data : xarray DataSet
+        Stress data, as imported by import_stress_data
+    stress_index_mode : str
+        Chosen stress index, "mean" or "weighted_mean"
+
+    Returns
+    -------
+    stress_index : xarray DataArray (x,y,period)
+        DataArray containing the value of the stress index for each pixel and each stress period.
+    """
+    if dict_paths["stress_index"].exists():
+        return import_stress_index(dict_paths["stress_index"])
+    return compute_stress_index(stress_data, stress_index_mode)
+
 def initialize_dieback_data(shape,coords):
     """
     Initializes data relating to dieback detection
@@ -949,7 +1429,7 @@ def initialize_dieback_data(shape,coords):
     return dieback_data
 
 
-def initialize_stress_data(shape,coords, max_nb_stress_periods):
+def initialize_stress_data(shape,coords, max_nb_stress_periods, dtype = float):
     """
     Initializes data relating to stress periods
 
@@ -961,6 +1441,8 @@ def initialize_stress_data(shape,coords, max_nb_stress_periods):
         Coordinates y and x
     max_nb_stress_periods : int
         Maximum number of stress periods, used to set the number of bands in the DataArrays. "date" will contain max_nb_stress_periods*2+1 bands, "nb_periods" only one, and "cum_diff" and "nb_dates" will contain max_nb_stress_periods+1 bands.
+    dtype : str or numpy dtype, optional
+        Floating point type of "cum_diff". The default is float.
 
     Returns
     -------
@@ -978,7 +1460,7 @@ def initialize_stress_data(shape,coords, max_nb_stress_periods):
     stress_data=xr.Dataset({"date": xr.DataArray(np.zeros(shape+((max_nb_stress_periods+1)*2-1,),dtype=np.uint16), 
                                                  coords= {"y" : coords["y"],"x" : coords["x"],"change" : range(1,(max_nb_stress_periods+1)*2)},dims = ["y","x","change"]),
                          "nb_periods": xr.DataArray(np.zeros(shape,dtype=np.uint8), coords=coords),
-                         "cum_diff": xr.DataArray(np.zeros(shape+(max_nb_stress_periods+1,),dtype=float), 
+                         "cum_diff": xr.DataArray(np.zeros(shape+(max_nb_stress_periods+1,),dtype=dtype), 
                                                                       coords= {"y" : coords["y"],"x" : coords["x"],"period" : range(1,max_nb_stress_periods+2)},dims = ["y","x","period"]),
                          "nb_dates": xr.DataArray(np.zeros(shape+(max_nb_stress_periods+1,),dtype=np.uint16), 
                                                                       coords= {"y" : coords["y"],"x" : coords["x"],"period" : range(1,max_nb_stress_periods+2)},dims = ["y","x","period"])
@@ -1043,7 +1525,35 @@ def initialize_soil_data(shape,coords):
                          "count" : xr.DataArray(count_soil, coords=coords)})
     return soil_data
 
-def import_masked_vi(dict_paths, date, chunks = None):
+def import_vegetation_index(dict_paths, date, chunks = None, window = None):
+    """
+    Imports the vegetation index of a date without its mask, for when the masks are read from elsewhere (e.g. packed bitplanes)
+
+    Parameters
+    ----------
+    dict_paths : str
+        Dictionnary where key "VegetationIndex" returns a dictionnary where keys are SENTINEL dates and values are paths to the files containing the values of the vegetation index for the SENTINEL date.
+    date : str
+        Date in the format "YYYY-MM-DD"
+    chunks : int, optional
+        Chunk size for import as dask array. The default is None.
+    window : rasterio.windows.Window, optional
+        If given, only this window of the vegetation index is imported. The default is None.
+
+    Returns
+    -------
+    vegetation_index : xarray DataArray
+        DataArray containing vegetation index values
+    """
+    window_slices = {} if window is None else dict(zip(["y", "x"], window.toslices()))
+    if is_cube(dict_paths["VegetationIndex"][date]):
+        cube = import_cube(dict_paths["VegetationIndex"][date], dates = [date], chunks = chunks).squeeze("Time", drop = True).isel(window_slices)
+        return cube["vegetation_index"].expand_dims(band = [1])
+    
+    # vegetation_index = rioxarray.open_rasterio(dict_paths["VegetationIndex"][date],chunks = chunks)
+    return xr.open_dataset(dict_paths["VegetationIndex"][date],chunks = chunks, engine = "rasterio")['Band1'].isel(window_slices)
+
+def import_masked_vi(dict_paths, date, chunks = None, window = None):
     """
     Imports masked vegetation index
 
@@ -1055,6 +1565,8 @@ def import_masked_vi(dict_paths, date, chunks = None):
         Date in the format "YYYY-MM-DD"
     chunks : int, optional
         Chunk size for import as dask array. The default is None.
+    window : rasterio.windows.Window, optional
+        If given, only this window of the vegetation index and mask is imported. The default is None.
 
     Returns
     -------
@@ -1063,10 +1575,13 @@ def import_masked_vi(dict_paths, date, chunks = None):
     mask : xarray DataArray
         DataArray containing mask values.
     """
+    window_slices = {} if window is None else dict(zip(["y", "x"], window.toslices()))
+    if is_cube(dict_paths["VegetationIndex"][date]):
+        cube = import_cube(dict_paths["VegetationIndex"][date], dates = [date], chunks = chunks).squeeze("Time", drop = True).isel(window_slices)
+        return cube["vegetation_index"].expand_dims(band = [1]), cube["mask"].expand_dims(band = [1])
     
-    # vegetation_index = rioxarray.open_rasterio(dict_paths["VegetationIndex"][date],chunks = chunks)
-    vegetation_index = xr.open_dataset(dict_paths["VegetationIndex"][date],chunks = chunks, engine = "rasterio")['Band1']
-    mask=rioxarray.open_rasterio(dict_paths["Masks"][date],chunks = chunks).astype(bool)
+    vegetation_index = import_vegetation_index(dict_paths, date, chunks = chunks, window = window)
+    mask=rioxarray.open_rasterio(dict_paths["Masks"][date],chunks = chunks).isel(window_slices).astype(bool) #The window is selected before the type conversion, which reads the data
     
     # masked_vi=xr.Dataset({"vegetation_index": vegetation_index,
     #                          "mask": mask})
@@ -1076,7 +1591,96 @@ def import_masked_vi(dict_paths, date, chunks = None):
 
 
 
-def import_stacked_anomalies(paths_anomalies, chunks = None):
+def is_cube(path):
+    """
+    Checks if a path is the path of a time-stacked cube of vegetation index and masks, as written by step 1 with output_format "zarr"
+
+    Parameters
+    ----------
+    path : str
+        Path of a file, directory or cube
+
+    Returns
+    -------
+    bool
+        True if the path is the path of a cube
+
+    """
+    return Path(path).suffix == ".zarr"
+
+def get_cube_dates(path):
+    """
+    Lists the dates stored in a time-stacked cube
+
+    Parameters
+    ----------
+    path : str
+        Path of the cube
+
+    Returns
+    -------
+    list
+        List of dates in the format "YYYY-MM-DD", empty if the cube does not exist yet.
+
+    """
+    if not (Path(path) / "zarr.json").exists() and not (Path(path) / ".zgroup").exists():
+        return []
+    cube = xr.open_zarr(path, consolidated = False)
+    return list(cube.Time.dt.strftime("%Y-%m-%d").values)
+
+def import_cube(path, dates = None, chunks = None):
+    """
+    Imports the time-stacked cube containing the vegetation index and masks of every date, as written by step 1 with output_format "zarr" (requires zarr)
+
+    Parameters
+    ----------
+    path : str
+        Path of the cube
+    dates : list, optional
+        Dates in the format "YYYY-MM-DD" to import. If None, all dates are imported. The default is None.
+    chunks : int, optional
+        If not None, data is imported as dask arrays using the chunks of the cube, so it can be rechunked without reading data. If None, data is imported as xarray. The default is None.
+
+    Returns
+    -------
+    cube : xarray DataSet
+        DataSet with variables "vegetation_index" and "mask", with dimensions Time, y and x. Time coordinates are dates in the format "YYYY-MM-DD".
+
+    """
+    
+    cube = xr.open_dataset(path, engine = "zarr", consolidated = False, chunks = None if chunks is None else {})
+    cube = cube.set_coords("spatial_ref")
+    cube = cube.assign_coords(Time = cube.Time.dt.strftime("%Y-%m-%d").values)
+    if dates is not None:
+        cube = cube.sel(Time = list(dates))
+    return cube
+
+def import_bitplanes_stack(bitplanes, dates, example_array, chunks = None):
+    """
+    Imports binary data stored as packed bitplanes as a 3D DataArray. Only the planes containing the dates are read, and with chunks, each chunk is unpacked when it is computed.
+
+    Parameters
+    ----------
+    bitplanes : PackedBitplanes
+        Bitplanes containing the dates
+    dates : list
+        Dates in the format "YYYY-MM-DD"
+    example_array : xarray DataArray
+        DataArray with the y and x coordinates of the stored data, other coordinates without dimension are also copied
+    chunks : int, optional
+        Chunk size for import as dask array. If None, data is imported as xarray. The default is None.
+
+    Returns
+    -------
+    stack : xarray DataArray
+        3D binary DataArray with dimensions Time, y and x.
+
+    """
+    data = bitplanes.read(dates) if chunks is None else bitplanes.to_dask(dates, chunks = chunks)
+    coords = {coord : example_array.coords[coord] for coord in example_array.coords if example_array.coords[coord].ndim == 0 and coord not in ["Time","band"]}
+    return xr.DataArray(data, coords = dict(coords, Time = list(dates), y = example_array.y, x = example_array.x), dims = ["Time","y","x"])
+
+def import_stacked_anomalies(paths_anomalies, chunks = None, bitplanes_path = None):
     """
     Imports all stacked anomalies
 
@@ -1086,6 +1690,8 @@ def import_stacked_anomalies(paths_anomalies, chunks = None):
         Dictionnary where keys are dates in the format "YYYY-MM-DD" and values are the paths to the raster file containing anomaly data.
     chunks : int, optional
         Chunk size for import as dask array. The default is None.
+    bitplanes_path : str, optional
+        Path of the directory containing anomalies stored as packed bitplanes. If given and the bitplanes contain all dates, anomalies are imported from the bitplanes. The default is None.
 
     Returns
     -------
@@ -1093,6 +1699,10 @@ def import_stacked_anomalies(paths_anomalies, chunks = None):
         3D binary DataArray with value True where there are anomalies, with Time coordinates.
 
     """
+    if bitplanes_path is not None and set(paths_anomalies).issubset(PackedBitplanes(bitplanes_path).dates):
+        example_anomalies = rioxarray.open_rasterio(next(iter(paths_anomalies.values()))).squeeze("band")
+        return import_bitplanes_stack(PackedBitplanes(bitplanes_path), list(paths_anomalies), example_anomalies, chunks = chunks).chunk({"Time": -1,"x" : chunks,"y" : chunks})
+    
     list_anomalies=[rioxarray.open_rasterio(paths_anomalies[date], chunks = chunks) for date in paths_anomalies]
     stack_anomalies=xr.concat(list_anomalies,dim="Time")
     stack_anomalies=stack_anomalies.assign_coords(Time=[date for date in paths_anomalies.keys()])
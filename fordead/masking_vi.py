@@ -4,6 +4,9 @@ import warnings
 import xarray as xr
 import numpy as np
 import re
+import ast
+import operator
+from functools import lru_cache
 from pathlib import Path
 import json
 from shapely.geometry import Polygon
@@ -19,6 +22,11 @@ from rasterio.vrt import WarpedVRT
 
 import rioxarray
 
+try:
+    import numexpr
+except ImportError: # numexpr is optional, formulas are evaluated with numpy if it is not installed
+    numexpr = None
+
 def bdforet_paths_in_zone(example_raster, dep_path, bdforet_dirpath):
     """
     Returns list of shapefile in the zone given by the raster, as well as the polygon extent of the raster
@@ -236,8 +244,8 @@ def raster_full(path_example_raster, fill_value, dtype = None):
 
     """
     
-    filled_raster = rioxarray.open_rasterio(path_example_raster).sel(band=1)
-    filled_raster[:,:]=fill_value
+    example_raster = rioxarray.open_rasterio(path_example_raster).sel(band=1)
+    filled_raster = example_raster.copy(data = np.full(example_raster.shape, fill_value, dtype = example_raster.dtype)) #The example raster is not read
 
     # filled_raster.rio.crs=filled_raster.crs.replace("+init=","") #Remove "+init=" which it deprecated
     if dtype!= None : filled_raster.data = filled_raster.data.astype(dtype)
@@ -266,7 +274,7 @@ def get_pre_masks(stack_bands):
 
     """
     
-    soil_anomaly = compute_vegetation_index(stack_bands, formula = "(B11 > 1250) & (B2 < 600) & ((B3 + B4) > 800)")
+    soil_anomaly = compute_vegetation_index(stack_bands, formula = "(B11 > 1250) & (B2 < 600) & ((B3 + B4) > 800)", dtype = "float64")
     # soil_anomaly = compute_vegetation_index(stack_bands, formula = "(B11 > 1250) & (B2 < 600) & (B4 > 600)")
     # soil_anomaly = compute_vegetation_index(stack_bands, formula = "(B4 + B2 - B3)/(B4 + B2 + B3)") #Bare soil index
     shadows = (stack_bands==0).any(dim = "band")
@@ -283,29 +291,70 @@ def detect_soil(soil_data, soil_anomaly, invalid, date_index):
 
     Parameters
     ----------
-    soil_data : xarray DataSet
+    soil_data : xarray DataSet or dict of numpy arrays
         DataSet where variable "state" is True where pixels are detected as cut, variable "count" gives the number of successive soil anomalies, and "first_date" gives the date index of the first anomaly
-    soil_anomaly : xarray DataArray
+    soil_anomaly : xarray DataArray or numpy array
         Binary DataArray, holds True where soil anomalies are detected
-    invalid : xarray DataArray
+    invalid : xarray DataArray or numpy array
         Binary DataArray, aggregates shadows, very visible clouds and pixels outside swath
     date_index : int
         Index of the date
 
     Returns
     -------
-    soil_data : xarray DataSet
-        Updated soil_data DataSet
+    soil_data : xarray DataSet or dict of numpy arrays
+        Updated soil_data, the arrays are updated in place if they are numpy arrays
 
     """
     
-    soil_data["count"]=xr.where(~invalid & soil_anomaly,soil_data["count"]+1,soil_data["count"])
-    soil_data["count"]=xr.where(~invalid & ~soil_anomaly,0,soil_data["count"])
-    soil_data["state"] = xr.where(soil_data["count"] == 3, True, soil_data["state"])
-    soil_data["first_date"] = xr.where(~invalid & (soil_data["count"] == 1) & ~soil_data["state"],date_index,soil_data["first_date"]) #Keeps index of first soil detection
+    # soil_data["count"]=xr.where(~invalid & soil_anomaly,soil_data["count"]+1,soil_data["count"])
+    # soil_data["count"]=xr.where(~invalid & ~soil_anomaly,0,soil_data["count"])
+    # soil_data["state"] = xr.where(soil_data["count"] == 3, True, soil_data["state"])
+    # soil_data["first_date"] = xr.where(~invalid & (soil_data["count"] == 1) & ~soil_data["state"],date_index,soil_data["first_date"]) #Keeps index of first soil detection
+    
+    soil_arrays = {var : np.asarray(soil_data[var]) for var in ["count", "state", "first_date"]}
+    update_soil_arrays(soil_arrays["count"], soil_arrays["state"], soil_arrays["first_date"], np.asarray(soil_anomaly), np.asarray(invalid), date_index)
+    if isinstance(soil_data, xr.Dataset):
+        for var in soil_arrays:
+            soil_data[var].values = soil_arrays[var] #Only necessary if soil_data was not loaded as numpy arrays, which are updated in place
     
     return soil_data
 
+def update_soil_arrays(count, state, first_date, soil_anomaly, invalid, date_index):
+    """
+    Updates soil detection arrays in place using soil anomalies from a new date. 
+    Only boolean buffers are allocated, so the update of a window of the soil data can be done directly on views of the arrays of the whole tile.
+
+    Parameters
+    ----------
+    count : numpy array
+        Number of successive soil anomalies
+    state : numpy array
+        Boolean array, holds True where pixels are detected as cut
+    first_date : numpy array
+        Date index of the first soil anomaly
+    soil_anomaly : numpy array
+        Boolean array, holds True where soil anomalies are detected
+    invalid : numpy array
+        Boolean array, aggregates shadows, very visible clouds and pixels outside swath
+    date_index : int
+        Index of the date
+
+    """
+    valid_anomaly = np.logical_not(invalid)
+    valid_normal = np.logical_not(soil_anomaly)
+    np.logical_and(valid_normal, valid_anomaly, out = valid_normal)
+    np.logical_and(valid_anomaly, soil_anomaly, out = valid_anomaly)
+    
+    np.add(count, 1, out = count, where = valid_anomaly, casting = "unsafe")
+    np.copyto(count, 0, where = valid_normal, casting = "unsafe")
+    np.logical_or(state, count == 3, out = state)
+    
+    #Keeps index of first soil detection
+    np.logical_and(valid_anomaly, count == 1, out = valid_anomaly) #Count can only be 1 if there is a valid soil anomaly
+    np.logical_and(valid_anomaly, ~state, out = valid_anomaly)
+    np.copyto(first_date, date_index, where = valid_anomaly, casting = "unsafe")
+
 
 def detect_clouds(stack_bands, soil_state, soil_anomaly):
     """
@@ -327,18 +376,111 @@ def detect_clouds(stack_bands, soil_state, soil_anomaly):
 
     """
     
-    # NG = stack_bands.sel(band = "B3")/(stack_bands.sel(band = "B8A")+stack_bands.sel(band = "B4")+stack_bands.sel(band = "B3"))
-    NG = compute_vegetation_index(stack_bands, formula = "B3/(B8A+B4+B3)")
-    cond1 = NG > 0.15
-    cond2 = stack_bands.sel(band = "B2") > 400
-    cond3 = stack_bands.sel(band = "B2") > 700
     cond4 =  ~(soil_state | soil_anomaly) #Not detected as soil
+    clouds = cond4 & detect_cloud_candidates(stack_bands)
+    return dilate_clouds(clouds)
+
+def detect_cloud_candidates(stack_bands):
+    """
+    Detects pixels which are cloudy according to the reflectance of a single date, before soil pixels are removed and the dilation is applied.
+    This part of the cloud detection does not depend on previous dates.
+
+    Parameters
+    ----------
+    stack_bands : xarray DataArray
+        3D xarray with band dimension
+
+    Returns
+    -------
+    cloud_candidates : xarray DataArray
+        Binary DataArray, holds True where pixels are considered cloudy before removal of soil pixels and dilation
+
+    """
+    return compute_vegetation_index(stack_bands, formula = "(B2 > 700) | ((B3/(B8A+B4+B3) > 0.15) & (B2 > 400))", dtype = "float64")
+
+def compute_pre_masks_fused(stack, band_names, block_rows = 256):
+    """
+    Computes the masks of a single date which do not depend on previous dates, in a single pass over blocks of rows. 
+    Each band is read once per block, and intermediate results are kept in boolean and floating point buffers of the size of a block, so memory traffic is limited to reading the bands and writing the results.
+    Results are identical to those of get_pre_masks and detect_cloud_candidates.
+
+    Parameters
+    ----------
+    stack : numpy array
+        3D array of SENTINEL data with dimensions (band, y, x). Must contain bands B2, B3, B4, B8A and B11.
+    band_names : list of str
+        Names of the bands in the order of the first dimension of stack
+    block_rows : int, optional
+        Number of rows processed at once. The default is 256.
+
+    Returns
+    -------
+    mask : numpy array
+        Boolean array, holds True where pixels are masked as shadows, outside swath, or soil anomalies
+    soil_inputs : numpy array
+        Boolean array with dimensions (3, y, x), holding the soil anomalies, invalid pixels and cloud candidates, as used by update_soil_mask
+
+    """
     
-    clouds = cond4 & (cond3 | (cond1 & cond2))    
-    clouds[:,:] = ndimage.binary_dilation(clouds,iterations=3,structure=ndimage.generate_binary_structure(2, 1)) # 3 pixels dilation of cloud mask
-    return clouds
+    band_index = {band : index for index, band in enumerate(band_names)}
+    height, width = stack.shape[1:]
+    mask = np.empty((height, width), dtype = bool)
+    soil_inputs = np.empty((3, height, width), dtype = bool)
+    
+    flag = np.empty((min(block_rows, height), width), dtype = bool)
+    reflectance_sum = np.empty((min(block_rows, height), width), dtype = np.float64)
+    
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        for start in range(0, height, block_rows):
+            rows = slice(start, min(start + block_rows, height))
+            block_flag = flag[:rows.stop - rows.start]
+            block_sum = reflectance_sum[:rows.stop - rows.start]
+            block_mask = mask[rows]
+            soil_anomaly, invalid, cloud_candidates = soil_inputs[:, rows]
+            B2, B3, B4, B8A, B11 = [stack[band_index[band], rows] for band in ["B2", "B3", "B4", "B8A", "B11"]]
+            
+            #Shadows
+            np.equal(stack[0, rows], 0, out = block_mask)
+            for band_stack in stack[1:, rows]:
+                np.logical_or(block_mask, np.equal(band_stack, 0, out = block_flag), out = block_mask)
+            #Outside swath
+            np.logical_or(block_mask, np.less(stack[0, rows], 0, out = block_flag), out = block_mask)
+            #Invalid
+            np.logical_or(block_mask, np.greater_equal(B2, 600, out = block_flag), out = invalid)
+            
+            #Soil anomaly : (B11 > 1250) & (B2 < 600) & ((B3 + B4) > 800)
+            np.add(B3, B4, out = block_sum)
+            np.greater(block_sum, 800, out = soil_anomaly)
+            np.logical_and(soil_anomaly, np.greater(B11, 1250, out = block_flag), out = soil_anomaly)
+            np.logical_and(soil_anomaly, np.less(B2, 600, out = block_flag), out = soil_anomaly)
+            np.logical_or(block_mask, soil_anomaly, out = block_mask)
+            
+            #Cloud candidates : (B2 > 700) | ((B3/(B8A+B4+B3) > 0.15) & (B2 > 400))
+            np.add(block_sum, B8A, out = block_sum)
+            np.divide(B3, block_sum, out = block_sum)
+            np.greater(block_sum, 0.15, out = cloud_candidates)
+            np.logical_and(cloud_candidates, np.greater(B2, 400, out = block_flag), out = cloud_candidates)
+            np.logical_or(cloud_candidates, np.greater(B2, 700, out = block_flag), out = cloud_candidates)
+    
+    return mask, soil_inputs
+
+def dilate_clouds(clouds):
+    """
+    Applies a 3 pixels dilation to the cloud mask. The result is exact in the whole array, except on the 3 pixels wide border if the array is a window of a larger area.
 
+    Parameters
+    ----------
+    clouds : xarray DataArray or 2D numpy array
+        Binary array, holds True where clouds are detected, soil pixels already removed
+
+    Returns
+    -------
+    clouds : xarray DataArray or 2D numpy array
+        Binary array mask, holds True where clouds are detected after dilation
 
+    """
+    clouds[:,:] = ndimage.binary_dilation(clouds,iterations=3,structure=ndimage.generate_binary_structure(2, 1)) # 3 pixels dilation of cloud mask
+    return clouds
 
 def compute_masks(stack_bands, soil_data, date_index):
     """
@@ -360,18 +502,102 @@ def compute_masks(stack_bands, soil_data, date_index):
 
     """
     
-    soil_anomaly, shadows, outside_swath, invalid = get_pre_masks(stack_bands)
+    mask, soil_inputs = compute_pre_masks_fused(stack_bands.values, list(stack_bands.band.values))
     
-    # Compute soil
-    soil_data = detect_soil(soil_data, soil_anomaly, invalid, date_index)
-
-    # Compute clouds
-    clouds = detect_clouds(stack_bands, soil_data["state"], soil_anomaly)
+    # Compute soil and clouds
+    mask, clouds = update_soil_mask(mask, soil_data, soil_inputs, date_index)
     
     #Combine all masks
-    mask = shadows | clouds | outside_swath | soil_data['state'] | soil_anomaly
+    np.logical_or(mask, dilate_clouds(clouds), out = mask)
 
-    return mask
+    return stack_bands.isel(band = 0, drop = True).copy(data = mask)
+
+def compute_date_masked_vi(stack_bands, vi_formula, soil_detection = True, formula_mask = "(B2 >= 700)", source_mask = None, dtype = None):
+    """
+    Computes the vegetation index of a single SENTINEL date and the part of its mask which does not depend on previous dates.
+    If soil_detection is True, the soil anomalies, invalid pixels and cloud candidates are also returned so the mask can be completed with [update_soil_mask](https://fordead.gitlab.io/fordead_package/reference/fordead/masking_vi/#update_soil_mask), which must be called in the order of the dates.
+    As it does not depend on other dates or on neighbouring pixels, this function can be used on several dates in parallel, and on windows of the SENTINEL tile.
+
+    Parameters
+    ----------
+    stack_bands : xarray DataArray
+        3D xarray with band dimension
+    vi_formula : str
+        Formula of the vegetation index, as used in compute_vegetation_index
+    soil_detection : bool, optional
+        If True, soil and clouds are detected, else the mask from formula_mask is used. The default is True.
+    formula_mask : str, optional
+        Logical operation involving Sentinel-2 bands used as mask if soil_detection is False. The default is "(B2 >= 700)".
+    source_mask : xarray DataArray, optional
+        Binary mask from the SENTINEL data provider, as returned by convert_source_mask, added to the mask if given. The default is None.
+    dtype : str or numpy dtype, optional
+        Floating point type of the vegetation index, see compute_vegetation_index. The default is None.
+
+    Returns
+    -------
+    vegetation_index : xarray DataArray
+        Vegetation index, invalid values are replaced by 0
+    mask : xarray DataArray
+        Binary DataArray, holds True where pixels are masked, without soil and clouds if soil_detection is True.
+    soil_inputs : numpy array or None
+        Boolean array with dimensions (3, y, x), holding soil_anomaly, invalid and cloud_candidates arrays if soil_detection is True, else None.
+
+    """
+    
+    vegetation_index = compute_vegetation_index(stack_bands, formula = vi_formula, dtype = dtype)
+    invalid_values = vegetation_index.isnull() | np.isinf(vegetation_index)
+    vegetation_index = vegetation_index.where(~invalid_values,0)
+    
+    if soil_detection:
+        mask, soil_inputs = compute_pre_masks_fused(stack_bands.values, list(stack_bands.band.values))
+        mask = stack_bands.isel(band = 0, drop = True).copy(data = mask)
+    else:
+        mask = compute_user_mask(stack_bands, formula_mask)
+        soil_inputs = None
+    mask = mask | invalid_values
+    if source_mask is not None:
+        mask = mask | source_mask
+    
+    return vegetation_index, mask, soil_inputs
+
+def update_soil_mask(mask, soil_data, soil_inputs, date_index):
+    """
+    Updates soil detection with a new date, adds soil to the mask of this date and returns the clouds, before dilation. Dates must be processed in chronological order.
+    As this operation does not depend on neighbouring pixels, it can be applied on windows of the SENTINEL tile, in which case soil_data holds the corresponding window of the soil data.
+    soil_data is updated in place, and so is mask if it is a numpy array.
+
+    Parameters
+    ----------
+    mask : xarray DataArray or numpy array
+        Binary array, mask of the date as returned by compute_date_masked_vi
+    soil_data : xarray DataSet or dict of numpy arrays
+        DataSet where variable "state" is True where pixels are detected as cut, variable "count" gives the number of successive soil anomalies, and "first_date" gives the date index of the first anomaly
+    soil_inputs : numpy array or tuple of arrays
+        soil_anomaly, invalid and cloud_candidates arrays as returned by compute_date_masked_vi
+    date_index : int
+        Index of the date
+
+    Returns
+    -------
+    mask : xarray DataArray or numpy array
+        Binary array, holds True where pixels are masked, without clouds
+    clouds : numpy array
+        Binary array, holds True where clouds are detected, before the dilation with dilate_clouds
+
+    """
+    soil_anomaly, invalid, cloud_candidates = [np.asarray(soil_input) for soil_input in soil_inputs]
+    soil_data = detect_soil(soil_data, soil_anomaly, invalid, date_index)
+    state = np.asarray(soil_data["state"])
+    
+    clouds = np.logical_or(state, soil_anomaly)
+    np.logical_not(clouds, out = clouds)
+    np.logical_and(clouds, cloud_candidates, out = clouds)
+    
+    if isinstance(mask, np.ndarray):
+        np.logical_or(mask, state, out = mask)
+    else:
+        mask = mask | state
+    return mask, clouds
 
 def compute_user_mask(stack_bands, formula_mask):
     """
@@ -398,10 +624,17 @@ def compute_user_mask(stack_bands, formula_mask):
         
     return mask
 
+DEFAULT_DICT_VI = {"CRSWIR" : {'formula': 'B11/(B8A+((B12-B8A)/(2185.7-864))*(1610.4-864))', 'dieback_change_direction': '+'},
+                   "NDVI" : {'formula': '(B8-B4)/(B8+B4)', 'dieback_change_direction': '-'},
+                   "BSI" : {"formula" : '(B4 + B2 - B3)/(B4 + B2 + B3)', 'dieback_change_direction' : '-'},
+                   "NDWI" : {"formula" : '(B8A-B11)/(B8A+B11)', 'dieback_change_direction' : '-'},
+                   "NBR" : {"formula" : '(B8-B12)/(B8+B12)', 'dieback_change_direction' : '-'}}
+
 def get_dict_vi(path_dict_vi = None):
     """
     Imports dictionnary containing formula of vegetation indices, as well as the way it changes in case of dieback
     CRSWIR, NDVI, BSI and NDWI can be used without specifying the formulas in a path_dict_vi text file.
+    The text file is only read once, as described in get_vi_registry.
     Parameters
     ----------
     path_dict_vi : str, optional
@@ -415,21 +648,92 @@ def get_dict_vi(path_dict_vi = None):
         Dictionnary containing formula of vegetation indices, as well as the way it changes in case of dieback
 
     """
+    return get_vi_registry(path_dict_vi).as_dict()
+
+class VegetationIndex():
+    """
+    Vegetation index of a VIRegistry, with its formula, the way it changes in case of dieback, and its formula compiled with compile_formula when it is first used.
+    """
+    
+    def __init__(self, name, formula, dieback_change_direction):
+        self.name = name
+        self.formula = formula
+        self.dieback_change_direction = dieback_change_direction
+    
+    @property
+    def kernel(self):
+        """
+        Compiled formula, as returned by compile_formula
+        """
+        return compile_formula(self.formula)
+    
+    @property
+    def bands(self):
+        """
+        Sorted list of the bands used in the formula
+        """
+        return self.kernel.bands
+    
+    def __repr__(self):
+        return "VegetationIndex(" + repr(self.name) + ", " + repr(self.formula) + ", " + repr(self.dieback_change_direction) + ")"
+
+class VIRegistry():
+    """
+    Vegetation indices which can be used with the "vi" parameter, default indices and those of a path_dict_vi text file. Registries are created with get_vi_registry, which caches them.
+    """
+    
+    def __init__(self, dict_vi):
+        """
+        Parameters
+        ----------
+        dict_vi : dict
+            Dictionnary where keys are names of vegetation indices, and values are dictionnaries with keys "formula" and "dieback_change_direction"
+
+        """
+        self.indices = {name : VegetationIndex(name, info["formula"], info["dieback_change_direction"]) for name, info in dict_vi.items()}
+    
+    def __getitem__(self, vi):
+        return self.indices[vi]
     
-    dict_vi = {"CRSWIR" : {'formula': 'B11/(B8A+((B12-B8A)/(2185.7-864))*(1610.4-864))', 'dieback_change_direction': '+'},
-                "NDVI" : {'formula': '(B8-B4)/(B8+B4)', 'dieback_change_direction': '-'},
-                "BSI" : {"formula" : '(B4 + B2 - B3)/(B4 + B2 + B3)', 'dieback_change_direction' : '-'},
-                "NDWI" : {"formula" : '(B8A-B11)/(B8A+B11)', 'dieback_change_direction' : '-'},
-                "NBR" : {"formula" : '(B8-B12)/(B8+B12)', 'dieback_change_direction' : '-'}}
+    def __contains__(self, vi):
+        return vi in self.indices
+    
+    def as_dict(self):
+        """
+        Returns the vegetation indices as a dictionnary, as described in get_dict_vi
+        """
+        return {name : {"formula" : index.formula, "dieback_change_direction" : index.dieback_change_direction} for name, index in self.indices.items()}
+
+def get_vi_registry(path_dict_vi = None):
+    """
+    Returns the registry of vegetation indices. The path_dict_vi text file is read once, registries being cached by path and modification time of the file, so they are shared by every step and date.
+
+    Parameters
+    ----------
+    path_dict_vi : str or VIRegistry, optional
+        Path of the text file, as described in get_dict_vi. A registry can also be given, in which case it is returned, so it can be resolved once and passed to functions called for each date. The default is None.
+
+    Returns
+    -------
+    VIRegistry
+        Registry of the default vegetation indices and of those of the text file
+
+    """
+    if isinstance(path_dict_vi, VIRegistry):
+        return path_dict_vi
+    if path_dict_vi is None:
+        return _load_vi_registry(None, None)
+    return _load_vi_registry(str(path_dict_vi), Path(path_dict_vi).stat().st_mtime_ns)
+
+@lru_cache(maxsize = 16)
+def _load_vi_registry(path_dict_vi, modification_time):
+    dict_vi = {name : dict(info) for name, info in DEFAULT_DICT_VI.items()}
     if path_dict_vi is not None:
-        d = {}
         with open(path_dict_vi) as f:
             for line in f:
                 list_line = line.split()
-                d[list_line[0]]={"formula" : list_line[1], "dieback_change_direction" : list_line[2]}
-                
-        dict_vi.update(d)
-    return dict_vi
+                dict_vi[list_line[0]]={"formula" : list_line[1], "dieback_change_direction" : list_line[2]}
+    return VIRegistry(dict_vi)
 
 def remove_0_from_match(matchobj):
     return re.sub(r'0',"",matchobj.group(0))
@@ -460,7 +764,7 @@ def get_bands_and_formula(vi = "CRSWIR", formula = None, path_dict_vi = None,for
 
     """
     if formula is None:
-        formula = get_dict_vi(path_dict_vi)[vi]["formula"]
+        formula = get_vi_registry(path_dict_vi)[vi].formula
     match_string = r"B(\d{1}[A-Z]|\d{2}|\d{1})"
     formula = re.sub(match_string, remove_0_from_match, formula)
     bands = list(set([forced_band.replace("0","") for forced_band in forced_bands] + ["B"+band for band in re.findall(match_string, formula)]))
@@ -485,10 +789,29 @@ def get_source_mask(band_paths, sentinel_source: str, extent = None):
     binary_mask : xarray DataArray
         Binary array with value 1 when pixel is masked.
 
+    """
+    source_mask = import_resampled_sen_stack(band_paths, ["Mask"], interpolation_order = 0, extent = extent)
+    return convert_source_mask(source_mask, sentinel_source)
+
+def convert_source_mask(source_mask, sentinel_source: str):
+    """
+    Converts source mask to binary. Keeps only 0 in THEIA mask, and only 4 and 5 in Scihub and PEPS mask.
+
+    Parameters
+    ----------
+    source_mask : xarray DataArray
+        Mask from the SENTINEL data provider
+    sentinel_source : str
+        Sentinel source (theia, scihub or peps).
+
+    Returns
+    -------
+    binary_mask : xarray DataArray
+        Binary array with value 1 when pixel is masked.
+
     """
     sentinel_source = sentinel_source.lower()
     
-    source_mask = import_resampled_sen_stack(band_paths, ["Mask"], interpolation_order = 0, extent = extent)
     if sentinel_source=="theia":
         binary_mask = source_mask>0
     elif sentinel_source=="scihub" or sentinel_source=="peps":
@@ -533,7 +856,7 @@ def get_source_mask(band_paths, sentinel_source: str, extent = None):
 #     code_formula = p.sub(r'stack_bands.sel(band= "B\1")', formula)
 #     return eval(code_formula)
 
-def compute_vegetation_index(reflectance, vi = "CRSWIR", formula = None, path_dict_vi = None):
+def compute_vegetation_index(reflectance, vi = "CRSWIR", formula = None, path_dict_vi = None, dtype = None):
     """
     Computes vegetation index
 
@@ -552,25 +875,205 @@ def compute_vegetation_index(reflectance, vi = "CRSWIR", formula = None, path_di
             The default is None.
     path_dict_vi : str, optional
         Path to a text file containing vegetation indices formulas so they can be used using 'vi' parameter. See get_dict_vi documentation. The default is None.
+    dtype : str or numpy dtype, optional
+        Floating point type used for the computation (ex : "float32"). If None, numpy's type promotion rules apply, so indices computed from integer bands are float64. The default is None.
 
     Returns
     -------
-    xarray DataArray
+    xarray DataArray or pandas Series
         Computed vegetation index
 
     """
-    if formula is None:
-        dict_vegetation_index = get_dict_vi(path_dict_vi)
-        formula = dict_vegetation_index[vi]["formula"]
+    kernel = get_vi_registry(path_dict_vi)[vi].kernel if formula is None else compile_formula(formula)
+    
+    if isinstance(reflectance, pd.DataFrame):
+        result = kernel.evaluate({band : reflectance[band].to_numpy() for band in kernel.bands}, dtype = dtype)
+        return pd.Series(result, index = reflectance.index)
+    else:
+        result = kernel.evaluate({band : reflectance.sel(band = band).values for band in kernel.bands}, dtype = dtype)
+        return reflectance.isel(band = 0, drop = True).copy(deep = False, data = result)
+
+@lru_cache(maxsize = 64)
+def compile_formula(formula):
+    """
+    Parses a formula once, so it can be evaluated on many dates or windows without parsing it again.
 
+    Parameters
+    ----------
+    formula : str
+        Formula as used in compute_vegetation_index. Bands can be called by their name, with or without 0 (B03 or B3).
+
+    Returns
+    -------
+    FormulaKernel
+        Parsed formula
+
+    """
     match_string = r"B(\d{1}[A-Z]|\d{2}|\d{1})" # B + un chiffre + une lettre OU B + deux chiffres OU B + un chiffre
     formula = re.sub(match_string, remove_0_from_match, formula) #Removes 0 from band name (B03 -> B3)
-    p = re.compile(match_string)
+    return FormulaKernel(formula)
+
+class FormulaKernel():
+    """
+    Formula parsed into a kernel evaluated on numpy arrays of bands.
+    If a dtype is given, the formula is evaluated in this type with numexpr if it is installed, which fuses operations and avoids temporary arrays, 
+    or else with numpy operations done in place in a few buffers of this type. If not, the formula is evaluated by numpy with its usual type promotion rules.
+    """
     
-    if isinstance(reflectance, pd.DataFrame):
-        code_formula = p.sub(r'reflectance["B\1"]', formula)
-    else:
-        code_formula = p.sub(r'reflectance.sel(band= "B\1")', formula)
+    BINARY_OPERATORS = {ast.Add : ("+", np.add, operator.add), ast.Sub : ("-", np.subtract, operator.sub), ast.Mult : ("*", np.multiply, operator.mul), 
+                        ast.Div : ("/", np.true_divide, operator.truediv), ast.Pow : ("**", np.power, operator.pow), ast.Mod : ("%", np.remainder, operator.mod), 
+                        ast.BitAnd : ("&", np.logical_and, operator.and_), ast.BitOr : ("|", np.logical_or, operator.or_), ast.BitXor : ("^", np.logical_xor, operator.xor)}
+    LOGICAL_OPERATORS = (ast.BitAnd, ast.BitOr, ast.BitXor)
+    COMPARISON_OPERATORS = {ast.Gt : (">", np.greater), ast.GtE : (">=", np.greater_equal), ast.Lt : ("<", np.less), 
+                            ast.LtE : ("<=", np.less_equal), ast.Eq : ("==", np.equal), ast.NotEq : ("!=", np.not_equal)}
+    NUMEXPR_FUNCTIONS = {"sqrt", "exp", "expm1", "log", "log10", "log1p", "abs", "sin", "cos", "tan", "arcsin", "arccos", "arctan", "arctan2", "sinh", "cosh", "tanh", "where"}
+    
+    def __init__(self, formula):
+        self.formula = formula
+        self.tree = ast.parse(formula, mode = "eval").body
+        self.bands = sorted({node.id for node in ast.walk(self.tree) if isinstance(node, ast.Name) and re.fullmatch(r"B(\d{1}[A-Z]|\d{2}|\d{1})", node.id)})
+        self.code = compile(formula, "<formula>", "eval")
+        self.constants = {}
+        self.numexpr_unsupported_dtypes = set()
+        self.numexpr_formula = self._to_numexpr(self.tree) if numexpr is not None else None
+        
+    def evaluate(self, bands, dtype = None, out = None):
+        """
+        Evaluates the formula
+
+        Parameters
+        ----------
+        bands : dict
+            Dictionnary where keys are band names and values are numpy arrays of the same shape
+        dtype : str or numpy dtype, optional
+            Floating point type used for the computation. If None, numpy's type promotion rules apply. The default is None.
+        out : numpy array, optional
+            Array in which the result is written. The default is None.
+
+        Returns
+        -------
+        numpy array
+            Result of the formula
+
+        """
+        if dtype is not None and self.numexpr_formula is not None and np.dtype(dtype) not in self.numexpr_unsupported_dtypes:
+            local_dict = {band : bands[band].astype(dtype, copy = False) for band in self.bands}
+            for name, value in self.constants.items():
+                local_dict[name] = np.asarray(value, dtype = dtype)
+            try:
+                return numexpr.evaluate(self.numexpr_formula, local_dict = local_dict, global_dict = {}, out = out, casting = "same_kind")
+            except (NotImplementedError, TypeError, ValueError): #Operations not supported by numexpr for these types, for example bitwise operations on floats
+                self.numexpr_unsupported_dtypes.add(np.dtype(dtype))
         
-    return eval(code_formula)
+        # Divisions by zero give inf or nan, which are handled as invalid values of the index, as with numexpr
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            if dtype is not None:
+                try:
+                    return self._evaluate_inplace(self.tree, bands, np.dtype(dtype), [], out)[0]
+                except TypeError: #Operations not supported in place, for example bitwise operations on integers
+                    pass
+            
+            result = np.asarray(eval(self.code, {"np" : np}, dict(bands)))
+        if dtype is not None and np.issubdtype(result.dtype, np.number):
+            result = result.astype(dtype, copy = False)
+        if out is not None:
+            np.copyto(out, result, casting = "same_kind")
+            return out
+        return result
+    
+    def _to_numexpr(self, node):
+        """
+        Translates the parsed formula to a numexpr expression, returns None if the formula uses operations not supported by numexpr. 
+        Constants are replaced by variables, so they can be given the type used for the computation.
+        """
+        if isinstance(node, ast.BinOp) and type(node.op) in self.BINARY_OPERATORS:
+            left, right = self._to_numexpr(node.left), self._to_numexpr(node.right)
+            return None if left is None or right is None else "(" + left + self.BINARY_OPERATORS[type(node.op)][0] + right + ")"
+        elif isinstance(node, ast.Compare) and len(node.ops) == 1 and type(node.ops[0]) in self.COMPARISON_OPERATORS:
+            left, right = self._to_numexpr(node.left), self._to_numexpr(node.comparators[0])
+            return None if left is None or right is None else "(" + left + self.COMPARISON_OPERATORS[type(node.ops[0])][0] + right + ")"
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.Invert)):
+            operand = self._to_numexpr(node.operand)
+            return None if operand is None else "(" + ("-" if isinstance(node.op, ast.USub) else "~") + operand + ")"
+        elif isinstance(node, ast.Call) and len(node.keywords) == 0 and self._function_name(node) in self.NUMEXPR_FUNCTIONS:
+            args = [self._to_numexpr(arg) for arg in node.args]
+            return None if None in args else self._function_name(node) + "(" + ",".join(args) + ")"
+        elif isinstance(node, ast.Name) and node.id in self.bands:
+            return node.id
+        elif isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            name = "_constant" + str(len(self.constants))
+            self.constants[name] = node.value
+            return name
+        return None
+    
+    def _function_name(self, node):
+        """
+        Returns the name of a numpy function called as np.function or function, or None
+        """
+        if isinstance(node.func, ast.Attribute) and isinstance(node.func.value, ast.Name) and node.func.value.id == "np":
+            return node.func.attr
+        elif isinstance(node.func, ast.Name):
+            return node.func.id
+        return None
+    
+    def _evaluate_inplace(self, node, bands, dtype, free_buffers, out = None):
+        """
+        Evaluates a node of the parsed formula with numpy, reusing buffers of the computation type for intermediary results.
+        Returns the result and whether it is a buffer which can be reused. Raises TypeError if an operation is not supported.
+        """
+        if isinstance(node, ast.Name) and node.id in bands:
+            return bands[node.id], False
+        elif isinstance(node, ast.Constant) and type(node.value) in (int, float, bool):
+            return node.value, False
+        elif isinstance(node, ast.BinOp) and type(node.op) in self.BINARY_OPERATORS:
+            operands = [self._evaluate_inplace(node.left, bands, dtype, free_buffers), self._evaluate_inplace(node.right, bands, dtype, free_buffers)]
+            if isinstance(node.op, self.LOGICAL_OPERATORS):
+                if any(not isinstance(value, np.ndarray) or value.dtype != bool for value, owned in operands):
+                    raise TypeError("Logical operations are only supported on boolean arrays")
+                return self._apply(self.BINARY_OPERATORS[type(node.op)][1], operands, np.dtype(bool), None, free_buffers, out)
+            if not any(isinstance(value, np.ndarray) for value, owned in operands):
+                return self.BINARY_OPERATORS[type(node.op)][2](operands[0][0], operands[1][0]), False
+            return self._apply(self.BINARY_OPERATORS[type(node.op)][1], operands, dtype, dtype, free_buffers, out)
+        elif isinstance(node, ast.Compare) and len(node.ops) == 1 and type(node.ops[0]) in self.COMPARISON_OPERATORS:
+            operands = [self._evaluate_inplace(node.left, bands, dtype, free_buffers), self._evaluate_inplace(node.comparators[0], bands, dtype, free_buffers)]
+            return self._apply(self.COMPARISON_OPERATORS[type(node.ops[0])][1], operands, np.dtype(bool), None, free_buffers, out)
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            operands = [self._evaluate_inplace(node.operand, bands, dtype, free_buffers)]
+            return self._apply(np.negative, operands, dtype, dtype, free_buffers, out)
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Invert):
+            operands = [self._evaluate_inplace(node.operand, bands, dtype, free_buffers)]
+            if not isinstance(operands[0][0], np.ndarray) or operands[0][0].dtype != bool:
+                raise TypeError("Inversion is only supported on boolean arrays")
+            return self._apply(np.logical_not, operands, np.dtype(bool), None, free_buffers, out)
+        elif isinstance(node, ast.Call) and len(node.keywords) == 0 and isinstance(getattr(np, str(self._function_name(node)), None), np.ufunc):
+            function = getattr(np, self._function_name(node))
+            if function.nout != 1 or function.nin != len(node.args) or dtype.char*(function.nin + 1) not in [signature.replace("->","") for signature in function.types]:
+                raise TypeError("Function " + function.__name__ + " is not supported in place")
+            operands = [self._evaluate_inplace(arg, bands, dtype, free_buffers) for arg in node.args]
+            return self._apply(function, operands, dtype, dtype, free_buffers, out)
+        raise TypeError("Operation not supported in place")
+    
+    def _apply(self, function, operands, result_dtype, computation_dtype, free_buffers, out):
+        """
+        Applies a numpy function, writing the result in out, in a buffer from one of the operands, or in a free buffer
+        """
+        owned_buffers = [value for value, owned in operands if owned]
+        if out is not None and out.dtype == result_dtype:
+            target = out
+        elif len([buffer for buffer in owned_buffers if buffer.dtype == result_dtype]) > 0:
+            target = next(buffer for buffer in owned_buffers if buffer.dtype == result_dtype)
+        elif len([buffer for buffer in free_buffers if buffer.dtype == result_dtype]) > 0:
+            target = next(buffer for buffer in free_buffers if buffer.dtype == result_dtype)
+            free_buffers.remove(target)
+        else:
+            target = np.empty(np.broadcast_shapes(*[np.shape(value) for value, owned in operands]), dtype = result_dtype)
+        if computation_dtype is None:
+            function(*[value for value, owned in operands], out = target)
+        else:
+            function(*[value for value, owned in operands], out = target, dtype = computation_dtype)
+        free_buffers.extend([buffer for buffer in owned_buffers if buffer is not target])
+        if out is not None and target is not out:
+            np.copyto(out, target, casting = "same_kind")
+            return out, False
+        return target, True
 
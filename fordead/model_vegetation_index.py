@@ -5,8 +5,11 @@ import numpy as np
 import dask.array as da
 import datetime
 from scipy.linalg import lstsq
-from fordead.import_data import import_binary_raster, import_masked_vi
+from fordead.import_data import import_binary_raster, import_masked_vi, import_vegetation_index, prefetch, get_block_windows, get_raster_metadata, is_cube, import_cube
+from rasterio.windows import Window
+from fordead.bitplanes import PackedBitplanes
 import warnings
+from functools import lru_cache
 
 def get_detection_dates(stack_masks,min_last_date_training,nb_min_date=10):
     """
@@ -45,6 +48,40 @@ def get_detection_dates(stack_masks,min_last_date_training,nb_min_date=10):
 def compute_HarmonicTerms(DateAsNumber):
     return np.array([1,np.sin(2*np.pi*DateAsNumber/365.25), np.cos(2*np.pi*DateAsNumber/365.25),np.sin(2*2*np.pi*DateAsNumber/365.25),np.cos(2*2*np.pi*DateAsNumber/365.25)])
 
+@lru_cache(maxsize = None)
+def get_date_as_number(date):
+    """
+    Returns the number of days between 2015-01-01 and a date in the format "YYYY-MM-DD". The result is cached as it is computed for the same dates by every step.
+    """
+    return (datetime.datetime.strptime(date, '%Y-%m-%d')-datetime.datetime.strptime('2015-01-01', '%Y-%m-%d')).days
+
+@lru_cache(maxsize = None)
+def _get_harmonic_row(date):
+    harmonic_row = compute_HarmonicTerms(get_date_as_number(date))
+    harmonic_row.flags.writeable = False
+    return harmonic_row
+
+def get_harmonic_terms(date_list, dtype = None):
+    """
+    Returns the harmonic terms of the model for each date, whose rows are cached by date.
+
+    Parameters
+    ----------
+    date_list : list of str
+        Dates in the format "YYYY-MM-DD"
+    dtype : str or numpy dtype, optional
+        Type of the result. If None, float64 is used. The default is None.
+
+    Returns
+    -------
+    harmonic_terms : numpy array (Time,coeff)
+        Array containing the five harmonic terms of each date
+    """
+    harmonic_terms = np.empty((len(date_list), 5), dtype = np.float64 if dtype is None else dtype)
+    for date_index, date in enumerate(date_list):
+        harmonic_terms[date_index] = _get_harmonic_row(str(date))
+    return harmonic_terms
+
 
 def model_vi(stack_vi, stack_masks, one_dim = False):      
 
@@ -75,12 +112,161 @@ def model_vi(stack_vi, stack_masks, one_dim = False):
         coeff_model['coeff'] = range(1,6) # coordinate values as recorded in .tif bands
         
     else:
-        p, _, _, _ = lstsq(HarmonicTerms[~stack_masks][0], stack_vi.where(~stack_masks,drop=True))
+        valid = ~np.asarray(stack_masks)
+        p, _, _, _ = lstsq(HarmonicTerms[valid], np.asarray(stack_vi)[valid])
         coeff_model = xr.DataArray(p, coords={"coeff" : range(1,6)},dims=["coeff"])
         
     return coeff_model
 
-def censored_lstsq(B, M, A):
+def get_model_windows(dict_paths, date, window_size = 1280):
+    """
+    Splits the area of the vegetation index into windows in which the model is computed, aligned to the internal blocks of the vegetation index rasters, or to the chunks of the cube if it was written with output_format "zarr".
+
+    Parameters
+    ----------
+    dict_paths : dict
+        Dictionnary where key "VegetationIndex" returns a dictionnary where keys are SENTINEL dates and values are paths to the vegetation index
+    date : str
+        Date whose vegetation index gives the area and the blocks
+    window_size : int, optional
+        Approximate size in pixels of the side of the windows. If None, the whole area is a single window. The default is 1280.
+
+    Returns
+    -------
+    list of rasterio.windows.Window
+        Windows covering the area
+    """
+    vegetation_index = import_vegetation_index(dict_paths, date)
+    height, width = vegetation_index.sizes["y"], vegetation_index.sizes["x"]
+    if window_size is None:
+        return [Window(0, 0, width, height)]
+    if is_cube(dict_paths["VegetationIndex"][date]): #Windows are aligned to the chunks of the cube
+        chunks = import_cube(dict_paths["VegetationIndex"][date])["vegetation_index"].encoding["preferred_chunks"]
+        window_height, window_width = [int(np.ceil(window_size / chunks[dim])) * chunks[dim] for dim in ["y", "x"]]
+        return [Window(col, row, min(window_width, width - col), min(window_height, height - row)) for row in range(0, height, window_height) for col in range(0, width, window_width)]
+    return get_block_windows(dict_paths["VegetationIndex"][date], get_raster_metadata(dict_paths["VegetationIndex"][date]), window_size = window_size)
+
+def model_vi_streaming(dict_paths, dates, min_last_date_training, nb_min_date = 10, correction_vi = None, prefetch_depth = 2, dtype = None, active_pixels = None, window_size = 1280, return_condition = False):
+    """
+    Finds the first date used for detection and models periodic vegetation index for each pixel, reading the training dates one at a time.
+    The area is split into windows, and for each window, the valid dates of each pixel are counted and the normal equations of the model are accumulated date by date, then solved once all dates are read, 
+    so memory usage depends neither on the number of dates nor on the size of the area, but on window_size.
+    Results are identical to get_detection_dates followed by model_vi on the stacked data, up to rounding errors.
+
+    Parameters
+    ----------
+    dict_paths : dict
+        Dictionnary where key "VegetationIndex" returns a dictionnary where keys are SENTINEL dates and values are paths to the vegetation index, with the equivalent for masks with key "Masks". If it contains up to date mask bitplanes with key "mask_bitplanes", they are used to import masks.
+    dates : list
+        Chronologically ordered list of the dates which can be used for training, in the format "YYYY-MM-DD"
+    min_last_date_training : str
+        Earliest date at which the training ends and the detection begins
+    nb_min_date : int, optional
+        Minimum number of dates used to train the model. The default is 10.
+    correction_vi : xarray (Time), optional
+        Correction terms added to the vegetation index of each date, as computed by compute_vi_correction. If None, the vegetation index is not corrected. The default is None.
+    prefetch_depth : int, optional
+        Number of dates read in advance by background threads while the current date is used. The default is 2.
+    dtype : str or numpy dtype, optional
+        Floating point type of the coefficients. Sums are accumulated and solved in float64 whatever the type. If None, float64 is used. The default is None.
+    active_pixels : fordead.active_pixels.ActivePixels, optional
+        Active pixels of the area. If given, the model is only computed for those pixels, sums being accumulated on compressed vectors, and other pixels have no model as if they did not have enough valid data. If None, all pixels are used. The default is None.
+    window_size : int, optional
+        Approximate size in pixels of the side of the windows, see get_model_windows. The sums of each window take 160 bytes per pixel. If None, the whole area is a single window. The default is 1280.
+    return_condition : bool, optional
+        If True, the condition number of the normal matrix of the model of each pixel is also returned, as computed by normal_condition_number. The default is False.
+
+    Returns
+    -------
+    coeff_model : array (5,x,y)
+        Array containing the five coefficients of the vegetation index model for each pixel
+    first_detection_date_index : xarray.DataArray (x,y)
+        Array containing the index of the first date used for detection, or 0 if there isn't enough valid data.
+    condition_number : xarray.DataArray (x,y)
+        Condition number of the normal matrix of each pixel, NaN where there is no model. High values indicate coefficients which are poorly constrained by the training dates. Only returned if return_condition is True.
+
+    """
+    min_date_index = sum(date < min_last_date_training for date in dates) - 1
+    if min_date_index == len(dates)-1 :
+        warnings.warn(f"Changing min_last_date_training to {dates[min_date_index-1]} to have enough data for detection. Extend max_last_date_training to avoid that warning.")
+        min_date_index = min_date_index-1
+    
+    DatesNumbers = [get_date_as_number(date) for date in dates]
+    HarmonicTerms = np.array([compute_HarmonicTerms(DateAsNumber) for DateAsNumber in DatesNumbers])
+    products = np.array([HarmonicTerms[:, i] * HarmonicTerms[:, j] for i, j in _packed_pairs(HarmonicTerms.shape[1])]).T
+    
+    mask_bitplanes = PackedBitplanes(dict_paths["mask_bitplanes"]) if "mask_bitplanes" in dict_paths else None
+    if mask_bitplanes is not None and not set(dates).issubset(mask_bitplanes.dates): #Bitplanes are not up to date
+        mask_bitplanes = None
+    
+    template = import_vegetation_index(dict_paths, dates[0]).squeeze("band")
+    coeff = np.full((HarmonicTerms.shape[1],) + template.shape, np.nan, dtype = np.float64 if dtype is None else dtype)
+    first_detection_date_index = np.zeros(template.shape, dtype = np.uint16)
+    condition = np.full(template.shape, np.nan, dtype = coeff.dtype) if return_condition else None
+    if active_pixels is not None:
+        active = np.zeros(template.shape, dtype = bool)
+        active.reshape(-1)[active_pixels.index] = True
+    
+    for window in get_model_windows(dict_paths, dates[0], window_size):
+        rows, cols = window.toslices()
+        #Sums are accumulated for the pixels of the window, or for its active pixels as compressed vectors
+        pixels = active[rows, cols] if active_pixels is not None else slice(None)
+        if active_pixels is not None and not pixels.any():
+            continue
+        
+        def import_date(date):
+            if mask_bitplanes is not None: #The mask file is not read
+                vegetation_index = import_vegetation_index(dict_paths, date, window = window)
+                mask = mask_bitplanes.read([date], rows = rows, cols = cols)[0]
+            else:
+                vegetation_index, mask = import_masked_vi(dict_paths, date, window = window)
+                mask = mask.values[0]
+            return vegetation_index.values[0][pixels], mask[pixels]
+        
+        for date_index, (date, (vegetation_index, mask)) in enumerate(prefetch(import_date, dates, depth = prefetch_depth)):
+            if date_index == 0:
+                nb_valid_dates = np.zeros(mask.shape, dtype = np.uint16)
+                nb_training_dates = np.zeros(mask.shape, dtype = np.uint16)
+                window_first_date_index = np.zeros(mask.shape, dtype = np.uint16)
+                detection = np.zeros(mask.shape, dtype = bool) #True once the first detection date of the pixel is reached
+                gram = np.zeros((products.shape[1],) + mask.shape)
+                rhs = np.zeros((HarmonicTerms.shape[1],) + mask.shape)
+            
+            valid = ~mask
+            nb_valid_dates += valid
+            if date_index > min_date_index:
+                first_date = ~detection & (nb_valid_dates > nb_min_date)
+                window_first_date_index[first_date] = date_index
+                detection |= first_date
+            
+            training = valid & ~detection
+            nb_training_dates += training
+            data = training * vegetation_index
+            if correction_vi is not None:
+                data = training * (vegetation_index + correction_vi.sel(Time = date).data)
+            for term_index in range(products.shape[1]):
+                gram[term_index] += products[date_index, term_index] * training
+            for coeff_index in range(HarmonicTerms.shape[1]):
+                rhs[coeff_index] += HarmonicTerms[date_index, coeff_index] * data
+        
+        window_coeff = np.full(rhs.shape, np.nan)
+        valid_model = nb_training_dates > HarmonicTerms.shape[1]
+        window_coeff[:, valid_model] = solve_normal_equations(gram[:, valid_model], rhs[:, valid_model])
+        coeff[:, rows, cols][:, pixels] = window_coeff
+        first_detection_date_index[rows, cols][pixels] = window_first_date_index
+        if return_condition:
+            window_condition = np.full(valid_model.shape, np.nan)
+            window_condition[valid_model] = normal_condition_number(gram[:, valid_model])
+            condition[rows, cols][pixels] = window_condition
+        del gram, rhs
+    
+    coeff_model = xr.DataArray(coeff, coords = {"coeff" : range(1,6), **template.coords}, dims = ["coeff", "y", "x"]).rio.write_crs(template.rio.crs)
+    first_detection_date_index = xr.DataArray(first_detection_date_index, coords = template.coords, dims = ["y", "x"]).rio.write_crs(template.rio.crs)
+    if return_condition:
+        return coeff_model, first_detection_date_index, xr.DataArray(condition, coords = template.coords, dims = ["y", "x"]).rio.write_crs(template.rio.crs)
+    return coeff_model, first_detection_date_index
+
+def censored_lstsq(B, M, A, time_batch = 8, return_condition = False):
     """Solves least squares problem subject to missing data, compatible with numpy, dask and xarray.
 
     Code inspired from http://alexhwilliams.info/itsneuronalblog/2018/02/26/censored-lstsq
@@ -92,11 +278,17 @@ def censored_lstsq(B, M, A):
         Mask giving the missing data (when False the data is not used in computation).
         It must have the same size/chunks as B.
     A : (N, P) numpy.array
+    time_batch : int, optional
+        Number of dates used at once to compute the normal equations, see normal_equations. The default is 8.
+    return_condition : bool, optional
+        If True, the condition number of the normal matrix of each pixel is also returned, only with numpy arrays. The default is False.
 
 
     Returns
     -------
     X : (P, ...) numpy.ndarray that minimizes norm(M*(AX - B))
+    condition : (...) numpy.ndarray
+        Condition number of the normal matrix of each pixel, NaN where there is not enough data. Only returned if return_condition is True.
 
     Notes
     -----
@@ -107,7 +299,7 @@ def censored_lstsq(B, M, A):
 
     It should be used with xr.map_blocks (only full A is needed, B et M can be processed by blocks).
 
-    It uses a broadcasted solve for speed.
+    It solves the normal equations of all pixels at once with a Cholesky decomposition vectorized over pixels, so memory usage does not depend on the number of dates.
 
         Examples
     --------
@@ -180,43 +372,181 @@ def censored_lstsq(B, M, A):
     out = np.empty((A.shape[1], M.shape[1]), dtype=A.dtype)
     out[:] = np.nan
     valid_index = (M.sum(axis=0) > A.shape[1])
-
-    B = B[:, valid_index]
-    M = M[:, valid_index]
     
-    # else solve via tensor representation
-    rhs = np.dot(A.T, M * B).T[:, :, None]  # n x r x 1 tensor
-    T = np.matmul(A.T[None, :, :], M.T[:, :, None] * A[None, :, :])  # n x r x r tensor
-    out[:, valid_index] = np.squeeze(np.linalg.solve(T, rhs)).T  # transpose to get r x n
+    # else solve the normal equations of valid pixels
+    gram, rhs = normal_equations(B, M, A, time_batch = time_batch)
+    gram, rhs = gram[:, valid_index], rhs[:, valid_index]
+    out[:, valid_index] = solve_normal_equations(gram, rhs)
     out = out.reshape([A.shape[1]] + list(shape[1:]))
-    # del B, M, rhs, T
+    if return_condition:
+        condition = np.full(M.shape[1], np.nan)
+        condition[valid_index] = normal_condition_number(gram)
+        return out, condition.reshape(shape[1:])
     return out
 
-def prediction_vegetation_index(coeff_model,date_list):
+def _packed_pairs(nb_params):
+    """
+    Returns the list of pairs (i, j) with i <= j, in the order in which the unique terms of a symmetric matrix of size nb_params are stored by normal_equations.
+    """
+    return [(i, j) for i in range(nb_params) for j in range(i, nb_params)]
+
+def normal_equations(B, M, A, time_batch = 8):
+    """
+    Computes the normal equations of the least squares problems of each pixel subject to missing data. 
+    As the normal matrix is symmetric, only its P(P+1)/2 unique terms are computed, each as a matrix product of the products of two columns of A with the mask.
+    Dates are processed in batches so memory usage only depends on the number of pixels and time_batch.
+
+    Parameters
+    ----------
+    B : (N, K) numpy.ndarray
+        Data of N dates for K pixels
+    M : (N, K) boolean numpy.ndarray
+        Mask giving the missing data (when False the data is not used in computation).
+    A : (N, P) numpy.array
+        Design matrix
+    time_batch : int, optional
+        Number of dates used at once. The default is 8.
+
+    Returns
+    -------
+    gram : (P(P+1)/2, K) numpy.ndarray
+        Unique terms of the normal matrix A.T M A of each pixel, in the order of the pairs of _packed_pairs
+    rhs : (P, K) numpy.ndarray
+        Right-hand side A.T (M B) of each pixel
+
+    """
+    pairs = _packed_pairs(A.shape[1])
+    products = np.array([A[:, i] * A[:, j] for i, j in pairs]) #Products of two columns of A for each date
+    gram = np.zeros((len(pairs), M.shape[1]), dtype = A.dtype)
+    rhs = np.zeros((A.shape[1], M.shape[1]), dtype = A.dtype)
+    for start in range(0, M.shape[0], time_batch):
+        dates = slice(start, start + time_batch)
+        gram += products[:, dates] @ M[dates].astype(A.dtype)
+        rhs += A[dates].T @ (M[dates] * B[dates])
+    return gram, rhs
+
+def solve_normal_equations(gram, rhs):
+    """
+    Solves the normal equations of each pixel with a Cholesky decomposition, vectorized over pixels. 
+    The solution is NaN for pixels where the normal matrix is not positive definite.
+
+    Parameters
+    ----------
+    gram : (P(P+1)/2, K) numpy.ndarray
+        Unique terms of the normal matrix of each pixel, as returned by normal_equations
+    rhs : (P, K) numpy.ndarray
+        Right-hand side of each pixel
+
+    Returns
+    -------
+    X : (P, K) numpy.ndarray
+        Solution for each pixel
+
     """
-    Predicts the vegetation index from the model coefficients and the date
+    nb_params = rhs.shape[0]
+    index = {pair : pair_index for pair_index, pair in enumerate(_packed_pairs(nb_params))}
+    lower = {} #Terms of the lower triangular matrix L such that L L.T is the normal matrix
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        for j in range(nb_params):
+            lower[j, j] = np.sqrt(gram[index[j, j]] - sum(lower[j, k]**2 for k in range(j)))
+            for i in range(j + 1, nb_params):
+                lower[i, j] = (gram[index[j, i]] - sum(lower[i, k] * lower[j, k] for k in range(j))) / lower[j, j]
+        
+        y = [] #Solution of L y = rhs
+        for i in range(nb_params):
+            y.append((rhs[i] - sum(lower[i, k] * y[k] for k in range(i))) / lower[i, i])
+        x = [None] * nb_params #Solution of L.T x = y
+        for i in reversed(range(nb_params)):
+            x[i] = (y[i] - sum(lower[k, i] * x[k] for k in range(i + 1, nb_params))) / lower[i, i]
+    return np.array(x)
+
+def normal_condition_number(gram):
+    """
+    Computes the condition number of the normal matrix of each pixel, the ratio between its largest and smallest eigenvalues. 
+    The condition number of the least squares problem is its square root. High values indicate coefficients which are poorly constrained by the available dates.
+
+    Parameters
+    ----------
+    gram : (P(P+1)/2, K) numpy.ndarray
+        Unique terms of the normal matrix of each pixel, as returned by normal_equations
+
+    Returns
+    -------
+    condition : (K,) numpy.ndarray
+        Condition number of each pixel, inf if the normal matrix is singular
+
+    """
+    nb_params = int((np.sqrt(8 * gram.shape[0] + 1) - 1) / 2)
+    matrix = np.empty((gram.shape[1], nb_params, nb_params), dtype = gram.dtype)
+    for pair_index, (i, j) in enumerate(_packed_pairs(nb_params)):
+        matrix[:, i, j] = matrix[:, j, i] = gram[pair_index]
+    eigenvalues = np.linalg.eigvalsh(matrix)
+    with np.errstate(divide = "ignore"):
+        return np.abs(eigenvalues[:, -1] / eigenvalues[:, 0])
+
+def contract_harmonic_terms(coeff_model, harmonic_terms, out = None):
+    """
+    Contracts the coefficients of the model with the harmonic terms of several dates. For each date, the terms of the five coefficients are accumulated in place in the output, in the order of the coefficients, so results are identical to a sum over the coefficients
+    and no array with both a coefficient and a date dimension is created.
+
+    Parameters
+    ----------
+    coeff_model : numpy array (coeff,...)
+        Array containing the five coefficients of the model for each pixel
+    harmonic_terms : numpy array (Time,coeff)
+        Harmonic terms of each date, as returned by get_harmonic_terms
+    out : numpy array (...,Time), optional
+        Array in which the prediction is written. If None, a new array is created. The default is None.
+
+    Returns
+    -------
+    out : numpy array (...,Time)
+        Prediction for each pixel and date
+    """
+    dtype = np.result_type(coeff_model.dtype, harmonic_terms.dtype)
+    if out is None:
+        out = np.moveaxis(np.empty((len(harmonic_terms),) + coeff_model.shape[1:], dtype = dtype), 0, -1) #Each date is contiguous in memory
+    term = np.empty(coeff_model.shape[1:], dtype = dtype)
+    for date_index, harmonic_row in enumerate(harmonic_terms):
+        predicted_vi = out[..., date_index]
+        np.multiply(coeff_model[0], harmonic_row[0], out = predicted_vi)
+        for coeff_index in range(1, len(harmonic_row)):
+            np.multiply(coeff_model[coeff_index], harmonic_row[coeff_index], out = term)
+            np.add(predicted_vi, term, out = predicted_vi)
+    return out
+
+def prediction_vegetation_index(coeff_model,date_list, out = None):
+    """
+    Predicts the vegetation index from the model coefficients and the dates.
+    All dates are predicted in a single contraction of the coefficients with the cached harmonic terms of the dates, as described in contract_harmonic_terms.
     
     Parameters
     ----------
     coeff_model : array (5,x,y)
         Array containing the five coefficients of the vegetation index model for each pixel
-    date : str
-        Date in the format "YYYY-MM-DD"
+    date_list : list of str
+        Dates in the format "YYYY-MM-DD"
+    out : numpy array (x,y,Time), optional
+        Array in which the prediction is written, with the type of the prediction. Only used if coeff_model is not a dask array. If None, a new array is created. The default is None.
 
     Returns
     -------
-    predicted_vi : array (x,y)
-        Array containing predicted vegetation index from the model
+    predicted_vi : array (x,y,Time)
+        Array containing predicted vegetation index from the model for each date
 
     """
-        
-    date_as_number_list=[(datetime.datetime.strptime(date, '%Y-%m-%d')-datetime.datetime.strptime('2015-01-01', '%Y-%m-%d')).days for date in date_list]
-    harmonic_terms = np.array([compute_HarmonicTerms(DateAsNumber) for DateAsNumber in date_as_number_list])
-    harmonic_terms = xr.DataArray(harmonic_terms, coords={"Time" : date_list, "coeff" : range(1, 6)},dims=["Time", "coeff"])
+    harmonic_terms = get_harmonic_terms(date_list, dtype = coeff_model.dtype if np.issubdtype(coeff_model.dtype, np.floating) else None) #The prediction has the type of the coefficients
+    coeff_model = coeff_model.transpose("coeff", ...)
     
-    predicted_vi = sum(coeff_model * harmonic_terms)
+    if isinstance(coeff_model.data, da.Array):
+        coeff_data = coeff_model.data.rechunk({0 : -1})
+        predicted_vi = coeff_data.map_blocks(contract_harmonic_terms, harmonic_terms, drop_axis = 0, new_axis = coeff_data.ndim - 1, 
+                                             chunks = coeff_data.chunks[1:] + ((len(harmonic_terms),),), dtype = np.result_type(coeff_data.dtype, harmonic_terms.dtype))
+    else:
+        predicted_vi = contract_harmonic_terms(coeff_model.values, harmonic_terms, out = out)
     
-    return predicted_vi
+    coords = {name : coord for name, coord in coeff_model.coords.items() if "coeff" not in coord.dims}
+    return xr.DataArray(predicted_vi, coords = {**coords, "Time" : list(date_list)}, dims = coeff_model.dims[1:] + ("Time",), attrs = coeff_model.attrs)
 
 def model_vi_correction(stack_vi, stack_masks, dict_paths):
     """
@@ -244,23 +574,98 @@ def model_vi_correction(stack_vi, stack_masks, dict_paths):
 
     """
     
-    forest_mask = import_binary_raster(dict_paths["forest_mask"])
-    median_vi=[]
-    for date in stack_vi.Time.data:
-        vegetation_index, mask = import_masked_vi(dict_paths, date)
-        try:
-            median_vi += [float(vegetation_index.where(forest_mask & ~mask,drop =True).median())]
-        except ValueError:
-            median_vi += [0]
-    median_vi = xr.DataArray(np.array(median_vi), coords=stack_vi.Time.coords)
+    large_scale_model, correction_vi, _ = compute_vi_correction(list(stack_vi.Time.data), dict_paths)
+    stack_vi = stack_vi + correction_vi
+    
+    return stack_vi, large_scale_model, correction_vi
+
+def compute_forest_median(vegetation_index, valid):
+    """
+    Computes the median of the vegetation index of valid pixels. The median is exact, and computed with a selection algorithm (numpy.partition) on the valid values only, rather than by sorting the whole area.
+
+    Parameters
+    ----------
+    vegetation_index : array or xarray DataArray
+        Vegetation index values
+    valid : array or xarray DataArray
+        Binary array of the same shape, containing True for unmasked pixels inside the region of interest.
+
+    Returns
+    -------
+    float
+        Median of the valid vegetation index values, NaN values being ignored. NaN if there are no valid values.
+
+    """
+    values = np.asarray(vegetation_index).reshape(-1)[np.asarray(valid).reshape(-1)]
+    values = values[~np.isnan(values)]
+    return float(np.median(values)) if values.size > 0 else np.nan
+
+def compute_vi_correction(dates, dict_paths, forest_medians = None):
+    """
+    Computes the correction terms of the vegetation index used by model_vi_correction, from the large scale vegetation index median value of each date.
+    The vegetation index is only imported for the dates whose median is not already in forest_medians.
+
+    Parameters
+    ----------
+    dates : list
+        List of dates in the format "YYYY-MM-DD"
+    dict_paths : dict
+        Dictionnary containing vegetation index path for each date, and forest_mask key linking to the path of the pixels of interest.
+    forest_medians : dict, optional
+        Dictionnary containing the median of the vegetation index within the forest mask for dates where it was already computed, as computed by compute_forest_median. The default is None.
+
+    Returns
+    -------
+    large_scale_model : xarray (coeff: 5)
+        Array containing the five coefficients of the large scale median vegetation index model
+    correction_vi : xarray (Time)
+        Array containing the correction terms for each date, to be added to the vegetation index for its correction
+    forest_medians : dict
+        forest_medians completed with the median of the vegetation index within the forest mask of each date of dates, NaN if there are no valid pixels
+
+    """
+    forest_medians = {} if forest_medians is None else dict(forest_medians)
+    missing_dates = [date for date in dates if date not in forest_medians]
+    if len(missing_dates) > 0:
+        forest_mask = import_binary_raster(dict_paths["forest_mask"])
+        for date in missing_dates:
+            vegetation_index, mask = import_masked_vi(dict_paths, date)
+            forest_medians[date] = compute_forest_median(vegetation_index, np.asarray(forest_mask) & ~np.asarray(mask))
+    median_vi = xr.DataArray(np.nan_to_num(np.array([forest_medians[date] for date in dates]), nan = 0), coords={"Time" : dates}, dims=["Time"])
     large_scale_model = model_vi(median_vi, median_vi==0, one_dim = True)
     predicted_median_vi = prediction_vegetation_index(large_scale_model,median_vi.Time.data)
     correction_vi = (predicted_median_vi - median_vi).where(median_vi!=0,0)
-    stack_vi = stack_vi + correction_vi
     
-    return stack_vi, large_scale_model, correction_vi
+    return large_scale_model, correction_vi, forest_medians
 
-def correct_vi_date(vegetation_index, mask, forest_mask, large_scale_model, date, correction_vi):
+def add_date_correction_vi(large_scale_model, date, correction_vi, forest_median):
+    """
+    Adds the correction term of a date to the correction terms, from the median of the vegetation index within the forest mask at this date.
+
+    Parameters
+    ----------
+    large_scale_model : xarray (coeff: 5)
+        Array containing the five coefficients of the large scale median vegetation index model
+    date : str
+        Date in the format "YYYY-MM-DD"
+    correction_vi : xarray (Time)
+        Array containing the correction terms for each date
+    forest_median : float
+        Median of the vegetation index within the forest mask at this date, as computed by compute_forest_median. If NaN, the correction term is 0.
+
+    Returns
+    -------
+    correction_vi : xarray (Time)
+        Array containing the correction terms for each date, with added correction term of the date.
+
+    """
+    if np.isnan(forest_median):
+        date_correction_vi = xr.DataArray(0, coords={"Time" : [date]},dims=["Time"])
+    else:
+        date_correction_vi = prediction_vegetation_index(large_scale_model,[date]) - forest_median
+    return xr.concat((correction_vi,date_correction_vi),dim = 'Time')
+
+def correct_vi_date(vegetation_index, mask, forest_mask, large_scale_model, date, correction_vi, forest_median = None):
     """
     Corrects single date vegetation index using large scale vegetation index median value previously computed.
     The difference between the prediction of the model and the large scale median value is used as a correction term for the vegetation index.
@@ -280,6 +685,8 @@ def correct_vi_date(vegetation_index, mask, forest_mask, large_scale_model, date
         Date in the format "YYYY-MM-DD"
     correction_vi : xarray (Time)
         Array containing the correction terms for each date which were added to the vegetation index for its correction
+    forest_median : float, optional
+        Median of the vegetation index within the forest mask if it was already computed, as computed by compute_forest_median. If None, it is computed from vegetation_index. The default is None.
 
     Returns
     -------
@@ -291,12 +698,8 @@ def correct_vi_date(vegetation_index, mask, forest_mask, large_scale_model, date
     """
     
     if date not in correction_vi.Time:
-        median_vi = vegetation_index.where(forest_mask & ~mask).median(dim=["x","y"])
-        if np.isnan(median_vi):
-            date_correction_vi = xr.DataArray(0, coords={"Time" : [date]},dims=["Time"])
-        else:
-            date_correction_vi = prediction_vegetation_index(large_scale_model,[date]) - median_vi
-        correction_vi = xr.concat((correction_vi,date_correction_vi),dim = 'Time')
+        median_vi = compute_forest_median(vegetation_index, np.asarray(forest_mask) & ~np.asarray(mask)) if forest_median is None else forest_median
+        correction_vi = add_date_correction_vi(large_scale_model, date, correction_vi, median_vi)
 
-    vegetation_index = vegetation_index + correction_vi.sel(Time = date)
+    vegetation_index = (vegetation_index + correction_vi.sel(Time = date)).astype(vegetation_index.dtype)
     return vegetation_index, correction_vi
@@ -15,8 +15,8 @@ import datetime
 import matplotlib.colors as colors
 
 
-from fordead.masking_vi import get_dict_vi
-from fordead.import_data import import_resampled_sen_stack, import_soil_data, import_dieback_data, import_binary_raster, import_stress_data, import_stress_index
+from fordead.masking_vi import get_vi_registry
+from fordead.import_data import import_resampled_sen_stack, import_soil_data, import_dieback_data, import_binary_raster, import_stress_data, import_stress_index, get_stress_index
 
 
 def get_stack_rgb(tile, extent, bands = ["B4","B3","B2"], dates = None):
@@ -98,7 +98,7 @@ def CreateTimelapse(shape,tile,vector_display_path, hover_column_list, max_date,
             soil_data = soil_data.loc[dict(x=slice(extent[0], extent[2]),y = slice(extent[3],extent[1]))]
         if show_confidence_class: 
             stress_data = import_stress_data(tile.paths)
-            stress_index = import_stress_index(tile.paths["stress_index"])
+            stress_index = get_stress_index(tile.paths, stress_data, tile.parameters["stress_index_mode"])
             confidence_index = stress_index.sel(period = (stress_data["nb_periods"]+1).where(stress_data["nb_periods"]<=tile.parameters["max_nb_stress_periods"],tile.parameters["max_nb_stress_periods"]))
             nb_dates = stress_data["nb_dates"].sel(period = (stress_data["nb_periods"]+1).where(stress_data["nb_periods"]<=tile.parameters["max_nb_stress_periods"],tile.parameters["max_nb_stress_periods"]))
             
@@ -110,10 +110,10 @@ def CreateTimelapse(shape,tile,vector_display_path, hover_column_list, max_date,
         dieback_data = import_dieback_data(tile.paths)
         dieback_data = dieback_data.loc[dict(x=slice(extent[0], extent[2]),y = slice(extent[3],extent[1]))]
       
-        forest_mask = import_binary_raster(tile.paths["forest_mask"]).loc[dict(x=slice(extent[0], extent[2]),y = slice(extent[3],extent[1]))]
-        sufficient_coverage_mask = import_binary_raster(tile.paths["sufficient_coverage_mask"]).loc[dict(x=slice(extent[0], extent[2]),y = slice(extent[3],extent[1]))]
+        forest_mask = import_binary_raster(tile.paths["forest_mask"], extent = extent)
+        sufficient_coverage_mask = import_binary_raster(tile.paths["sufficient_coverage_mask"], extent = extent)
         if tile.parameters["stress_index_mode"] is not None:
-            too_many_stress_periods_mask = import_binary_raster(tile.paths["too_many_stress_periods_mask"]).loc[dict(x=slice(extent[0], extent[2]),y = slice(extent[3],extent[1]))]
+            too_many_stress_periods_mask = import_binary_raster(tile.paths["too_many_stress_periods_mask"], extent = extent)
             relevant_area = forest_mask & sufficient_coverage_mask & too_many_stress_periods_mask
         else:
             relevant_area = forest_mask & sufficient_coverage_mask
@@ -447,10 +447,10 @@ def plot_temporal_series(pixel_series, xy_soil_data, xy_dieback_data, xy_first_d
             
         yy.plot.line("b", label='Vegetation index model based on training dates')
         
-        dict_vi = get_dict_vi(path_dict_vi)
-        if dict_vi[vi]["dieback_change_direction"] == "+":
+        dieback_change_direction = get_vi_registry(path_dict_vi)[vi].dieback_change_direction
+        if dieback_change_direction == "+":
             (yy+threshold_anomaly).plot.line("b--", label='Threshold for anomaly detection')
-        elif dict_vi[vi]["dieback_change_direction"] == "-":
+        elif dieback_change_direction == "-":
             (yy-threshold_anomaly).plot.line("b--", label='Threshold for anomaly detection')
         
         
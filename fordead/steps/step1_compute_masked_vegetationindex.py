@@ -9,35 +9,217 @@ import click
 from pathlib import Path
 # import geopandas as gp
 import numpy as np
+import xarray as xr
+import rioxarray
+import dask.array as da
 from tqdm import tqdm
 import warnings
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import tempfile
+from dask.utils import parse_bytes
 #%% ===========================================================================
 #   IMPORT FORDEAD MODULES 
 # =============================================================================
-from fordead.cli.utils import empty_to_none
-from fordead.import_data import TileInfo, get_band_paths, get_cloudiness, import_resampled_sen_stack, import_soil_data, initialize_soil_data, get_raster_metadata
-from fordead.masking_vi import compute_masks, compute_vegetation_index, get_bands_and_formula, get_source_mask, compute_user_mask
-from fordead.writing_data import write_raster, write_tif
+from fordead.cli.utils import empty_to_none, execution_options, pop_execution
+from fordead.execution import with_execution
+from fordead.import_data import TileInfo, get_band_paths, get_cloudiness, import_soil_data, initialize_soil_data, get_raster_metadata, get_block_windows, open_sen_bands, import_resampled_sen_window, import_masked_vi, import_binary_raster, prefetch
+from fordead.masking_vi import get_bands_and_formula, compute_date_masked_vi, update_soil_mask, dilate_clouds, convert_source_mask
+from fordead.model_vegetation_index import compute_forest_median
+from fordead.writing_data import WindowWriter, RasterWriter, CheckpointSchedule, write_cube_date
+from fordead.bitplanes import PackedBitplanes
 
 #%% =============================================================================
 #   FONCTIONS
 # =============================================================================
 
+def _raster_template(raster_meta, dtype, attrs = None):
+    """
+    Returns a lazy DataArray with the coordinates of the area, used to create files written window by window.
+    """
+    #The name of the dask array is removed so it is not written as band description
+    return xr.DataArray(da.zeros(raster_meta["shape"], dtype = dtype), coords = raster_meta["coords"], dims = raster_meta["dims"], attrs = attrs).rename(None)
+
+def _iter_date_windows(band_paths, vi_path, windows, raster_meta, list_bands, vi_formula, interpolation_order, soil_detection, formula_mask, apply_source_mask, sentinel_source, compress_vi, prefetch_depth = 2, dtype = None, forest_mask = None):
+    """
+    Computes vegetation index and mask of a single date window by window and writes the vegetation index.
+    Yields for each window, in the order of windows, the window, its mask and soil detection inputs as numpy arrays, and the vegetation index of the pixels of the forest mask if forest_mask is given (else None).
+    The vegetation index file is complete once all windows were consumed.
+    The bands of the next prefetch_depth windows are read in background threads while the current window is computed.
+    """
+    sen_bands = open_sen_bands(band_paths, list_bands, raster_meta, interpolation_order = interpolation_order)
+    if apply_source_mask:
+        sen_bands.update(open_sen_bands(band_paths, ["Mask"], raster_meta))
+    
+    def import_window(window):
+        stack_bands = import_resampled_sen_window(sen_bands, list_bands, window, raster_meta)
+        source_mask = import_resampled_sen_window(sen_bands, ["Mask"], window, raster_meta).isel(band = 0) if apply_source_mask else None
+        return stack_bands, source_mask
+    
+    vi_writer = None
+    for window, (stack_bands, source_mask) in prefetch(import_window, windows, depth = prefetch_depth):
+        rows, cols = window.toslices()
+        if apply_source_mask: #Masking with source mask if option chosen
+            source_mask = convert_source_mask(source_mask, sentinel_source)
+        
+        vegetation_index, window_mask, window_soil_inputs = compute_date_masked_vi(stack_bands, vi_formula, soil_detection = soil_detection, formula_mask = formula_mask, source_mask = source_mask, dtype = dtype)
+        
+        if vi_writer is None:
+            vi_writer = WindowWriter(_raster_template(raster_meta, vegetation_index.dtype, vegetation_index.attrs), vi_path, compress_vi = compress_vi)
+        vi_writer.write(vegetation_index, window)
+        del stack_bands, source_mask
+        yield window, np.array(window_mask, dtype = bool), window_soil_inputs, np.asarray(vegetation_index)[forest_mask[rows, cols]] if forest_mask is not None else None
+    vi_writer.close()
+
+def _compute_and_write_date(*args, **kwargs):
+    """
+    Computes and writes a date in a worker process, and returns the results of _iter_date_windows for all windows.
+    Binary arrays are packed with 8 pixels per byte, so the results of dates computed in advance hold little memory until they are consumed.
+    """
+    return [(window, np.packbits(window_mask, axis = -1), None if window_soil_inputs is None else np.packbits(window_soil_inputs, axis = -1), forest_vi)
+            for window, window_mask, window_soil_inputs, forest_vi in _iter_date_windows(*args, **kwargs)]
+
+def _unpack_date_windows(packed_windows):
+    """
+    Unpacks the results of _compute_and_write_date one window at a time.
+    """
+    for window, window_mask, window_soil_inputs, forest_vi in packed_windows:
+        yield (window, np.unpackbits(window_mask, axis = -1, count = window.width).view(bool),
+               None if window_soil_inputs is None else np.unpackbits(window_soil_inputs, axis = -1, count = window.width).view(bool),
+               forest_vi)
+
+def _packed_date_size(date_args):
+    """
+    Approximate size in bytes of the results of _compute_and_write_date for a date
+    """
+    nb_arrays = 4 if date_args["soil_detection"] else 1
+    size = sum(nb_arrays * window.height * ((window.width + 7) // 8) for window in date_args["windows"])
+    if date_args["forest_mask"] is not None:
+        size += int(date_args["forest_mask"].sum()) * np.dtype(date_args["dtype"] or np.float64).itemsize
+    return size
+
+def _iter_masked_vi(tile, date_indexes, date_args, n_workers = 1, vi_directory = None, vi_extension = ".nc", memory_limit = None):
+    """
+    Yields (date_index, date_windows) for each date index, in the order of date_indexes, where date_windows yields the results of _iter_date_windows for each window of the date.
+    date_windows must be consumed before the next date is requested.
+    The vegetation index of each date is written in vi_directory (tile.paths["VegetationIndexDir"] if None).
+    If n_workers > 1, dates are computed in a pool of processes. Up to 2*n_workers dates are computed in advance, fewer if their packed results would exceed memory_limit.
+    Processes are spawned rather than forked, as forking a process where GDAL or dask threads are running is unsafe.
+    """
+    vi_directory = tile.paths["VegetationIndexDir"] if vi_directory is None else Path(vi_directory)
+    def submit_args(date_index):
+        date = tile.dates[date_index]
+        return tile.paths["Sentinel"][date], vi_directory / ("VegetationIndex_"+date+vi_extension)
+    
+    if n_workers <= 1:
+        for date_index in date_indexes:
+            yield date_index, _iter_date_windows(*submit_args(date_index), **date_args)
+        return
+    
+    max_pending = 2*n_workers
+    if memory_limit is not None:
+        max_pending = int(min(max_pending, max(1, parse_bytes(memory_limit) // _packed_date_size(date_args))))
+    with ProcessPoolExecutor(max_workers = n_workers, mp_context = multiprocessing.get_context("spawn")) as executor:
+        pending = []
+        remaining = iter(date_indexes)
+        for date_index in remaining:
+            pending.append((date_index, executor.submit(_compute_and_write_date, *submit_args(date_index), **date_args)))
+            if len(pending) >= max_pending:
+                break
+        while len(pending) > 0:
+            date_index, future = pending.pop(0)
+            packed_windows = future.result()
+            del future
+            next_date_index = next(remaining, None)
+            if next_date_index is not None:
+                pending.append((next_date_index, executor.submit(_compute_and_write_date, *submit_args(next_date_index), **date_args)))
+            yield date_index, _unpack_date_windows(packed_windows)
+            del packed_windows
+
+def _update_soil_windows(date_windows, soil_arrays, date_index, forest_vi):
+    """
+    Updates the soil detection with the windows of a date, yielded by _iter_date_windows, and yields (mask, clouds) for each window, clouds being None if soil_arrays is None.
+    Soil detection depends on previous dates, so the dates must be processed in chronological order. The soil arrays and the masks are updated in place through views of the windows.
+    The vegetation index of the pixels of the forest mask of each window is appended to forest_vi.
+    """
+    for window, window_mask, window_soil_inputs, window_forest_vi in date_windows:
+        rows, cols = window.toslices()
+        forest_vi.append(window_forest_vi)
+        clouds = None
+        if soil_arrays is not None:
+            _, clouds = update_soil_mask(window_mask, {var : soil_arrays[var][rows, cols] for var in soil_arrays}, window_soil_inputs, date_index)
+        yield window_mask, clouds
+
+def _dilate_window_clouds(window_results, windows, raster_meta, margin = 3):
+    """
+    Adds dilated clouds to the masks of the windows, given by window_results as (mask, clouds) in the order of windows, and yields (window, mask) in the same order.
+    The clouds of a window are dilated once the clouds of all windows within margin pixels are known, so only the clouds of about one row of windows are held in memory, and the result is identical to the dilation of the whole area.
+    """
+    height, width = raster_meta["shape"]
+    halos = [(slice(max(window.row_off - margin, 0), min(window.row_off + window.height + margin, height)),
+              slice(max(window.col_off - margin, 0), min(window.col_off + window.width + margin, width))) for window in windows]
+    #Windows intersecting the halo of each window
+    neighbours = [[index for index, window in enumerate(windows) if window.row_off < halo_rows.stop and window.row_off + window.height > halo_rows.start and window.col_off < halo_cols.stop and window.col_off + window.width > halo_cols.start]
+                  for halo_rows, halo_cols in halos]
+    last_use = {}
+    for window_index in range(len(windows)):
+        for index in neighbours[window_index]:
+            last_use[index] = max(last_use.get(index, -1), window_index)
+    
+    masks, clouds = {}, {}
+    next_index = 0
+    for computed_index, (window_mask, window_clouds) in enumerate(window_results):
+        masks[computed_index], clouds[computed_index] = window_mask, window_clouds
+        while next_index < len(windows) and max(neighbours[next_index]) <= computed_index:
+            window_mask = masks.pop(next_index)
+            if window_clouds is not None:
+                (halo_rows, halo_cols), window = halos[next_index], windows[next_index]
+                halo_clouds = np.zeros((halo_rows.stop - halo_rows.start, halo_cols.stop - halo_cols.start), dtype = bool)
+                for index in neighbours[next_index]:
+                    rows = slice(max(windows[index].row_off, halo_rows.start), min(windows[index].row_off + windows[index].height, halo_rows.stop))
+                    cols = slice(max(windows[index].col_off, halo_cols.start), min(windows[index].col_off + windows[index].width, halo_cols.stop))
+                    halo_clouds[rows.start - halo_rows.start : rows.stop - halo_rows.start, cols.start - halo_cols.start : cols.stop - halo_cols.start] = \
+                        clouds[index][rows.start - windows[index].row_off : rows.stop - windows[index].row_off, cols.start - windows[index].col_off : cols.stop - windows[index].col_off]
+                dilate_clouds(halo_clouds)
+                window_mask |= halo_clouds[window.row_off - halo_rows.start : window.row_off + window.height - halo_rows.start, window.col_off - halo_cols.start : window.col_off + window.width - halo_cols.start]
+            for index in [index for index in clouds if last_use[index] <= next_index]:
+                del clouds[index]
+            yield windows[next_index], window_mask
+            next_index += 1
+
 @click.command(name='masked_vi')
 @click.option("-i", "--input_directory", type = str, help = "Path of the directory with Sentinel dates")
 @click.option("-o", "--data_directory", type = str, help = "Path of the output directory")
 @click.option("-s", "--start_date", type = str,default = "2015-01-01", help = "First date of processing, dates before this date will be ignored.", show_default=True)
 @click.option("-n", "--lim_perc_cloud", type = float,default = 0.4, help = "Maximum cloudiness at the tile scale, used to filter used SENTINEL dates. Set parameter as -1 to not filter based on cloudiness", show_default=True)
+@click.option("--cloudiness_decimation", type = int,default = 4, help = "Decimation factor of the reads used to compute cloudiness, set to 1 to compute cloudiness exactly from full resolution rasters. Cloudiness is stored in an index in the input directory, so it is only computed for new or modified dates.", show_default=True)
 @click.option("--interpolation_order", type = int,default = 0, help ="interpolation order for bands at 20m resolution : 0 = nearest neighbour, 1 = linear, 2 = bilinéaire, 3 = cubique", show_default=True)
 @click.option("--sentinel_source", type = str,default = "theia", help = "Source of data, can be 'theia' et 'scihub' et 'peps'", show_default=True)
 @click.option("--apply_source_mask",  is_flag=True, help = "If True, applies the mask from SENTINEL-data supplier", show_default=True)
 @click.option("--soil_detection",  is_flag=True, help = "If True, bare ground is detected and used as mask, but the process has not been tested on other data than THEIA data in France (see https://fordead.gitlab.io/fordead_package/docs/user_guides/english/01_compute_masked_vegetationindex/). If False, mask from formula_mask is applied.", show_default=True)
 @click.option("--formula_mask", type = str,default = "(B2 >= 700)", help = "formula whose result would be binary, as described here https://fordead.gitlab.io/fordead_package/reference/fordead/masking_vi/#compute_vegetation_index. Is only used if soil_detection is False.", show_default=True)
 @click.option("--vi", type = str,default = "CRSWIR", help = "Chosen vegetation index", show_default=True)
+@click.option("--dtype", type = click.Choice(["float32", "float64"]),default = "float32", help = "Floating point type of the vegetation index, of the model and of the computations of the following steps. float64 doubles memory usage and the size of the files, but can be used to reproduce results of previous versions.", show_default=True)
 @click.option("--compress_vi",  is_flag=True, help = "Stores the vegetation index as low-resolution floating-point data as small integers in a netCDF file. Uses less disk space but can lead to very small difference in results as the vegetation is rounded to three decimal places", show_default=True)
 @click.option("--ignored_period", multiple=True, type = str, default = None, help = "Period whose Sentinel dates to ignore (format 'MM-DD', ex : --ignored_period 11-01 --ignored_period 05-01", show_default=True)
 @click.option("--extent_shape_path", type = str,default = None, help = "Path of shapefile used as extent of detection, if None, the whole tile is used", show_default=True)
 @click.option("--path_dict_vi", type = str,default = None, help = "Path of text file to add vegetation index formula, if None, only built-in vegetation indices can be used (CRSWIR, NDVI)", show_default=True)
+@click.option("--n_workers", type = int,default = 1, help = "Number of processes used to compute several dates in parallel. Soil detection is still updated date by date, so results are identical to sequential processing.", show_default=True)
+@click.option("--window_size", type = int,default = 1024, help = "Approximate size in pixels of the windows in which each date is processed, rounded up to a multiple of the block size of SENTINEL data. Memory usage depends on this size rather than on the size of the tile.", show_default=True)
+@click.option("--prefetch_depth", type = int,default = 2, help = "Number of windows whose SENTINEL bands are read in advance by background threads while the current window is computed, so reading and computing overlap. Set to 0 to read each window when it is computed.", show_default=True)
+@click.option("--output_format", type = click.Choice(["files", "zarr"]),default = "files", help = "Storage of vegetation index and masks. 'files' writes a vegetation index file and a mask file for each date, 'zarr' appends each date to a single time-stacked cube (requires zarr), which is much faster to read as time series.", show_default=True)
+@click.option("--cube_chunks", type = int,default = 512, help = "Size of the chunks of the cube along x and y, if output_format is 'zarr'. Only used when the cube is created.", show_default=True)
+@click.option("--cube_time_chunks", type = int,default = 16, help = "Number of dates in each chunk of the cube, if output_format is 'zarr'. Only used when the cube is created.", show_default=True)
+@click.option("--pack_masks",  is_flag=True, help = "If True, masks are also stored as packed bitplanes (8 dates per byte) which can be memory-mapped, and are used to import masks in the following steps.", show_default=True)
+@click.option("--codec", type = click.Choice(["DEFLATE", "ZSTD", "LZW", "LERC"]),default = None, help = "Compression codec of the GeoTIFF files written by this step and the following steps. If None, files are not compressed.", show_default=True)
+@click.option("--predictor", type = click.Choice(["1", "2", "3"]),default = None, help = "Predictor used with the codec (1 : none, 2 : horizontal differencing, 3 : floating point). If None, it is chosen from the data type of each file.", show_default=True)
+@click.option("--blocksize", type = int,default = None, help = "Size of the internal tiles of the GeoTIFF files. If None, the GDAL default is used.", show_default=True)
+@click.option("--overviews",  is_flag=True, help = "If True, GeoTIFF files are written as Cloud-Optimized GeoTIFF with internal overviews.", show_default=True)
+@click.option("--quantize",  is_flag=True, help = "If True, the stress index and confidence index are stored as small integers with a 0.001 scale factor.", show_default=True)
+@click.option("--forest_median",  is_flag=True, help = "If True and the forest mask was already computed by the step compute_forest_mask, the median of the vegetation index within the forest mask is computed for each new date and stored, so the correction of the vegetation index (correct_vi option) does not read the vegetation index again. Not used with compress_vi.", show_default=True)
+@click.option("--checkpoint_dates", type = int,default = None, help = "Number of computed dates between two checkpoints of the soil detection state and of the last computed date, from which an interrupted computation is resumed. If None, checkpoints are only saved depending on checkpoint_minutes.", show_default=True)
+@click.option("--checkpoint_minutes", type = float,default = 30, help = "Number of minutes between two checkpoints. If 0, checkpoints are only saved depending on checkpoint_dates.", show_default=True)
+@execution_options
 def cli_compute_masked_vegetationindex(**kwargs):
     """
     Computes masks and masked vegetation index for each SENTINEL date under a cloudiness threshold.
@@ -50,14 +232,18 @@ def cli_compute_masked_vegetationindex(**kwargs):
 
     """
     empty_to_none(kwargs, "ignored_period")
+    pop_execution(kwargs)
+    if kwargs["predictor"] is not None: kwargs["predictor"] = int(kwargs["predictor"])
     compute_masked_vegetationindex(**kwargs)
 
 
+@with_execution
 def compute_masked_vegetationindex(
     input_directory,
     data_directory,
     start_date = "2015-01-01",
     lim_perc_cloud=0.4,
+    cloudiness_decimation = 4,
     interpolation_order = 0,
     sentinel_source = "theia",
     apply_source_mask = False,
@@ -65,9 +251,26 @@ def compute_masked_vegetationindex(
     formula_mask = "(B2 >= 700)",
     vi = "CRSWIR",
     compress_vi = False,
+    dtype = "float32",
     ignored_period = None,
     extent_shape_path=None,
     path_dict_vi = None,
+    n_workers = 1,
+    window_size = 1024,
+    prefetch_depth = 2,
+    output_format = "files",
+    cube_chunks = 512,
+    cube_time_chunks = 16,
+    pack_masks = False,
+    codec = None,
+    predictor = None,
+    blocksize = None,
+    overviews = False,
+    quantize = False,
+    forest_median = False,
+    checkpoint_dates = None,
+    checkpoint_minutes = 30,
+    execution = None,
     progress=True
     ):
     """
@@ -86,6 +289,9 @@ def compute_masked_vegetationindex(
         First date to process, dates before this date will be ignored. Format : 'YYYY-MM-DD'
     lim_perc_cloud : float
         Maximum cloudiness at the tile scale, used to filter used SENTINEL dates. Set parameter as -1 to not filter based on cloudiness
+    cloudiness_decimation : int, optional
+        Decimation factor of the reads used to compute cloudiness, rasters are read with their size divided by this factor, using overviews if they exist. Set to 1 to compute cloudiness exactly from full resolution rasters.
+        Cloudiness is stored in the index "cloudiness.sqlite" in the input directory, so it is only computed for new or modified dates, and previously computed values are kept. Defaults to 4.
     interpolation_order : int
         interpolation order for bands at 20m resolution : 0 = nearest neighbour, 1 = linear, 2 = bilinéaire, 3 = cubique
     sentinel_source : str
@@ -100,12 +306,54 @@ def compute_masked_vegetationindex(
         Chosen vegetation index
     compress_vi : bool
         If True, stores the vegetation index as low-resolution floating-point data as small integers in a netCDF file. Uses less disk space but can lead to very small difference in results as the vegetation index is rounded to three decimal places
+    dtype : str, optional
+        Floating point type, "float32" or "float64", of the vegetation index, of the model coefficients and of the computations of the following steps (predictions, differences with predictions, stress index). 
+        "float64" doubles memory usage and the size of the files, but can be used to reproduce results of previous versions. Differences are measured by the test test_dtype_accuracy. Defaults to "float32".
     ignored_period : list of two strings
         Period whose Sentinel dates to ignore (format 'MM-DD', ex : ["11-01","05-01"])
     extent_shape_path : str
         Path of shapefile used as extent of detection, if None, the whole tile is used
     path_dict_vi : str
         Path of text file to add vegetation index formula, if None, only built-in vegetation indices can be used (CRSWIR, NDVI)
+    n_workers : int, optional
+        Number of processes used to compute several dates in parallel. Soil detection is still updated date by date, so results are identical to sequential processing. Defaults to 1.
+        As processes are spawned, scripts using n_workers > 1 must be protected by an `if __name__ == '__main__':` block. Up to 2*n_workers dates are computed in advance, fewer if the memory_limit of the execution configuration is exceeded.
+    window_size : int, optional
+        Approximate size in pixels of the windows in which each date is processed, rounded up to a multiple of the block size of SENTINEL data. Memory usage depends on this size rather than on the size of the tile, unless interpolation_order is not 0 : 20m bands are then interpolated over the whole tile for each date, as the interpolation depends on the size of the interpolated area. Defaults to 1024.
+    prefetch_depth : int, optional
+        Number of windows whose SENTINEL bands are read in advance by background threads while the current window is computed, so reading and computing overlap. Each prefetched window holds the bands of window_size pixels in memory. Set to 0 to read each window when it is computed. Defaults to 2.
+    output_format : str, optional
+        Storage of vegetation index and masks. If "files", a vegetation index file and a mask file are written for each date in the directories "VegetationIndex" and "Mask". 
+        If "zarr", each date is appended to a single time-stacked cube "MaskedVegetationIndex.zarr" with variables "vegetation_index" and "mask" (requires zarr), so following steps read a few chunks instead of opening a file per date. Defaults to "files".
+    cube_chunks : int, optional
+        Size of the chunks of the cube along x and y, if output_format is "zarr". Only used when the cube is created. Defaults to 512.
+    cube_time_chunks : int, optional
+        Number of dates in each chunk of the cube, if output_format is "zarr". Only used when the cube is created. Defaults to 16.
+    pack_masks : bool, optional
+        If True, masks are also stored in the "MaskBitplanes" directory as packed bitplanes, with 8 dates per byte, which can be memory-mapped. They are then used to import masks in the following steps, which reduces reads and memory usage about 8 times. 
+        If masks were computed for previous dates without this option, they are added to the bitplanes. Defaults to False.
+    codec : str, optional
+        Compression codec of the GeoTIFF files written by this step and the following steps, can be "DEFLATE", "ZSTD", "LZW" or "LERC". If None, files are not compressed. 
+        The vegetation index is still written in netCDF files, compress_vi can be used to reduce their size. Defaults to None.
+    predictor : int, optional
+        Predictor used with the codec, 1 for no predictor, 2 for horizontal differencing, 3 for floating point. If None, 3 is used for floating point data, 2 for integer data and 1 with LERC. Defaults to None.
+    blocksize : int, optional
+        Size of the internal tiles of the GeoTIFF files, must be a multiple of 16. If None, the GDAL default is used. Defaults to None.
+    overviews : bool, optional
+        If True, GeoTIFF files are written as Cloud-Optimized GeoTIFF with internal overviews, which can be displayed and read at low resolution quickly. Defaults to False.
+    quantize : bool, optional
+        If True, the stress index and confidence index are stored as small integers with a 0.001 scale factor, and decoded when they are imported. Defaults to False.
+    forest_median : bool, optional
+        If True and the forest mask was already computed by the step compute_forest_mask, the median of the vegetation index of unmasked pixels within the forest mask is computed for each new date, from the vegetation index computed in memory. 
+        Medians are stored in the TileInfo object, and are used by the correction of the vegetation index (correct_vi option of the steps train_model and dieback_detection) instead of reading the vegetation index of each date again. 
+        Medians missing when the vegetation index is corrected are computed and stored by the step train_model. Not used with compress_vi, as medians are then computed from the stored rounded values. Defaults to False.
+    checkpoint_dates : int, optional
+        Number of computed dates between two checkpoints. At each checkpoint, the soil detection state and the list of computed dates are saved in the "Checkpoints" directory once the masks of these dates are written. 
+        If the computation is interrupted, it is resumed from the last checkpoint when this step is run again with the same parameters. If None, checkpoints are only saved depending on checkpoint_minutes. Defaults to None.
+    checkpoint_minutes : float, optional
+        Number of minutes between two checkpoints. If 0, checkpoints are only saved depending on checkpoint_dates. Defaults to 30.
+    execution : ExecutionConfig or dict, optional
+        Execution configuration of dask computations (scheduler, workers, chunks, memory budget), as described in fordead.execution.ExecutionConfig. If None, the default threaded scheduler is used. Dates are computed by the processes of n_workers, the configuration is used by the dask computations such as the writing of the cube. Defaults to None.
     progress : bool, optional
         Whether to show a progress bar. Defaults to True.
     """
@@ -127,16 +375,34 @@ def compute_masked_vegetationindex(
         "soil_detection" : soil_detection,
         "formula_mask" : formula_mask,
         "ignored_period" : ignored_period,
-        "compress_vi" : compress_vi
+        "compress_vi" : compress_vi,
+        "dtype" : dtype,
+        "output_format" : output_format
         })
+    
+    # Output profile of GeoTIFF files, also used by the following steps. It does not change results so previous results are kept if it changes.
+    tile.output_profile = None if codec is None and blocksize is None and not(overviews) and not(quantize) else {
+        "codec" : codec, "predictor" : predictor, "blocksize" : blocksize, "overviews" : overviews, "quantize" : quantize}
+  
+    # Checkpoint of an interrupted computation with the same parameters
+    tile.add_path("checkpoint_masked_vi", tile.data_directory / "Checkpoints" / "checkpoint_masked_vi.pickle")
+    checkpoint = tile.import_checkpoint("checkpoint_masked_vi")
   
-    # If parameters added differ from previously used parameters, all previous computation results are deleted
+    # If parameters added differ from previously used parameters, all previous computation results are deleted. If a checkpoint was saved with those parameters, they were already deleted by the interrupted computation.
     if tile.parameters["Overwrite"] : 
-        tile.delete_dirs("VegetationIndexDir", "MaskDir", "coeff_model", "AnomaliesDir",
-                         "state_dieback", "state_soil", "periodic_results_dieback",
-                         "result_files","timelapse","series", "nb_periods_stress")
-        tile.delete_files("sufficient_coverage_mask","too_many_stress_periods_mask")
-        tile.delete_attributes("last_computed_anomaly","dates","last_date_export")
+        if checkpoint is None:
+            tile.delete_dirs("VegetationIndexDir", "MaskDir", "mask_bitplanes", "anomaly_bitplanes", "coeff_model", "AnomaliesDir",
+                             "state_dieback", "state_soil", "periodic_results_dieback",
+                             "result_files","timelapse","series", "nb_periods_stress", "threshold_sweep")
+            tile.delete_files("sufficient_coverage_mask","too_many_stress_periods_mask")
+        tile.delete_attributes("last_computed_anomaly","dates","last_date_export","forest_medians")
+    
+    # The computation is resumed from the checkpoint if it contains dates computed after the saved dates
+    previous_dates = list(tile.dates) if hasattr(tile, "dates") else []
+    if checkpoint is not None and len(checkpoint["dates"]) > len(previous_dates) and list(checkpoint["dates"][:len(previous_dates)]) == previous_dates:
+        tile.dates = checkpoint["dates"]
+    else:
+        checkpoint = None
 
     # All SENTINEL data in the input directory is detected, and paths are added to the TileInfo object. For example, after this operation tile.paths["Sentinel"]["YYYY-MM-DD"]["B2"] brings up the path to the B2 band file of the specified date?
     # check if upgrade is needed
@@ -154,15 +420,21 @@ def compute_masked_vegetationindex(
     tile.paths["Sentinel"] = get_band_paths(tile.paths["Sentinel"]) #Replaces the paths to the directories for each date with a dictionnary where keys are the bands, and values are their paths
     
     #Adding directories for ouput. Directories are created and their paths added to the TileInfo object.
-    tile.add_dirpath("VegetationIndexDir", tile.data_directory / "VegetationIndex")
-    tile.add_dirpath("MaskDir", tile.data_directory / "Mask")
+    if output_format == "zarr":
+        tile.add_path("VegetationIndexDir", tile.data_directory / "MaskedVegetationIndex.zarr")
+        tile.add_path("MaskDir", tile.data_directory / "MaskedVegetationIndex.zarr")
+    else:
+        tile.add_dirpath("VegetationIndexDir", tile.data_directory / "VegetationIndex")
+        tile.add_dirpath("MaskDir", tile.data_directory / "Mask")
     if soil_detection:
         tile.add_path("state_soil", tile.data_directory / "DataSoil" / "state_soil.tif")
         tile.add_path("first_date_soil", tile.data_directory / "DataSoil" / "first_date_soil.tif")
         tile.add_path("count_soil", tile.data_directory / "DataSoil" / "count_soil.tif")
+    if pack_masks:
+        tile.add_dirpath("mask_bitplanes", tile.data_directory / "MaskBitplanes")
         
     #Computing cloudiness percentage for each date
-    cloudiness = get_cloudiness(Path(input_directory) / "cloudiness", tile.paths["Sentinel"], sentinel_source) if lim_perc_cloud != -1 else dict(zip(tile.paths["Sentinel"], [-1]*len(tile.paths["Sentinel"]))) #Returns dictionnary with cloud percentage for each date, except if lim_perc_cloud is set as 1, in which case cloud percentage is -1 for every date so source mask is not used and every date is used 
+    cloudiness = get_cloudiness(Path(input_directory) / "cloudiness", tile.paths["Sentinel"], sentinel_source, decimation = cloudiness_decimation, n_workers = n_workers) if lim_perc_cloud != -1 else dict(zip(tile.paths["Sentinel"], [-1]*len(tile.paths["Sentinel"]))) #Returns dictionnary with cloud percentage for each date, except if lim_perc_cloud is set as 1, in which case cloud percentage is -1 for every date so source mask is not used and every date is used 
     new_dates = np.array([date for date in tile.paths["Sentinel"] if cloudiness[date] <= lim_perc_cloud and date>=start_date and ((ignored_period is None or len(ignored_period) == 0) or (date[5:] > min(ignored_period) and date[5:] < max(ignored_period))) and (not(hasattr(tile, "dates")) or date > tile.dates[-1])]) #Creates array containing only the dates with cloudiness inferior to lim_perc_cloud parameter. Also filters out dates anterior to already used dates.
     tile.dates = np.concatenate((tile.dates, new_dates)) if hasattr(tile, "dates") else new_dates #Adds list of all used dates (already used + new dates) as attribute to TileInfo object
     tile.raster_meta = get_raster_metadata(list(tile.paths["Sentinel"].values())[-1][next(x for x in list(tile.paths["Sentinel"].values())[0] if x in ["B2","B3","B4","B8"])], #path of first 10m resolution band found
@@ -173,55 +445,93 @@ def compute_masked_vegetationindex(
     else:
         print("Computing masks and vegetation index : " + str(len(new_dates))+ " new dates")
         
-        tile.raster_meta = get_raster_metadata(list(tile.paths["Sentinel"].values())[-1][next(x for x in list(tile.paths["Sentinel"].values())[1] if x in ["B2","B3","B4","B8"])], #path of first 10m resolution band found
+        tile.raster_meta = get_raster_metadata(list(tile.paths["Sentinel"].values())[-1][next(x for x in list(tile.paths["Sentinel"].values())[0] if x in ["B2","B3","B4","B8"])], #path of first 10m resolution band found
                                                extent_shape_path = extent_shape_path)  #Imports all raster metadata from one band. 
         
         #Import or initialize data for the soil mask
         if soil_detection:
-            if tile.paths["state_soil"].exists():
-                soil_data = import_soil_data(tile.paths)
+            if checkpoint is not None:
+                soil_data = checkpoint["soil_data"]
+            elif tile.paths["state_soil"].exists():
+                soil_data = import_soil_data(tile.paths).load()
             else:
                 soil_data = initialize_soil_data(tile.raster_meta["shape"],tile.raster_meta["coords"])
+            soil_arrays = {var : soil_data[var].values for var in ["count", "state", "first_date"]} #Updated in place
+
+        #Import the forest mask to compute the median of the vegetation index within the forest mask
+        forest_mask = None
+        forest_medians = checkpoint.get("forest_medians", {}) if checkpoint is not None else dict(getattr(tile, "forest_medians", {}))
+        if forest_median and not(compress_vi):
+            if "forest_mask" in tile.paths and tile.paths["forest_mask"].exists():
+                forest_mask = import_binary_raster(tile.paths["forest_mask"]).values
+            if forest_mask is None or forest_mask.shape != tuple(tile.raster_meta["shape"]):
+                print("Forest mask not computed with the same extent, medians of the vegetation index will be computed by the step train_model")
+                forest_mask = None
 
         tile.used_bands, tile.vi_formula = get_bands_and_formula(vi, path_dict_vi = path_dict_vi, forced_bands = ["B2","B3","B4", "B8A","B11"] if soil_detection else get_bands_and_formula(formula = formula_mask)[0]) #Selects only relevant bands depending on used vegetation index plus forced_bands used in masks
         
-        for date_index, date in tqdm(enumerate(tile.dates), total=len(tile.dates), disable=not progress):
-            if date in new_dates:
-                
-                # Resample and import SENTINEL data
-                stack_bands = import_resampled_sen_stack(tile.paths["Sentinel"][date], tile.used_bands, interpolation_order = interpolation_order, extent = tile.raster_meta["extent"])
-                
-                # Compute vegetation index
-                vegetation_index = compute_vegetation_index(stack_bands, formula = tile.vi_formula)
-                invalid_values = vegetation_index.isnull() | np.isinf(vegetation_index)
-                vegetation_index = vegetation_index.where(~invalid_values,0)
-
-                # Compute mask
-                if soil_detection:
-                    mask = compute_masks(stack_bands, soil_data, date_index)
-                else:
-                    mask = compute_user_mask(stack_bands, formula_mask)
-                mask = mask | invalid_values
-                if apply_source_mask:
-                    mask = mask | get_source_mask(tile.paths["Sentinel"][date], sentinel_source, extent = tile.raster_meta["extent"]) #Masking with source mask if option chosen
-                
-                #Writing vegetation index and mask
-                # write_tif(vegetation_index, tile.raster_meta["attrs"],tile.paths["VegetationIndexDir"] / ("VegetationIndex_"+date+".nc"),nodata=0)
-                write_tif(mask, tile.raster_meta["attrs"], tile.paths["MaskDir"] / ("Mask_"+date+".tif"),nodata=0)
-                write_raster(vegetation_index, tile.paths["VegetationIndexDir"] / ("VegetationIndex_"+date+".nc"), compress_vi)
-                # write_raster(mask, tile.paths["MaskDir"] / ("Mask_"+date+".nc"))
-
-                del vegetation_index, mask
-                # print('\r', date, " | ", len(tile.dates)-date_index-1, " remaining       ", sep='', end='', flush=True) if date_index != (len(tile.dates) -1) else print('\r', '                                              ', '\r', sep='', end='', flush=True)
+        windows = get_block_windows(list(tile.paths["Sentinel"].values())[-1][next(x for x in list(tile.paths["Sentinel"].values())[0] if x in ["B2","B3","B4","B8"])], tile.raster_meta, window_size = window_size) #Windows aligned to the blocks of the band used for metadata
+        date_args = dict(windows = windows, raster_meta = tile.raster_meta, list_bands = tile.used_bands, vi_formula = tile.vi_formula, interpolation_order = interpolation_order,
+                         soil_detection = soil_detection, formula_mask = formula_mask, apply_source_mask = apply_source_mask, sentinel_source = sentinel_source, compress_vi = compress_vi and output_format == "files", prefetch_depth = prefetch_depth, dtype = dtype, forest_mask = forest_mask)
+        new_date_indexes = [date_index for date_index, date in enumerate(tile.dates) if date in new_dates]
+        
+        if pack_masks:
+            mask_bitplanes = PackedBitplanes(tile.paths["mask_bitplanes"])
+            for date in tile.dates: #Adding masks of previously computed dates
+                if date not in new_dates and date not in mask_bitplanes.dates:
+                    mask_bitplanes.append(date, import_masked_vi(tile.paths, date)[1])
+        
+        # With a cube, the vegetation index and the mask of each date are written in temporary files before being appended to the cube in chronological order
+        temporary_directory = tempfile.TemporaryDirectory(dir = tile.data_directory) if output_format == "zarr" else None
+        vi_directory = temporary_directory.name if output_format == "zarr" else None
+        
+        writer = RasterWriter() #Soil data is written in a background thread
+        checkpoints = CheckpointSchedule(checkpoint_dates, checkpoint_minutes)
+        for date_index, date_windows in tqdm(_iter_masked_vi(tile, new_date_indexes, date_args, n_workers, vi_directory = vi_directory, vi_extension = ".tif" if output_format == "zarr" else ".nc", memory_limit = execution.memory_limit), total=len(new_date_indexes), disable=not progress):
+            date = tile.dates[date_index]
+            forest_vi = []
+            # With a cube, the mask is written in a temporary file, appended to the cube with the vegetation index
+            mask_path = Path(vi_directory) / ("Mask_"+date+".tif") if output_format == "zarr" else tile.paths["MaskDir"] / ("Mask_"+date+".tif")
+            mask_writer = WindowWriter(_raster_template(tile.raster_meta, bool), mask_path, attributes = tile.raster_meta["attrs"], nodata = 0, profile = None if output_format == "zarr" else tile.output_profile)
+            forest_masked = []
+            for window, window_mask in _dilate_window_clouds(_update_soil_windows(date_windows, soil_arrays if soil_detection else None, date_index, forest_vi), windows, tile.raster_meta):
+                rows, cols = window.toslices()
+                mask_writer.write(xr.DataArray(window_mask, dims = ["y","x"]), window)
+                if pack_masks:
+                    mask_bitplanes.append(date, window_mask, rows, cols, shape = tile.raster_meta["shape"])
+                if forest_mask is not None:
+                    forest_masked.append(window_mask[forest_mask[rows, cols]])
+                del window_mask
+            mask_writer.close()
+            
+            if forest_mask is not None:
+                forest_medians[date] = compute_forest_median(np.concatenate(forest_vi), ~np.concatenate(forest_masked))
+            
+            if output_format == "zarr":
+                vi_path = Path(vi_directory) / ("VegetationIndex_"+date+".tif")
+                with rioxarray.open_rasterio(vi_path, chunks = cube_chunks) as vegetation_index, rioxarray.open_rasterio(mask_path, chunks = cube_chunks) as mask:
+                    write_cube_date(tile.paths["VegetationIndexDir"], date, vegetation_index, mask, chunks = cube_chunks, time_chunks = cube_time_chunks, compress_vi = compress_vi)
+                vi_path.unlink()
+                mask_path.unlink()
+            del date_windows, forest_vi, forest_masked
+            
+            if checkpoints.due() and date_index != new_date_indexes[-1]:
+                tile.save_checkpoint("checkpoint_masked_vi", {"dates" : tile.dates[:date_index+1], "soil_data" : soil_data if soil_detection else None, "forest_medians" : forest_medians})
+        
+        if temporary_directory is not None:
+            temporary_directory.cleanup()
             
         if soil_detection:
             #Writing soil data 
-            write_tif(soil_data["state"], tile.raster_meta["attrs"],tile.paths["state_soil"],nodata=0)
-            write_tif(soil_data["first_date"], tile.raster_meta["attrs"],tile.paths["first_date_soil"],nodata=0)
-            write_tif(soil_data["count"], tile.raster_meta["attrs"],tile.paths["count_soil"],nodata=0)
+            writer.write_tif(soil_data["state"], tile.raster_meta["attrs"],tile.paths["state_soil"],nodata=0, profile = tile.output_profile)
+            writer.write_tif(soil_data["first_date"], tile.raster_meta["attrs"],tile.paths["first_date_soil"],nodata=0, profile = tile.output_profile)
+            writer.write_tif(soil_data["count"], tile.raster_meta["attrs"],tile.paths["count_soil"],nodata=0, profile = tile.output_profile)
             # write_raster(soil_data["state"],tile.paths["state_soil"])
             # write_raster(soil_data["first_date"],tile.paths["first_date_soil"])
             # write_raster(soil_data["count"],tile.paths["count_soil"])
+        writer.close() #All files are written before the TileInfo object is saved
+        if len(forest_medians) > 0:
+            tile.forest_medians = forest_medians
 
     #Add paths to vi and mask to TileInfo object
     tile.getdict_paths(path_vi = tile.paths["VegetationIndexDir"],
@@ -229,6 +539,7 @@ def compute_masked_vegetationindex(
     
     #Saving TileInfo object
     tile.save_info()
+    tile.delete_files("checkpoint_masked_vi")
     
 if __name__ == '__main__':
     # start_time_debut = time.time()
@@ -5,9 +5,12 @@
 # =============================================================================
 
 import click
-from fordead.import_data import import_stackedmaskedVI, TileInfo, get_raster_metadata
-from fordead.model_vegetation_index import get_detection_dates, model_vi, model_vi_correction
+from fordead.cli.utils import execution_options, pop_execution
+from fordead.execution import with_execution
+from fordead.import_data import TileInfo, get_raster_metadata
+from fordead.model_vegetation_index import model_vi_streaming, compute_vi_correction
 from fordead.writing_data import write_tif
+from fordead.active_pixels import ActivePixels, import_active_mask
 
 
 @click.command(name='train_model')
@@ -18,6 +21,10 @@ from fordead.writing_data import write_tif
 @click.option("--correct_vi",  is_flag=True, help = "If True, corrects vi using large scale median vi", show_default=True)
 @click.option("--path_vi", type = str,default = None, help = "Path of directory containing vegetation indices for each date. If None, the information has to be saved from a previous step", show_default=True)
 @click.option("--path_masks", type = str,default = None, help = "Path of directory containing masks for each date.  If None, the information has to be saved from a previous step", show_default=True)
+@click.option("--prefetch_depth", type = int,default = 2, help = "Number of dates read in advance by background threads while the current date is used for training. Set to 0 to read each date when it is used.", show_default=True)
+@click.option("--active_pixels",  is_flag=True, help = "If True and the forest mask was computed, the model is only computed for pixels inside the forest mask, on compressed vectors of those pixels. Other pixels have no model, as if they did not have enough valid dates.", show_default=True)
+@click.option("--condition_number",  is_flag=True, help = "If True, the condition number of the normal matrix of the model of each pixel is written in DataModel/condition_number.tif. High values indicate coefficients which are poorly constrained by the training dates.", show_default=True)
+@execution_options
 def cli_train_model(**kwargs):
     """
     Uses first SENTINEL dates to train a periodic vegetation index model capable of predicting the vegetation index at any date.
@@ -26,9 +33,11 @@ def cli_train_model(**kwargs):
     
     \f
     """
+    pop_execution(kwargs)
     train_model(**kwargs)
 
 
+@with_execution
 def train_model(
     data_directory,
     nb_min_date = 10,
@@ -37,6 +46,10 @@ def train_model(
     correct_vi = False,
     path_vi=None,
     path_masks = None,
+    prefetch_depth = 2,
+    active_pixels = False,
+    condition_number = False,
+    execution = None,
     ):
     """
     Uses first SENTINEL dates to train a periodic vegetation index model capable of predicting the vegetation index at any date.
@@ -60,6 +73,18 @@ def train_model(
         Path of directory containing vegetation indices for each date. If None, the information has to be saved from a previous step
     path_masks : str
         Path of directory containing masks for each date.  If None, the information has to be saved from a previous step
+    prefetch_depth : int, optional
+        Training dates are read one at a time, and the model is computed from sums accumulated date by date, so memory usage does not depend on the number of dates. 
+        prefetch_depth is the number of dates read in advance by background threads while the current date is used. Set to 0 to read each date when it is used. Defaults to 2.
+    active_pixels : bool, optional
+        If True and the forest mask was computed, the model is only computed for pixels inside the forest mask. Data of those pixels is gathered as compressed vectors, so computation time and memory usage are proportional to the forest area. 
+        Other pixels have no model, and are outside the sufficient_coverage_mask, so they are also skipped by the dieback detection if it uses active_pixels. Results exported by export_results are unchanged. Defaults to False.
+    condition_number : bool, optional
+        If True, the condition number of the normal matrix of the model of each pixel, ratio between its largest and smallest eigenvalues, is written in DataModel/condition_number.tif, with NaN where there is no model. 
+        High values indicate coefficients which are poorly constrained by the training dates, for example when valid dates are concentrated in a part of the year. It is only computed with the model. Defaults to False.
+    execution : ExecutionConfig or dict, optional
+        Execution configuration of dask computations (scheduler, workers, chunks, memory budget), as described in fordead.execution.ExecutionConfig. If None, the default threaded scheduler is used. 
+        The model is computed in windows whose size is given by its chunks, 1280 pixels by default, or in a single window if chunks is 0. Defaults to None.
 
     Returns
     -------
@@ -78,9 +103,9 @@ def train_model(
 
 
     
-    tile.add_parameters({"nb_min_date" : nb_min_date, "min_last_date_training" : min_last_date_training, "max_last_date_training" : max_last_date_training, "correct_vi" : correct_vi})
+    tile.add_parameters({"nb_min_date" : nb_min_date, "min_last_date_training" : min_last_date_training, "max_last_date_training" : max_last_date_training, "correct_vi" : correct_vi, "active_pixels" : active_pixels})
     if tile.parameters["Overwrite"] : 
-        tile.delete_dirs("coeff_model","AnomaliesDir","state_dieback", "periodic_results_dieback","result_files","timelapse","series", "validation", "nb_periods_stress") #Deleting previous training and detection results if they exist
+        tile.delete_dirs("coeff_model","AnomaliesDir","anomaly_bitplanes","state_dieback", "periodic_results_dieback","result_files","timelapse","series", "validation", "nb_periods_stress", "threshold_sweep") #Deleting previous training and detection results if they exist
         tile.delete_files("sufficient_coverage_mask","too_many_stress_periods_mask")
         tile.delete_attributes("last_computed_anomaly","last_date_export")
 
@@ -88,6 +113,8 @@ def train_model(
     tile.add_path("coeff_model", tile.data_directory / "DataModel" / "coeff_model.tif")
     tile.add_path("first_detection_date_index", tile.data_directory / "DataModel" / "first_detection_date_index.tif")
     tile.add_path("sufficient_coverage_mask", tile.data_directory / "TimelessMasks" / "sufficient_coverage_mask.tif")
+    if condition_number:
+        tile.add_path("condition_number", tile.data_directory / "DataModel" / "condition_number.tif")
     
     if tile.paths["coeff_model"].exists():
         print("Model already calculated")
@@ -96,28 +123,33 @@ def train_model(
         tile.getdict_paths(path_vi = tile.paths["VegetationIndexDir"],
                             path_masks = tile.paths["MaskDir"])
         
-        # Import des index de végétations et des masques
-        stack_vi, stack_masks = import_stackedmaskedVI(tile, max_date=max_last_date_training, chunks = 1280)
-   
-        detection_dates, first_detection_date_index = get_detection_dates(stack_masks,
-                                              min_last_date_training = min_last_date_training,
-                                              nb_min_date = nb_min_date)
+        # Dates which can be used for training
+        dates = [date for date in tile.paths["VegetationIndex"] if date <= max_last_date_training]
         
+        if correct_vi:
+            # Medians computed by step 1 or by previous computations are not computed again
+            tile.large_scale_model, tile.correction_vi, tile.forest_medians = compute_vi_correction(dates, tile.paths, getattr(tile, "forest_medians", None))
+        
+        forest_mask = import_active_mask(tile.paths, ["forest_mask"]) if active_pixels else None
+        
+        # Modéliser le CRSWIR, en lisant les dates une par une
+        model = model_vi_streaming(tile.paths, dates, min_last_date_training, nb_min_date = nb_min_date, 
+                                   correction_vi = tile.correction_vi if correct_vi else None, prefetch_depth = prefetch_depth,
+                                   dtype = tile.parameters.get("dtype", "float64"),
+                                   active_pixels = ActivePixels(forest_mask) if forest_mask is not None else None,
+                                   window_size = execution.get_chunks(1280) if execution.chunks != "auto" else 1280,
+                                   return_condition = condition_number)
+        coeff_model, first_detection_date_index = model[:2]
         
         #Fusion du masque forêt et des zones non utilisables par manque de données
         sufficient_coverage_mask = first_detection_date_index!=0
         
-        if correct_vi:
-            stack_vi, tile.large_scale_model, tile.correction_vi = model_vi_correction(stack_vi, stack_masks, tile.paths)
-
-        # Modéliser le CRSWIR
-        stack_masks = stack_masks | detection_dates #Masking data not used in training
-        coeff_model = model_vi(stack_vi, stack_masks)
-        
         #Ecrire rasters de l'index de la dernière date utilisée, les coefficients, la zone utilisable
-        write_tif(first_detection_date_index,tile.raster_meta["attrs"], tile.paths["first_detection_date_index"],nodata=0)
-        write_tif(coeff_model,tile.raster_meta["attrs"], tile.paths["coeff_model"])
-        write_tif(sufficient_coverage_mask,tile.raster_meta["attrs"], tile.paths["sufficient_coverage_mask"],nodata=0)
+        write_tif(first_detection_date_index,tile.raster_meta["attrs"], tile.paths["first_detection_date_index"],nodata=0, profile = tile.output_profile)
+        write_tif(coeff_model,tile.raster_meta["attrs"], tile.paths["coeff_model"], profile = tile.output_profile)
+        write_tif(sufficient_coverage_mask,tile.raster_meta["attrs"], tile.paths["sufficient_coverage_mask"],nodata=0, profile = tile.output_profile)
+        if condition_number:
+            write_tif(model[2],tile.raster_meta["attrs"], tile.paths["condition_number"], profile = tile.output_profile)
         #Save the TileInfo object
     tile.save_info()
 
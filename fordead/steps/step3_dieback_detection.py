@@ -1,16 +1,293 @@
 # -*- coding: utf-8 -*-
 
 import click
+from fordead.cli.utils import execution_options, pop_execution
+from fordead.execution import with_execution
 from tqdm import tqdm
-from fordead.import_data import import_coeff_model, import_dieback_data, import_stress_data, initialize_dieback_data, initialize_stress_data, import_masked_vi, import_first_detection_date_index, TileInfo, import_binary_raster
-from fordead.writing_data import write_tif
-from fordead.dieback_detection import detection_anomalies, detection_dieback, save_stress
-from fordead.model_vegetation_index import prediction_vegetation_index, correct_vi_date
+import numpy as np
+import pandas as pd
+import xarray as xr
+import multiprocessing
+import traceback
+from rasterio.windows import Window
+from fordead.import_data import import_coeff_model, import_dieback_data, import_stress_data, import_sparse_stress_data, initialize_dieback_data, initialize_stress_data, import_masked_vi, import_first_detection_date_index, TileInfo, import_binary_raster, prefetch
+from fordead.writing_data import RasterWriter, CheckpointSchedule, write_stress_periods
+from fordead.bitplanes import PackedBitplanes
+from fordead.dieback_detection import detection_anomalies, DiebackBatch
+from fordead.active_pixels import ActivePixels, import_active_mask
+from fordead.stress_periods import initialize_sparse_stress_data, ended_periods_table, get_stress_periods, compute_stress_index
+from fordead.model_vegetation_index import prediction_vegetation_index, correct_vi_date, add_date_correction_vi, compute_forest_median
+from fordead.masking_vi import get_vi_registry
+
+class _Detection():
+    """
+    Detection of anomalies and update of dieback and stress data, on the whole area or on a shard of rows.
+    If active_mask is given, only active pixels are computed, their data being gathered as compressed vectors. Inactive pixels have no anomalies and keep their dieback and stress data.
+    If stress data is sparse, stress periods ended during the detection are returned as a table, where pixel_offset is added to the position of pixels in the area, so it is their position in the tile.
+    """
+
+    def __init__(self, first_detection_date_index, coeff_model, dieback_data, stress_data, threshold_anomaly, vi, path_dict_vi, stress_index_mode = None, batch_dates = 8, active_mask = None, pixel_offset = 0):
+        self.active_pixels = ActivePixels(active_mask) if active_mask is not None else None
+        self.stress_index_mode = stress_index_mode
+        self.pixel_offset = pixel_offset
+        self.detection_args = dict(threshold_anomaly = threshold_anomaly, vi = vi, path_dict_vi = get_vi_registry(path_dict_vi)) #Vegetation indices are resolved once for all dates
+        if self.active_pixels is not None:
+            self.dieback_data, self.stress_data = dieback_data.load(), stress_data.load() #Data of inactive pixels
+            first_detection_date_index, coeff_model = self.active_pixels.gather(first_detection_date_index), self.active_pixels.gather(coeff_model)
+            dieback_data = self.active_pixels.gather(dieback_data)
+            if stress_index_mode is not None: stress_data = self.active_pixels.gather(stress_data)
+        self.first_detection_date_index, self.coeff_model = first_detection_date_index, coeff_model.load()
+        self.predicted_vi = None #Array in which the vegetation index of each date is predicted
+        self.dieback_batch = DiebackBatch(dieback_data.load(), stress_data.load(), stress_index_mode, batch_dates)
+
+    def detect(self, vegetation_index, mask, date_index, date):
+        """
+        Detects anomalies of a date and adds them to the batch of dates used to update dieback and stress data.
+        Returns the anomalies.
+        """
+        if self.active_pixels is not None:
+            vegetation_index, mask = self.active_pixels.gather(vegetation_index), self.active_pixels.gather(mask)
+        
+        mask = mask | (date_index < self.first_detection_date_index) #Masking pixels where date was used for training
+        
+        predicted_vi=prediction_vegetation_index(self.coeff_model,[date], out = self.predicted_vi)
+        self.predicted_vi = predicted_vi.values
+        
+        anomalies, diff_vi = detection_anomalies(vegetation_index, mask, predicted_vi, **self.detection_args)
+        
+        self.dieback_batch.add(anomalies, mask, diff_vi, date_index)
+        
+        if self.active_pixels is not None:
+            anomalies = self.active_pixels.scatter(anomalies, fill_value = False)
+        return anomalies
+
+    def state(self):
+        """
+        Returns dieback and stress data updated with all detected dates, and the table of stress periods ended during the detection if stress data is sparse, None otherwise
+        """
+        dieback_data, stress_data = self.dieback_batch.result()
+        ended_periods = None
+        if self.dieback_batch.ended_periods is not None:
+            ended_periods = ended_periods_table(self.dieback_batch.ended_periods, dtype = stress_data["cum_diff"].dtype)
+            pixels = ended_periods["pixel"].values
+            ended_periods["pixel"] = (self.active_pixels.index[pixels] if self.active_pixels is not None else pixels) + self.pixel_offset
+        if self.active_pixels is not None:
+            dieback_data = self.active_pixels.scatter(dieback_data, like = self.dieback_data)
+            stress_data = self.active_pixels.scatter(stress_data, like = self.stress_data) if self.stress_index_mode is not None else self.stress_data
+        return dieback_data, stress_data, ended_periods
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+def _detection_worker(connection, window, dict_paths, dates, date_indexes, detection, prefetch_depth):
+    """
+    Runs in a worker process the detection of a shard of rows, for each date of date_indexes.
+    For each ("date", date_index, correction_vi) command received from the connection, the vegetation index and mask of the window of the shard are imported, corrected with correction_vi if it is not None, and the anomalies are sent back.
+    For a "state" command, dieback and stress data updated with all received dates are sent back, and a "close" command ends the process. Errors are sent back as ("error", traceback).
+    """
+    def import_date(date_index):
+        return [data.load() for data in import_masked_vi(dict_paths, dates[date_index], window = window)]
+    try:
+        loader = prefetch(import_date, date_indexes, depth = prefetch_depth)
+        while True:
+            command = connection.recv()
+            if command[0] == "date":
+                _, date_index, correction_vi = command
+                _, (vegetation_index, mask) = next(loader)
+                if correction_vi is not None:
+                    vegetation_index, _ = correct_vi_date(vegetation_index, mask, None, None, dates[date_index], correction_vi)
+                connection.send(("anomalies", detection.detect(vegetation_index, mask, date_index, dates[date_index])))
+            elif command[0] == "state":
+                connection.send(("state", detection.state()))
+            else:
+                break
+    except Exception:
+        connection.send(("error", traceback.format_exc()))
+    finally:
+        connection.close()
+
+class _ShardedDetection():
+    """
+    Pool of worker processes, each detecting anomalies on a shard of rows of the area with _detection_worker, dates being computed in the same order by every worker.
+    Results of the shards are concatenated along y, so they are identical to the results of the detection on the whole area.
+    Processes are spawned rather than forked, as forking a process where GDAL or dask threads are running is unsafe.
+    """
+
+    def __init__(self, n_workers, dict_paths, dates, date_indexes, first_detection_date_index, coeff_model, dieback_data, stress_data, detection_args, active_mask = None, prefetch_depth = 2):
+        context = multiprocessing.get_context("spawn")
+        shards = [rows for rows in np.array_split(np.arange(first_detection_date_index.sizes["y"]), n_workers) if len(rows) > 0]
+        self.connections = []
+        self.processes = []
+        for rows in shards:
+            rows = slice(int(rows[0]), int(rows[-1]) + 1)
+            connection, worker_connection = context.Pipe()
+            process = context.Process(target = _detection_worker, daemon = True,
+                                      args = (worker_connection, Window(0, rows.start, first_detection_date_index.sizes["x"], rows.stop - rows.start), dict_paths, dates, date_indexes, 
+                                              _Detection(first_detection_date_index.isel(y = rows).load(), coeff_model.isel(y = rows).load(), 
+                                                         dieback_data.isel(y = rows).load(), stress_data.isel(y = rows).load(), 
+                                                         active_mask = active_mask.isel(y = rows).load() if active_mask is not None else None, 
+                                                         pixel_offset = rows.start * first_detection_date_index.sizes["x"], **detection_args), 
+                                              prefetch_depth))
+            process.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+
+    def _receive(self):
+        results = []
+        for connection in self.connections:
+            try:
+                message, result = connection.recv()
+            except EOFError:
+                raise RuntimeError("A dieback detection worker process ended unexpectedly")
+            if message == "error":
+                raise RuntimeError("Error in a dieback detection worker process :\n" + result)
+            results.append(result)
+        return results
+
+    def detect(self, date_index, correction_vi = None):
+        """
+        Detects anomalies of a date on every shard and returns the anomalies of the whole area
+        """
+        for connection in self.connections:
+            connection.send(("date", date_index, correction_vi))
+        return xr.concat(self._receive(), dim = "y")
+
+    def state(self):
+        """
+        Returns dieback and stress data of the whole area, and the table of stress periods ended during the detection if stress data is sparse, None otherwise
+        """
+        for connection in self.connections:
+            connection.send(("state",))
+        dieback_data, stress_data, ended_periods = zip(*self._receive())
+        ended_periods = pd.concat(ended_periods, ignore_index = True) if ended_periods[0] is not None else None
+        return xr.concat(dieback_data, dim = "y"), xr.concat(stress_data, dim = "y"), ended_periods
+
+    def close(self):
+        for connection, process in zip(self.connections, self.processes):
+            if process.is_alive():
+                try:
+                    connection.send(("close",))
+                except (BrokenPipeError, OSError):
+                    pass
+            connection.close()
+            process.join(timeout = 60)
+            if process.is_alive():
+                process.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+def _detect_dates(tile, detection, date_indexes, forest_mask = None, prefetch_depth = 2, progress = True):
+    """
+    Detects the anomalies of each date of date_indexes with a _Detection or a _ShardedDetection, and yields each date with its anomalies.
+    If correct_vi was used in the training step, the vegetation index is corrected, and the corrections of dates not stored by the previous steps are added to tile.correction_vi.
+    """
+    if isinstance(detection, _ShardedDetection):
+        # Each process computes a shard of rows, the correction of the vegetation index is computed for each date by the main process
+        for date_index in tqdm(date_indexes, disable=not progress):
+            date = tile.dates[date_index]
+            correction_vi = None
+            if tile.parameters["correct_vi"]:
+                if date not in tile.correction_vi.Time:
+                    forest_median = getattr(tile, "forest_medians", {}).get(date)
+                    if forest_median is None:
+                        vegetation_index, mask = import_masked_vi(tile.paths, date)
+                        forest_median = compute_forest_median(vegetation_index, np.asarray(forest_mask) & ~np.asarray(mask))
+                    tile.correction_vi = add_date_correction_vi(tile.large_scale_model, date, tile.correction_vi, forest_median)
+                correction_vi = tile.correction_vi.sel(Time = [date])
+            
+            yield date, detection.detect(date_index, correction_vi)
+    else:
+        def import_date(date_index):
+            return [data.load() for data in import_masked_vi(tile.paths, tile.dates[date_index])]
+        
+        for date_index, (vegetation_index, mask) in tqdm(prefetch(import_date, date_indexes, depth = prefetch_depth), total=len(date_indexes), disable=not progress):
+            date = tile.dates[date_index]
+            if tile.parameters["correct_vi"]:
+                vegetation_index, tile.correction_vi = correct_vi_date(vegetation_index, mask,forest_mask, tile.large_scale_model, date, tile.correction_vi,
+                                                                       forest_median = getattr(tile, "forest_medians", {}).get(date))
+            
+            yield date, detection.detect(vegetation_index, mask, date_index, date)
+            # print('\r', date, " | ", len(tile.dates)-date_index-1, " remaining         ", sep='', end='', flush=True) if date_index != (len(tile.dates) -1) else print('\r', "                                              ", sep='', end='\r', flush=True) 
+            del vegetation_index, mask
+
+def _open_detection(tile, n_workers, date_indexes, first_detection_date_index, coeff_model, dieback_data, stress_data, detection_args, active_mask = None, prefetch_depth = 2):
+    """
+    Returns a _ShardedDetection of n_workers processes if n_workers > 1, a _Detection of the whole area otherwise
+    """
+    if n_workers > 1:
+        return _ShardedDetection(n_workers, tile.paths, tile.dates, date_indexes, first_detection_date_index, coeff_model, dieback_data, stress_data, detection_args, 
+                                 active_mask = active_mask, prefetch_depth = prefetch_depth)
+    return _Detection(first_detection_date_index, coeff_model, dieback_data, stress_data, active_mask = active_mask, **detection_args)
+
+def _threshold_sweep(tile, thresholds, max_nb_stress_periods, stress_index_mode, vi, path_dict_vi, prefetch_depth, pack_anomalies, n_workers, batch_dates, active_pixels, progress):
+    """
+    Detects dieback for several thresholds of anomaly detection in a single pass over the dates, dieback and stress data having an additional "threshold" dimension.
+    All dates from min_last_date_training are computed, and the results of each threshold are written in the directory "ThresholdSweep/threshold_<threshold>", previous results of a sweep being deleted. 
+    Results of the detection with a single threshold are not modified.
+    """
+    thresholds = [float(threshold) for threshold in thresholds]
+    if len(set(thresholds)) != len(thresholds):
+        raise ValueError("Thresholds of anomaly detection must be unique : " + str(thresholds))
+    if vi==None : vi = tile.parameters["vi"]
+    if path_dict_vi==None : path_dict_vi = tile.parameters["path_dict_vi"] if "path_dict_vi" in tile.parameters else None
+    
+    tile.add_dirpath("threshold_sweep", tile.data_directory / "ThresholdSweep")
+    tile.delete_dirs("threshold_sweep")
+    tile.search_new_dates()
+    date_indexes = [date_index for date_index, date in enumerate(tile.dates) if date >= tile.parameters["min_last_date_training"]]
+    print("Dieback detection : " + str(len(date_indexes)) + " dates, " + str(len(thresholds)) + " thresholds")
+    
+    first_detection_date_index = import_first_detection_date_index(tile.paths["first_detection_date_index"])
+    coeff_model = import_coeff_model(tile.paths["coeff_model"])
+    dieback_data = initialize_dieback_data(first_detection_date_index.shape,first_detection_date_index.coords).expand_dims(threshold = thresholds, axis = 0)
+    stress_data = initialize_stress_data(first_detection_date_index.shape,first_detection_date_index.coords, max_nb_stress_periods, dtype = tile.parameters.get("dtype", "float64")).expand_dims(threshold = thresholds, axis = 0)
+    forest_mask = import_binary_raster(tile.paths["forest_mask"]) if tile.parameters["correct_vi"] else None
+    active_mask = import_active_mask(tile.paths, ["sufficient_coverage_mask", "forest_mask"]) if active_pixels else None
+    
+    threshold_dirs = {threshold : tile.paths["threshold_sweep"] / ("threshold_" + str(threshold)) for threshold in thresholds}
+    if pack_anomalies:
+        anomaly_bitplanes = {threshold : PackedBitplanes(threshold_dirs[threshold] / "AnomalyBitplanes") for threshold in thresholds}
+    
+    writer = RasterWriter()
+    detection_args = dict(threshold_anomaly = xr.DataArray(thresholds, coords = {"threshold" : thresholds}, dims = ["threshold"]), vi = vi, path_dict_vi = path_dict_vi, stress_index_mode = stress_index_mode, batch_dates = batch_dates)
+    detection = _open_detection(tile, n_workers, date_indexes, first_detection_date_index, coeff_model, dieback_data, stress_data, detection_args, 
+                                active_mask = active_mask, prefetch_depth = prefetch_depth)
+    del dieback_data, stress_data
+    with detection:
+        for date, anomalies in _detect_dates(tile, detection, date_indexes, forest_mask = forest_mask, prefetch_depth = prefetch_depth, progress = progress):
+            if pack_anomalies:
+                for threshold in thresholds:
+                    anomaly_bitplanes[threshold].append(date, anomalies.sel(threshold = threshold).transpose("y", "x"))
+            del anomalies
+        dieback_data, stress_data, _ = detection.state()
+    
+    for threshold in thresholds:
+        threshold_dieback, threshold_stress = dieback_data.sel(threshold = threshold, drop = True), stress_data.sel(threshold = threshold, drop = True)
+        for directory in ["DataDieback"] + (["DataStress", "TimelessMasks"] if stress_index_mode is not None else []):
+            (threshold_dirs[threshold] / directory).mkdir(parents=True, exist_ok=True)
+        for name, file_name in [("state", "state_dieback"), ("first_date", "first_date_dieback"), ("first_date_unconfirmed", "first_date_unconfirmed_dieback"), ("count", "count_dieback")]:
+            writer.write_tif(threshold_dieback[name], first_detection_date_index.attrs, threshold_dirs[threshold] / "DataDieback" / (file_name + ".tif"),nodata=0, profile = tile.output_profile)
+        if stress_index_mode is not None:
+            writer.write_tif(threshold_stress["nb_periods"]<=max_nb_stress_periods, first_detection_date_index.attrs, threshold_dirs[threshold] / "TimelessMasks" / "too_many_stress_periods_mask.tif",nodata=0, profile = tile.output_profile)
+            writer.write_tif(compute_stress_index(threshold_stress, stress_index_mode), first_detection_date_index.attrs, threshold_dirs[threshold] / "DataStress" / "stress_index.tif",nodata=0, profile = tile.output_profile, quantize = True)
+            for name, file_name in [("date", "dates_stress"), ("nb_periods", "nb_periods_stress"), ("cum_diff", "cum_diff_stress"), ("nb_dates", "nb_dates_stress")]:
+                writer.write_tif(threshold_stress[name], first_detection_date_index.attrs, threshold_dirs[threshold] / "DataStress" / (file_name + ".tif"),nodata=0, profile = tile.output_profile)
+    writer.close()
+    tile.save_info()
 
 @click.command(name='dieback_detection')
 @click.option("-o", "--data_directory",  type=str, help="Path of the output directory")
-@click.option("-s", "--threshold_anomaly",  type=float, default=0.16,
-                    help="Minimum threshold for anomaly detection", show_default=True)
+@click.option("-s", "--threshold_anomaly",  type=float, multiple=True, default=[0.16],
+                    help="Minimum threshold for anomaly detection. If several thresholds are given (ex : -s 0.12 -s 0.16 -s 0.2), they are evaluated in a single pass over the dates and the results of each threshold are written in the ThresholdSweep directory.", show_default=True)
 @click.option("--max_nb_stress_periods",  type=int, default=5,
                     help="Maximum number of stress periods", show_default=True)
 @click.option("--stress_index_mode",  type=str, default=None,
@@ -19,14 +296,39 @@ from fordead.model_vegetation_index import prediction_vegetation_index, correct_
                     help="Chosen vegetation index, only useful if step1 was skipped", show_default=True)
 @click.option("--path_dict_vi",  type=str, default=None,
                     help="Path of text file to add vegetation index formula, only useful if step1 was skipped", show_default=True)
+@click.option("--prefetch_depth",  type=int, default=2,
+                    help="Number of dates whose vegetation index and mask are read in advance by background threads while the current date is computed. Set to 0 to read each date when it is computed.", show_default=True)
+@click.option("--pack_anomalies",  is_flag=True,
+                    help="If True, anomalies are also stored as packed bitplanes (8 dates per byte) which can be memory-mapped, and are used to import anomalies in visualisation tools.", show_default=True)
+@click.option("--n_workers",  type=int, default=1,
+                    help="Number of processes computing the detection in parallel, each on a shard of rows of the area. Results are identical to the computation of the whole area in a single process.", show_default=True)
+@click.option("--batch_dates",  type=int, default=8,
+                    help="Number of dates whose anomalies are accumulated before dieback and stress data are updated in a single pass over the area. Each accumulated date holds an anomaly and a mask array of the area, and the difference between the vegetation index and its prediction if stress_index_mode is given.", show_default=True)
+@click.option("--active_pixels/--all_pixels",  default=None,
+                    help="If --active_pixels, only pixels inside the forest mask, the sufficient_coverage_mask and the too_many_stress_periods_mask are computed, on compressed vectors of those pixels. Other pixels have no anomalies and keep their dieback and stress data. If not given, the value used in the training step is used.", show_default=True)
+@click.option("--stress_output_format", type = click.Choice(["rasters", "table"]),default = "rasters",
+                    help="Storage of stress periods, if stress_index_mode is given. 'rasters' writes rasters with a band for each possible stress period, 'table' writes a Parquet table with a row for each stress period of each pixel, and only keeps the sums of the current period of each pixel during the detection.", show_default=True)
+@click.option("--checkpoint_dates",  type=int, default=None,
+                    help="Number of computed dates between two checkpoints of the dieback and stress data and of the last computed date, from which an interrupted computation is resumed. If None, checkpoints are only saved depending on checkpoint_minutes.", show_default=True)
+@click.option("--checkpoint_minutes",  type=float, default=30,
+                    help="Number of minutes between two checkpoints. If 0, checkpoints are only saved depending on checkpoint_dates.", show_default=True)
+@execution_options
 def cli_dieback_detection(
     data_directory,
     threshold_anomaly=0.16,
     max_nb_stress_periods = 5,
     stress_index_mode = None,
     vi = None,
-    path_dict_vi = None
-    
+    path_dict_vi = None,
+    prefetch_depth = 2,
+    pack_anomalies = False,
+    n_workers = 1,
+    batch_dates = 8,
+    active_pixels = None,
+    stress_output_format = "rasters",
+    checkpoint_dates = None,
+    checkpoint_minutes = 30,
+    **execution_kwargs
     ):
     """
     Detects anomalies by comparing the vegetation index and its prediction from the model. 
@@ -36,9 +338,12 @@ def cli_dieback_detection(
     See details here : https://fordead.gitlab.io/fordead_package/docs/user_guides/english/03_dieback_detection/
     \f
     """
-    dieback_detection(data_directory, threshold_anomaly, max_nb_stress_periods, stress_index_mode, vi, path_dict_vi)
+    pop_execution(execution_kwargs)
+    threshold_anomaly = threshold_anomaly[0] if len(threshold_anomaly) == 1 else list(threshold_anomaly)
+    dieback_detection(data_directory, threshold_anomaly, max_nb_stress_periods, stress_index_mode, vi, path_dict_vi, prefetch_depth = prefetch_depth, pack_anomalies = pack_anomalies, n_workers = n_workers, batch_dates = batch_dates, active_pixels = active_pixels, stress_output_format = stress_output_format, checkpoint_dates = checkpoint_dates, checkpoint_minutes = checkpoint_minutes, **execution_kwargs)
 
 
+@with_execution
 def dieback_detection(
     data_directory,
     threshold_anomaly=0.16,
@@ -46,6 +351,15 @@ def dieback_detection(
     stress_index_mode = None,
     vi = None,
     path_dict_vi = None,
+    prefetch_depth = 2,
+    pack_anomalies = False,
+    n_workers = 1,
+    batch_dates = 8,
+    active_pixels = None,
+    stress_output_format = "rasters",
+    checkpoint_dates = None,
+    checkpoint_minutes = 30,
+    execution = None,
     progress=True
     ):
     """
@@ -60,8 +374,12 @@ def dieback_detection(
     ----------
     data_directory : str
         Path of the output directory
-    threshold_anomaly : float
-        Minimum threshold for anomaly detection
+    threshold_anomaly : float or list
+        Minimum threshold for anomaly detection. 
+        If a list of thresholds is given, they are evaluated in a single pass over the dates, dieback and stress data being updated for each threshold with the same vegetation index, masks and predictions. 
+        All dates from the end of the training period are then computed, and the dieback data, stress data and too_many_stress_periods_mask of each threshold are written in the directory "ThresholdSweep/threshold_<threshold>", previous results of a sweep being deleted. 
+        Anomalies of each date are only written as packed bitplanes, if pack_anomalies is True. Stress data is written as rasters whatever stress_output_format, and checkpoints are not saved. 
+        Results of the detection with a single threshold, used by the next steps, are not modified.
     max_nb_stress_periods : int
         Maximum number of stress periods, if this number is reached, the pixel is masked in the too_many_stress_periods, thus removed from future exports. Only used if stress_index_mode is not None.
     stress_index_mode : str
@@ -72,6 +390,34 @@ def dieback_detection(
         Chosen vegetation index, only useful if step1 was skipped
     path_dict_vi : str
         Path of text file to add vegetation index formula, only useful if step1 was skipped
+    prefetch_depth : int, optional
+        Number of dates whose vegetation index and mask are read in advance by background threads while the current date is computed, so reading and computing overlap. Each prefetched date holds a vegetation index and a mask of the whole tile in memory. Set to 0 to read each date when it is computed. Defaults to 2.
+    pack_anomalies : bool, optional
+        If True, anomalies are also stored in the "AnomalyBitplanes" directory as packed bitplanes, with 8 dates per byte, which can be memory-mapped. They are then used to import anomalies in visualisation tools. 
+        If anomalies were computed for previous dates without this option, they are added to the bitplanes. Defaults to False.
+    n_workers : int, optional
+        Number of processes computing the detection in parallel. The area is split into n_workers shards of rows, and each process imports the vegetation index and masks of its rows and updates their dieback and stress data for all new dates.
+        The anomalies of each date are gathered and written by the main process, and results are identical to the computation of the whole area in a single process. 
+        If correct_vi was used in the training step, the median of the vegetation index of dates not stored by the previous steps is computed by the main process. 
+        As processes are spawned, scripts using n_workers > 1 must be protected by an `if __name__ == '__main__':` block. Defaults to 1.
+    batch_dates : int, optional
+        Number of dates whose anomalies are accumulated before dieback and stress data are updated. The dates of a batch are scanned in a single pass over the area, by blocks of rows, instead of updating arrays of the whole area for each date. 
+        Each accumulated date holds an anomaly and a mask array of the area (or of the shard of each process), as well as the difference between the vegetation index and its prediction if stress_index_mode is given. Results do not depend on this parameter. Defaults to 8.
+    active_pixels : bool, optional
+        If True, only active pixels are computed, which are pixels inside the forest mask if it was computed, inside the sufficient_coverage_mask, and inside the too_many_stress_periods_mask if it was computed by a previous detection. 
+        The data of those pixels is gathered as compressed vectors, so computation time and memory usage are proportional to the active area. Other pixels have no anomalies and keep their dieback and stress data. Results exported by export_results are unchanged, as they only concern active pixels.
+        If None, the value used in the training step is used. Defaults to None.
+    stress_output_format : str, optional
+        Storage of stress periods, only used if stress_index_mode is not None. If "rasters", the dates, sums and numbers of dates of stress periods and the stress index are written as rasters with a band for each possible stress period in the "DataStress" directory.
+        If "table", stress periods are written to the Parquet table "DataStress/stress_periods.parquet", with a row for each stress period of each pixel, along with the "nb_periods_stress" raster. During the detection, only the sums of the current period of each pixel are kept in memory, and a row is added when a period ends. 
+        Dense stress data is computed from the table when it is imported with import_stress_data. Defaults to "rasters".
+    checkpoint_dates : int, optional
+        Number of computed dates between two checkpoints. At each checkpoint, dieback and stress data and the last computed date are saved in the "Checkpoints" directory once the anomalies of computed dates are written. 
+        If the computation is interrupted, it is resumed from the last checkpoint when this step is run again with the same parameters. If None, checkpoints are only saved depending on checkpoint_minutes. Defaults to None.
+    checkpoint_minutes : float, optional
+        Number of minutes between two checkpoints. If 0, checkpoints are only saved depending on checkpoint_dates. Defaults to 30.
+    execution : ExecutionConfig or dict, optional
+        Execution configuration of dask computations (scheduler, workers, chunks, memory budget), as described in fordead.execution.ExecutionConfig. If None, the default threaded scheduler is used. Dates are computed one after the other on numpy arrays, so chunks are not used by this step. Defaults to None.
     progress : bool, optional
         Whether to show a progress bar. Defaults to True.
     Returns
@@ -80,11 +426,23 @@ def dieback_detection(
     """
     tile = TileInfo(data_directory)
     tile = tile.import_info()
-    tile.add_parameters({"threshold_anomaly" : threshold_anomaly, "max_nb_stress_periods" : max_nb_stress_periods, "stress_index_mode" : stress_index_mode})
+    if active_pixels is None: active_pixels = tile.parameters.get("active_pixels", False)
+    if isinstance(threshold_anomaly, (list, tuple, np.ndarray)):
+        _threshold_sweep(tile, threshold_anomaly, max_nb_stress_periods, stress_index_mode, vi, path_dict_vi, prefetch_depth, pack_anomalies, n_workers, batch_dates, active_pixels, progress)
+        return
+    tile.add_parameters({"threshold_anomaly" : threshold_anomaly, "max_nb_stress_periods" : max_nb_stress_periods, "stress_index_mode" : stress_index_mode, "active_pixels" : active_pixels, "stress_output_format" : stress_output_format})
+    tile.add_path("checkpoint_dieback", tile.data_directory / "Checkpoints" / "checkpoint_dieback.pickle")
+    checkpoint = tile.import_checkpoint("checkpoint_dieback") #Checkpoint of an interrupted computation with the same parameters
     if tile.parameters["Overwrite"] : 
-        tile.delete_dirs("AnomaliesDir","state_dieback","periodic_results_dieback","result_files","timelapse","series","nb_periods_stress") #Deleting previous detection results if they exist
-        tile.delete_files("too_many_stress_periods_mask")
+        if checkpoint is None: #Otherwise, previous results were already deleted by the interrupted computation
+            tile.delete_dirs("AnomaliesDir","anomaly_bitplanes","state_dieback","periodic_results_dieback","result_files","timelapse","series","nb_periods_stress","threshold_sweep") #Deleting previous detection results if they exist
+            tile.delete_files("too_many_stress_periods_mask")
         tile.delete_attributes("last_computed_anomaly","last_date_export")
+    
+    #The computation is resumed from the checkpoint if it was saved after the last computed date
+    if checkpoint is not None and hasattr(tile, "last_computed_anomaly") and checkpoint["last_computed_anomaly"] <= tile.last_computed_anomaly:
+        checkpoint = None
+    last_computed_anomaly = checkpoint["last_computed_anomaly"] if checkpoint is not None else getattr(tile, "last_computed_anomaly", None)
 
     if vi==None : vi = tile.parameters["vi"]
     if path_dict_vi==None : path_dict_vi = tile.parameters["path_dict_vi"] if "path_dict_vi" in tile.parameters else None
@@ -93,6 +451,9 @@ def dieback_detection(
     tile.getdict_datepaths("Anomalies",tile.paths["AnomaliesDir"]) # Get paths and dates to previously calculated anomalies
     tile.search_new_dates() #Get list of all used dates
     
+    if pack_anomalies:
+        tile.add_dirpath("anomaly_bitplanes", tile.data_directory / "AnomalyBitplanes")
+    
     tile.add_path("too_many_stress_periods_mask", tile.data_directory / "TimelessMasks" / "too_many_stress_periods_mask.tif")
     
     tile.add_path("state_dieback", tile.data_directory / "DataDieback" / "state_dieback.tif")
@@ -105,9 +466,11 @@ def dieback_detection(
     tile.add_path("cum_diff_stress", tile.data_directory / "DataStress" / "cum_diff_stress.tif")
     tile.add_path("nb_dates_stress", tile.data_directory / "DataStress" / "nb_dates_stress.tif")
     tile.add_path("stress_index", tile.data_directory / "DataStress" / "stress_index.tif")
+    if stress_output_format == "table":
+        tile.add_path("stress_periods_table", tile.data_directory / "DataStress" / "stress_periods.parquet")
 
     #Verify if there are new SENTINEL dates
-    new_dates = tile.dates[tile.dates > tile.last_computed_anomaly] if hasattr(tile, "last_computed_anomaly") else tile.dates[tile.dates >= tile.parameters["min_last_date_training"]]
+    new_dates = tile.dates[tile.dates > last_computed_anomaly] if last_computed_anomaly is not None else tile.dates[tile.dates >= tile.parameters["min_last_date_training"]]
     if  len(new_dates) == 0:
         print("Dieback detection : no new dates")
     else:
@@ -117,72 +480,101 @@ def dieback_detection(
         first_detection_date_index = import_first_detection_date_index(tile.paths["first_detection_date_index"])
         coeff_model = import_coeff_model(tile.paths["coeff_model"])
         
-        if tile.paths["state_dieback"].exists():
-            dieback_data = import_dieback_data(tile.paths)
+        if checkpoint is not None:
+            dieback_data, stress_data, ended_periods = checkpoint["dieback_data"], checkpoint["stress_data"], checkpoint.get("stress_periods")
+            if tile.parameters["correct_vi"]: tile.correction_vi = checkpoint["correction_vi"]
         else:
-            dieback_data = initialize_dieback_data(first_detection_date_index.shape,first_detection_date_index.coords)
-        if tile.paths["nb_dates_stress"].exists(): 
-            stress_data = import_stress_data(tile.paths)
-        else:
-            stress_data = initialize_stress_data(first_detection_date_index.shape,first_detection_date_index.coords, max_nb_stress_periods)
+            if tile.paths["state_dieback"].exists():
+                dieback_data = import_dieback_data(tile.paths)
+            else:
+                dieback_data = initialize_dieback_data(first_detection_date_index.shape,first_detection_date_index.coords)
+            ended_periods = None
+            if stress_output_format == "table":
+                #Ended stress periods are kept as a table, and only the sums of the current period of each pixel are updated
+                if tile.paths["stress_periods_table"].exists():
+                    ended_periods, stress_data = import_sparse_stress_data(tile.paths)
+                else:
+                    ended_periods = ended_periods_table([], dtype = tile.parameters.get("dtype", "float64"))
+                    stress_data = initialize_sparse_stress_data(first_detection_date_index.shape,first_detection_date_index.coords, dtype = tile.parameters.get("dtype", "float64"))
+            elif tile.paths["nb_dates_stress"].exists(): 
+                stress_data = import_stress_data(tile.paths)
+            else:
+                stress_data = initialize_stress_data(first_detection_date_index.shape,first_detection_date_index.coords, max_nb_stress_periods, dtype = tile.parameters.get("dtype", "float64"))
    
-        if tile.parameters["correct_vi"]:
-            forest_mask = import_binary_raster(tile.paths["forest_mask"])
+        forest_mask = import_binary_raster(tile.paths["forest_mask"]) if tile.parameters["correct_vi"] else None
+        
+        #Only pixels with a model, inside the forest mask and without too many stress periods are computed
+        active_mask = import_active_mask(tile.paths, ["sufficient_coverage_mask", "forest_mask", "too_many_stress_periods_mask"]) if active_pixels else None
             
+        if pack_anomalies:
+            anomaly_bitplanes = PackedBitplanes(tile.paths["anomaly_bitplanes"])
+            for date in tile.paths["Anomalies"]: #Adding anomalies of previously computed dates
+                if date not in new_dates and date not in anomaly_bitplanes.dates:
+                    anomaly_bitplanes.append(date, import_binary_raster(tile.paths["Anomalies"][date]))
+        
         #dieback DETECTION
-        for date_index, date in tqdm(enumerate(tile.dates), total=len(tile.dates), disable=not progress):
-            if date in new_dates:
-                vegetation_index, mask = import_masked_vi(tile.paths,date)
-                if tile.parameters["correct_vi"]:
-                    vegetation_index, tile.correction_vi = correct_vi_date(vegetation_index, mask,forest_mask, tile.large_scale_model, date, tile.correction_vi)
-
-                mask = mask | (date_index < first_detection_date_index) #Masking pixels where date was used for training
-                
-                predicted_vi=prediction_vegetation_index(coeff_model,[date])
-                
-                anomalies, diff_vi = detection_anomalies(vegetation_index, mask, predicted_vi, threshold_anomaly, 
-                                                vi = vi, path_dict_vi = path_dict_vi)
-                                
-                dieback_data, changing_pixels = detection_dieback(dieback_data, anomalies, mask, date_index)
+        new_date_indexes = [date_index for date_index, date in enumerate(tile.dates) if date in new_dates]
+        writer = RasterWriter() #Anomalies are written in a background thread while the next dates are computed
+        checkpoints = CheckpointSchedule(checkpoint_dates, checkpoint_minutes)
+        detection_args = dict(threshold_anomaly = threshold_anomaly, vi = vi, path_dict_vi = path_dict_vi, stress_index_mode = stress_index_mode, batch_dates = batch_dates)
+        
+        def write_anomalies(date, anomalies):
+            writer.write_tif(anomalies, first_detection_date_index.attrs, tile.paths["AnomaliesDir"] / str("Anomalies_" + date + ".tif"),nodata=0, profile = tile.output_profile)
+            if pack_anomalies:
+                anomaly_bitplanes.append(date, anomalies)
+        
+        def all_ended_periods(new_ended_periods):
+            return pd.concat([ended_periods, new_ended_periods], ignore_index = True) if new_ended_periods is not None else None
+        
+        def save_checkpoint(date, dieback_data, stress_data, new_ended_periods):
+            writer.flush() #Anomalies of all computed dates are written before the checkpoint
+            tile.save_checkpoint("checkpoint_dieback", {"last_computed_anomaly" : date, "dieback_data" : dieback_data.load(), "stress_data" : stress_data.load(), "stress_periods" : all_ended_periods(new_ended_periods),
+                                                        "correction_vi" : tile.correction_vi if tile.parameters["correct_vi"] else None})
+        
+        detection = _open_detection(tile, n_workers, new_date_indexes, first_detection_date_index, coeff_model, dieback_data, stress_data, detection_args, 
+                                    active_mask = active_mask, prefetch_depth = prefetch_depth)
+        del dieback_data, stress_data
+        with detection:
+            for date, anomalies in _detect_dates(tile, detection, new_date_indexes, forest_mask = forest_mask, prefetch_depth = prefetch_depth, progress = progress):
+                write_anomalies(date, anomalies)
+                del anomalies
                 
-                if stress_index_mode is not None: stress_data = save_stress(stress_data, dieback_data, changing_pixels, diff_vi, mask, stress_index_mode) 
-
-                write_tif(anomalies, first_detection_date_index.attrs, tile.paths["AnomaliesDir"] / str("Anomalies_" + date + ".tif"),nodata=0)
-                # print('\r', date, " | ", len(tile.dates)-date_index-1, " remaining         ", sep='', end='', flush=True) if date_index != (len(tile.dates) -1) else print('\r', "                                              ", sep='', end='\r', flush=True) 
-                del vegetation_index, mask, predicted_vi, anomalies, changing_pixels, diff_vi
+                if checkpoints.due() and date != new_dates[-1]:
+                    save_checkpoint(date, *detection.state())
+            dieback_data, stress_data, new_ended_periods = detection.state()
+        ended_periods = all_ended_periods(new_ended_periods)
 
         tile.last_computed_anomaly = new_dates[-1]
   
-        write_tif(dieback_data["state"], first_detection_date_index.attrs,tile.paths["state_dieback"],nodata=0)
-        write_tif(dieback_data["first_date"], first_detection_date_index.attrs,tile.paths["first_date_dieback"],nodata=0)
-        write_tif(dieback_data["first_date_unconfirmed"], first_detection_date_index.attrs,tile.paths["first_date_unconfirmed_dieback"],nodata=0)
-        write_tif(dieback_data["count"], first_detection_date_index.attrs,tile.paths["count_dieback"],nodata=0)
-        del dieback_data
+        writer.write_tif(dieback_data["state"], first_detection_date_index.attrs,tile.paths["state_dieback"],nodata=0, profile = tile.output_profile)
+        writer.write_tif(dieback_data["first_date"], first_detection_date_index.attrs,tile.paths["first_date_dieback"],nodata=0, profile = tile.output_profile)
+        writer.write_tif(dieback_data["first_date_unconfirmed"], first_detection_date_index.attrs,tile.paths["first_date_unconfirmed_dieback"],nodata=0, profile = tile.output_profile)
+        writer.write_tif(dieback_data["count"], first_detection_date_index.attrs,tile.paths["count_dieback"],nodata=0, profile = tile.output_profile)
         
         if stress_index_mode is not None:
             # valid_model = import_binary_raster(tile.paths["sufficient_coverage_mask"])
             # valid_model = valid_model.where(stress_data["nb_periods"]<=max_nb_stress_periods,False)
             too_many_stress_periods_mask = stress_data["nb_periods"]<=max_nb_stress_periods
-            write_tif(too_many_stress_periods_mask, first_detection_date_index.attrs,tile.paths["too_many_stress_periods_mask"],nodata=0) 
-
-            if stress_index_mode == "mean":
-                stress_index = stress_data["cum_diff"]/stress_data["nb_dates"]
-            elif stress_index_mode == "weighted_mean":
-                stress_index = stress_data["cum_diff"]/(stress_data["nb_dates"]*(stress_data["nb_dates"]+1)/2)
+            writer.write_tif(too_many_stress_periods_mask, first_detection_date_index.attrs,tile.paths["too_many_stress_periods_mask"],nodata=0, profile = tile.output_profile) 
+            writer.write_tif(stress_data["nb_periods"], first_detection_date_index.attrs,tile.paths["nb_periods_stress"],nodata=0, profile = tile.output_profile)
+            
+            if stress_output_format == "table":
+                writer.submit(write_stress_periods, get_stress_periods(ended_periods, stress_data, dieback_data), tile.paths["stress_periods_table"], max_nb_stress_periods)
             else:
-                raise Exception("Unrecognized stress_index_mode")
-                   
-            write_tif(stress_index, first_detection_date_index.attrs,tile.paths["stress_index"],nodata=0)
-            del stress_index
-            #Writing dieback data to rasters
-            write_tif(stress_data["date"], first_detection_date_index.attrs,tile.paths["dates_stress"],nodata=0)
-            write_tif(stress_data["nb_periods"], first_detection_date_index.attrs,tile.paths["nb_periods_stress"],nodata=0)
-            write_tif(stress_data["cum_diff"], first_detection_date_index.attrs,tile.paths["cum_diff_stress"],nodata=0)
-            write_tif(stress_data["nb_dates"], first_detection_date_index.attrs,tile.paths["nb_dates_stress"],nodata=0)
+                stress_index = compute_stress_index(stress_data, stress_index_mode)
+                writer.write_tif(stress_index, first_detection_date_index.attrs,tile.paths["stress_index"],nodata=0, profile = tile.output_profile, quantize = True)
+                del stress_index
+                #Writing dieback data to rasters
+                writer.write_tif(stress_data["date"], first_detection_date_index.attrs,tile.paths["dates_stress"],nodata=0, profile = tile.output_profile)
+                writer.write_tif(stress_data["cum_diff"], first_detection_date_index.attrs,tile.paths["cum_diff_stress"],nodata=0, profile = tile.output_profile)
+                writer.write_tif(stress_data["nb_dates"], first_detection_date_index.attrs,tile.paths["nb_dates_stress"],nodata=0, profile = tile.output_profile)
             del stress_data
+        del dieback_data
+        writer.close() #All files are written before the TileInfo object is saved
 
     # update tile info with new anomalies    
     tile.getdict_datepaths("Anomalies",tile.paths["AnomaliesDir"]) # Get paths and dates to previously calculated anomalies
     tile.save_info()
 
 
+    tile.delete_files("checkpoint_dieback")
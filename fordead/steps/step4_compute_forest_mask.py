@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import click
-from fordead.cli.utils import empty_to_none
-from fordead.import_data import TileInfo, import_binary_raster, get_raster_metadata, clip_xarray
+from fordead.cli.utils import empty_to_none, execution_options, pop_execution
+from fordead.execution import with_execution
+from fordead.import_data import TileInfo, import_binary_raster, get_raster_metadata, is_cube, import_masked_vi
 from fordead.masking_vi import rasterize_bdforet, clip_oso, raster_full, rasterize_vector
 from fordead.writing_data import write_tif
 from pathlib import Path
@@ -26,6 +27,7 @@ from pathlib import Path
                     help="path of shapefile whose polygons will be rasterized as a binary raster with resolution, extent and crs of the raster at path_example_raster. Only used if forest_mask_source = 'vector'", show_default=True)
 @click.option("--path_example_raster",  type=str, default=None,
                     help="Path to raster from which to copy the extent, resolution, CRS...", show_default=True)
+@execution_options
 def cli_compute_forest_mask(**kwargs):
     """
     Compute forest mask from IGN's BDFORET or CESBIO's OSO map
@@ -35,9 +37,11 @@ def cli_compute_forest_mask(**kwargs):
     """
     empty_to_none(kwargs, "list_forest_type")
     empty_to_none(kwargs, "list_code_oso")
+    pop_execution(kwargs)
     compute_forest_mask(**kwargs)
 
 
+@with_execution
 def compute_forest_mask(data_directory,
                         forest_mask_source = None,
 
@@ -48,7 +52,8 @@ def compute_forest_mask(data_directory,
                         path_oso = None,
                         list_code_oso = [17],
                         vector_path = None,
-                        path_example_raster = None
+                        path_example_raster = None,
+                        execution = None
                         ):
     """
     Compute forest mask
@@ -73,6 +78,8 @@ def compute_forest_mask(data_directory,
         path of shapefile whose polygons will be rasterized as a binary raster with resolution, extent and crs of the raster at path_example_raster. Only used if forest_mask_source = "vector"
     path_example_raster : str
         Path to raster from which to copy the extent, CRS...
+    execution : ExecutionConfig or dict, optional
+        Execution configuration of dask computations (scheduler, workers, chunks, memory budget), as described in fordead.execution.ExecutionConfig. If None, the default threaded scheduler is used. Defaults to None.
 
     Returns
     -------
@@ -84,10 +91,11 @@ def compute_forest_mask(data_directory,
     tile.add_parameters({"forest_mask_source" : forest_mask_source, "list_forest_type" : list_forest_type, "list_code_oso" : list_code_oso, "vector_path" : vector_path})
     if tile.parameters["Overwrite"] : 
         tile.delete_files("forest_mask" ,"periodic_results_dieback","result_files","timelapse")
-        tile.delete_attributes("last_date_export")
+        tile.delete_attributes("last_date_export", "forest_medians")
         #Si correction de l'indice de végétation, le calcul du masque forêt se fait en step2 et d'autres résultats doivent être supprimés
-        if hasattr(tile, "correct_vi") and tile.parameters["correct_vi"] : 
-            tile.delete_dirs("coeff_model","AnomaliesDir","state_dieback" ,"periodic_results_dieback","result_files","timelapse","series", "validation", "nb_periods_stress") #Deleting previous training and detection results if they exist
+        #C'est aussi le cas si seuls les pixels actifs, dans le masque forêt, sont calculés
+        if (hasattr(tile, "correct_vi") and tile.parameters["correct_vi"]) or tile.parameters.get("active_pixels", False) : 
+            tile.delete_dirs("coeff_model","AnomaliesDir","anomaly_bitplanes","state_dieback" ,"periodic_results_dieback","result_files","timelapse","series", "validation", "nb_periods_stress", "threshold_sweep") #Deleting previous training and detection results if they exist
             tile.delete_files("sufficient_coverage_mask","too_many_stress_periods_mask")
             tile.delete_attributes("last_computed_anomaly")
 
@@ -100,6 +108,10 @@ def compute_forest_mask(data_directory,
         tile.save_info()
     else:
         if path_example_raster is None : path_example_raster = tile.paths["Masks"][tile.dates[-1]]
+        if is_cube(path_example_raster): #Masks are stored in a cube, the last mask is written as a raster so it can be used as example
+            tile.add_path("example_raster", tile.data_directory / "TimelessMasks" / "example_raster.tif")
+            write_tif(import_masked_vi(tile.paths, tile.dates[-1])[1].squeeze("band"), tile.raster_meta["attrs"], tile.paths["example_raster"], nodata = 0, profile = tile.output_profile)
+            path_example_raster = tile.paths["example_raster"]
         
         if forest_mask_source is None:
             print("No mask used, computing forest mask with every pixel marked as True")
@@ -107,8 +119,7 @@ def compute_forest_mask(data_directory,
             
         elif Path(forest_mask_source).is_file():
             print("Importing " + forest_mask_source)
-            forest_mask = clip_xarray(array = import_binary_raster(forest_mask_source), 
-                                      extent = get_raster_metadata(path_example_raster)["extent"])
+            forest_mask = import_binary_raster(forest_mask_source, extent = get_raster_metadata(path_example_raster)["extent"])
             
         elif forest_mask_source=="BDFORET":
             print("Computing forest mask from BDFORET")
@@ -126,7 +137,8 @@ def compute_forest_mask(data_directory,
             print("Unrecognized forest_mask_source")
         
         
-        write_tif(forest_mask, forest_mask.attrs, nodata = 0, path = tile.paths["forest_mask"])
+        write_tif(forest_mask, forest_mask.attrs, nodata = 0, path = tile.paths["forest_mask"], profile = tile.output_profile)
+        tile.delete_attributes("forest_medians") #Medians of the vegetation index within the previous forest mask
         tile.save_info()
         
 if __name__ == '__main__':
@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
 
 import click
-from fordead.cli.utils import empty_to_none
-from fordead.import_data import TileInfo, import_dieback_data, import_binary_raster, import_soil_data, import_stress_data, import_stress_index, import_coeff_model, import_first_detection_date_index
+from fordead.cli.utils import empty_to_none, execution_options, pop_execution
+from fordead.execution import with_execution
+from fordead.import_data import TileInfo, import_dieback_data, import_binary_raster, import_soil_data, import_stress_data, import_stress_index, get_stress_index, import_coeff_model, import_first_detection_date_index
 from fordead.writing_data import vectorizing_confidence_class, get_bins, convert_dateindex_to_datenumber, get_periodic_results_as_shapefile, get_state_at_date, union_confidence_class, write_tif
 from fordead.stac.stac_module import get_tile_collection
 from fordead.reflectance_extraction import extract_raster_values
 from fordead.model_vegetation_index import prediction_vegetation_index
+from fordead.active_pixels import import_active_mask
 import numpy as np
 import geopandas as gp
 import pandas as pd
@@ -29,6 +31,7 @@ warnings.filterwarnings("ignore", message="`unary_union` returned None due to al
                     help="If True, one shapefile is exported for each period containing the areas in dieback at the end of the period. Else, a single shapefile is exported containing diebackd areas associated with the period of dieback", show_default=True)
 @click.option("-t", "--conf_threshold_list", type = float, multiple=True, default = None, help = "List of thresholds used as bins to discretize the confidence index into several classes", show_default=True)
 @click.option("-c", "--conf_classes_list", type = str, multiple=True, default = None, help = "List of classes names, if conf_threshold_list has n values, conf_classes_list must have n+1 values", show_default=True)
+@execution_options
 def cli_export_results(**kwargs):
     """
     Export results to a vectorized shapefile format.
@@ -37,10 +40,12 @@ def cli_export_results(**kwargs):
     """
     empty_to_none(kwargs, "conf_threshold_list")
     empty_to_none(kwargs, "conf_classes_list")
+    pop_execution(kwargs)
     export_results(**kwargs)
 
 
 
+@with_execution
 def export_results(
     data_directory,
     start_date = '2015-06-23',
@@ -49,6 +54,7 @@ def export_results(
     multiple_files = False,
     conf_threshold_list = None,
     conf_classes_list = None,
+    execution = None,
     ):
     """
     Writes results in the chosen period, form and using chosen frequency.
@@ -71,6 +77,8 @@ def export_results(
         List of thresholds used as bins to discretize the confidence index into several classes
     conf_classes_list : list
         List of classes names, if conf_threshold_list has n values, conf_classes_list must have n+1 values
+    execution : ExecutionConfig or dict, optional
+        Execution configuration of dask computations (scheduler, workers, chunks, memory budget), as described in fordead.execution.ExecutionConfig. If None, the default threaded scheduler is used. Rasters are imported with chunks of 1280 pixels if chunks are not configured. Defaults to None.
     
     Returns
     -------
@@ -96,25 +104,22 @@ def export_results(
         first_date_number = convert_dateindex_to_datenumber(dieback_data.first_date,dieback_data.state, tile.dates)
     
         if tile.parameters["soil_detection"]:
-            soil_data = import_soil_data(tile.paths, chunks= 1280)
+            soil_data = import_soil_data(tile.paths, chunks = execution.get_chunks(1280))
             first_date_number_soil = convert_dateindex_to_datenumber(soil_data.first_date, soil_data.state, tile.dates)
             
 
-        forest_mask = import_binary_raster(tile.paths["forest_mask"], chunks= 1280)
-        sufficient_coverage_mask = import_binary_raster(tile.paths["sufficient_coverage_mask"], chunks= 1280)
-        if tile.parameters["stress_index_mode"] is not None:
-            too_many_stress_periods_mask = import_binary_raster(tile.paths["too_many_stress_periods_mask"], chunks= 1280)
-            relevant_area = forest_mask & sufficient_coverage_mask & too_many_stress_periods_mask
-        else:
-            relevant_area = forest_mask & sufficient_coverage_mask
+        forest_mask = import_binary_raster(tile.paths["forest_mask"], chunks = execution.get_chunks(1280))
+        #Same active pixels as in the dieback detection
+        relevant_area = import_active_mask(tile.paths, ["forest_mask", "sufficient_coverage_mask"] + (["too_many_stress_periods_mask"] if tile.parameters["stress_index_mode"] is not None else []), 
+                                           chunks = execution.get_chunks(1280))
       
         #EXPORTING STRESS RESULTS
         if tile.parameters["stress_index_mode"] is not None:
             if conf_threshold_list is None or conf_classes_list is None or len(conf_threshold_list) == 0 or len(conf_classes_list) == 0:
                 print("Parameters conf_threshold_list and conf_classes_list are not provided, stress results can't be exported")
             else:
-                stress_index = import_stress_index(tile.paths["stress_index"])
                 stress_data = import_stress_data(tile.paths)
+                stress_index = get_stress_index(tile.paths, stress_data, tile.parameters["stress_index_mode"])
                 stress_list = []
                 for period in range(tile.parameters["max_nb_stress_periods"]):
                     stress_period = stress_index.isel(period = period)
@@ -157,13 +162,13 @@ def export_results(
                     print("Confidence index was not saved, parameters conf_threshold_list and conf_classes_list are ignored. Change stress_index_mode parameter in step 3 to compute confidence index")
                 else:
                     stress_data = import_stress_data(tile.paths)
-                    stress_index = import_stress_index(tile.paths["stress_index"])
+                    stress_index = get_stress_index(tile.paths, stress_data, tile.parameters["stress_index_mode"])
                     confidence_area = relevant_area & dieback_data["state"] & ~soil_data["state"] if tile.parameters["soil_detection"] else relevant_area & dieback_data["state"]
                
                     confidence_index = stress_index.sel(period = (stress_data["nb_periods"]+1).where(stress_data["nb_periods"]<=tile.parameters["max_nb_stress_periods"],tile.parameters["max_nb_stress_periods"])) #The selection probably makes no sense for pixels with nb_periods higher that max_nb_stress_periods, but it doesn't matter since they are excluded from result exports, but it removes bugs of inexistant period values.
                     nb_dates = stress_data["nb_dates"].sel(period = (stress_data["nb_periods"]+1).where(stress_data["nb_periods"]<=tile.parameters["max_nb_stress_periods"],tile.parameters["max_nb_stress_periods"]))  #The selection probably makes no sense for pixels with nb_periods higher that max_nb_stress_periods, but it doesn't matter since they are excluded from result exports, but it removes bugs of inexistant period values.
                    
-                    write_tif(confidence_index.where(confidence_area,0), forest_mask.attrs,nodata = 0, path = tile.paths["confidence_index"])
+                    write_tif(confidence_index.where(confidence_area,0), forest_mask.attrs,nodata = 0, path = tile.paths["confidence_index"], profile = tile.output_profile, quantize = True)
                    
                     confidence_class = vectorizing_confidence_class(confidence_index, nb_dates, confidence_area.compute(), conf_threshold_list, np.array(conf_classes_list), tile.raster_meta["attrs"])
 
@@ -277,7 +282,7 @@ def extract_results(data_directory, points, output_dir=None,
         
     coeff_model = import_coeff_model(tile.paths["coeff_model"],chunks = chunks)
     
-    pred = prediction_vegetation_index(coeff_model,ts.Date.drop_duplicates().to_list()).rename({"Time":"time", "coeff":"band"})
+    pred = prediction_vegetation_index(coeff_model,ts.Date.drop_duplicates().to_list()).rename({"Time":"time"})
     pred.name = "value"
     pred["time"] = pd.to_datetime(pred.time)
     pred["band"] = "predicted_vi"
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Sparse representation of stress periods, as a table with a row for each stress period of each pixel, instead of rasters with a layer for each possible period and change of state.
+During the detection, the dense data only contains the number of stress periods and the sums of the current period of each pixel, and a row is added to the table when a period ends.
+"""
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+STRESS_PERIODS_COLUMNS = {"pixel" : np.int64, "period" : np.uint16, "start_date_index" : np.uint16, "end_date_index" : np.uint16, "cum_diff" : np.float64, "nb_dates" : np.uint16}
+
+def initialize_sparse_stress_data(shape, coords, dtype = float):
+    """
+    Initializes data relating to stress periods, with only the sums of the current stress period of each pixel
+
+    Parameters
+    ----------
+    shape : tuple
+        Tuple with sizes for the resulting array
+    coords : Coordinates attribute of xarray DataArray
+        Coordinates y and x
+    dtype : str or numpy dtype, optional
+        Floating point type of "cum_diff". The default is float.
+
+    Returns
+    -------
+    stress_data : xarray DataSet
+        DataSet containing three DataArrays (y,x), "nb_periods" containing the number of ended stress periods of each pixel,
+        "cum_diff" containing the sum of the difference between the vegetation index and its prediction during the current period, multiplied by the weight if stress_index_mode is "weighted_mean",
+        and "nb_dates" containing the number of valid dates of the current period. All pixels are intitialized at zero.
+    """
+    return xr.Dataset({"nb_periods" : xr.DataArray(np.zeros(shape, dtype = np.uint8), coords = coords),
+                       "cum_diff" : xr.DataArray(np.zeros(shape, dtype = dtype), coords = coords),
+                       "nb_dates" : xr.DataArray(np.zeros(shape, dtype = np.uint16), coords = coords)})
+
+def empty_stress_periods(dtype = np.float64):
+    """
+    Returns a table of stress periods without rows, with the columns "pixel", "period", "start_date_index", "end_date_index", "cum_diff" and "nb_dates"
+    """
+    return pd.DataFrame({column : np.array([], dtype = dtype if column == "cum_diff" else column_dtype) for column, column_dtype in STRESS_PERIODS_COLUMNS.items()})
+
+def ended_periods_table(records, dtype = np.float64):
+    """
+    Gathers the stress periods ended during the detection in a table
+
+    Parameters
+    ----------
+    records : list
+        List of tuples of arrays (pixel, period, start_date_index, end_date_index, cum_diff, nb_dates), as filled by update_dieback_block
+    dtype : str or numpy dtype, optional
+        Floating point type of "cum_diff". The default is np.float64.
+
+    Returns
+    -------
+    pandas DataFrame
+        Table of ended stress periods, with a row for each period of each pixel
+    """
+    if len(records) == 0:
+        return empty_stress_periods(dtype)
+    columns = [np.concatenate(column) for column in zip(*records)]
+    return pd.DataFrame({column : values.astype(dtype if column == "cum_diff" else column_dtype) for (column, column_dtype), values in zip(STRESS_PERIODS_COLUMNS.items(), columns)})
+
+def get_stress_periods(ended_periods, stress_data, dieback_data):
+    """
+    Builds the table of all stress periods, ended periods and current periods of pixels in a stress period or whose sums are not zero. Current periods have an end_date_index of 0, and a start_date_index of 0 if the stress period is not confirmed yet.
+
+    Parameters
+    ----------
+    ended_periods : pandas DataFrame
+        Table of ended stress periods
+    stress_data : xarray DataSet
+        Sparse stress data (y,x), as described in initialize_sparse_stress_data
+    dieback_data : xarray DataSet
+        Dieback data, whose "state" and "first_date" give the start of the current stress period of pixels detected as suffering from dieback
+
+    Returns
+    -------
+    pandas DataFrame
+        Table of stress periods, sorted by pixel and period
+    """
+    state = np.asarray(dieback_data["state"].transpose(..., "y", "x")).reshape(-1)
+    first_date = np.asarray(dieback_data["first_date"].transpose(..., "y", "x")).reshape(-1)
+    nb_periods, cum_diff, nb_dates = [np.asarray(stress_data[name].transpose(..., "y", "x")).reshape(-1) for name in ["nb_periods", "cum_diff", "nb_dates"]]
+    current = np.flatnonzero(state | (nb_dates != 0) | (cum_diff != 0)) #cum_diff != 0 is also True for NaN values
+    current_periods = pd.DataFrame({"pixel" : current.astype(np.int64),
+                                    "period" : nb_periods[current].astype(np.uint16) + 1,
+                                    "start_date_index" : np.where(state[current], first_date[current], 0).astype(np.uint16),
+                                    "end_date_index" : np.zeros(current.size, dtype = np.uint16),
+                                    "cum_diff" : cum_diff[current],
+                                    "nb_dates" : nb_dates[current]})
+    stress_periods = pd.concat([ended_periods.astype(current_periods.dtypes.to_dict()), current_periods], ignore_index = True) if len(ended_periods) > 0 else current_periods
+    return stress_periods.sort_values(["pixel", "period"], ignore_index = True)
+
+def split_stress_periods(stress_periods, nb_periods):
+    """
+    Splits a table of stress periods into the table of ended periods and the sparse stress data used to continue the detection
+
+    Parameters
+    ----------
+    stress_periods : pandas DataFrame
+        Table of stress periods, as returned by get_stress_periods
+    nb_periods : xarray DataArray
+        Number of ended stress periods of each pixel (y,x)
+
+    Returns
+    -------
+    ended_periods : pandas DataFrame
+        Table of ended stress periods
+    stress_data : xarray DataSet
+        Sparse stress data (y,x), as described in initialize_sparse_stress_data
+    """
+    if "band" in nb_periods.dims:
+        nb_periods = nb_periods.squeeze("band")
+    nb_periods = nb_periods.transpose("y", "x").load()
+    current = stress_periods["end_date_index"] == 0
+    stress_data = initialize_sparse_stress_data(nb_periods.shape, nb_periods.coords, dtype = stress_periods["cum_diff"].dtype)
+    stress_data["nb_periods"] = nb_periods.astype(np.uint8)
+    for name in ["cum_diff", "nb_dates"]:
+        stress_data[name].values.reshape(-1)[stress_periods["pixel"][current].values] = stress_periods[name][current].values
+    return stress_periods[~current].reset_index(drop = True), stress_data
+
+def stress_periods_to_dense(stress_periods, nb_periods, max_nb_stress_periods):
+    """
+    Converts a table of stress periods to dense stress data, with a layer for each possible period and change of state, identical to the stress data computed with dense storage
+
+    Parameters
+    ----------
+    stress_periods : pandas DataFrame
+        Table of stress periods, as returned by get_stress_periods
+    nb_periods : xarray DataArray
+        Number of ended stress periods of each pixel (y,x)
+    max_nb_stress_periods : int
+        Maximum number of stress periods. Periods after the (max_nb_stress_periods+1)th are not included, as in dense stress data.
+
+    Returns
+    -------
+    stress_data : xarray DataSet
+        DataSet containing four DataArrays, "date" (change,y,x) containing the date index of each pixel state change, "nb_periods" containing the total number of stress periods detected for each pixel,
+        "cum_diff" (period,y,x) containing for each stress period the sum of the difference between the vegetation index and its prediction, multiplied by the weight if stress_index_mode is "weighted_mean", and "nb_dates" (period,y,x) containing the number of valid dates of each stress period.
+    """
+    if "band" in nb_periods.dims:
+        nb_periods = nb_periods.squeeze("band")
+    nb_periods = nb_periods.transpose("y", "x")
+    nb_layers = max_nb_stress_periods + 1
+    date = np.zeros((nb_layers*2 - 1,) + nb_periods.shape, dtype = np.uint16)
+    cum_diff = np.zeros((nb_layers,) + nb_periods.shape, dtype = stress_periods["cum_diff"].dtype)
+    nb_dates = np.zeros((nb_layers,) + nb_periods.shape, dtype = np.uint16)
+
+    stored = stress_periods[stress_periods["period"] <= nb_layers]
+    pixels, periods = stored["pixel"].values, stored["period"].values.astype(np.intp)
+    date.reshape(date.shape[0], -1)[2*periods - 2, pixels] = stored["start_date_index"].values
+    ends = periods < nb_layers #The end of the last period is not stored
+    date.reshape(date.shape[0], -1)[2*periods[ends] - 1, pixels[ends]] = stored["end_date_index"].values[ends]
+    cum_diff.reshape(nb_layers, -1)[periods - 1, pixels] = stored["cum_diff"].values
+    nb_dates.reshape(nb_layers, -1)[periods - 1, pixels] = stored["nb_dates"].values
+
+    coords = nb_periods.coords
+    return xr.Dataset({"date" : xr.DataArray(date, coords = {"change" : range(1, date.shape[0] + 1), **coords}, dims = ["change", "y", "x"]),
+                       "nb_periods" : nb_periods,
+                       "cum_diff" : xr.DataArray(cum_diff, coords = {"period" : range(1, nb_layers + 1), **coords}, dims = ["period", "y", "x"]),
+                       "nb_dates" : xr.DataArray(nb_dates, coords = {"period" : range(1, nb_layers + 1), **coords}, dims = ["period", "y", "x"])})
+
+def compute_stress_index(stress_data, stress_index_mode):
+    """
+    Computes the stress index of each stress period
+
+    Parameters
+    ----------
+    stress_data : xarray DataSet
+        Dense stress data, as returned by stress_periods_to_dense or import_stress_data
+    stress_index_mode : str
+        Chosen stress index, if 'mean', the index is the mean of the difference between the vegetation index and its prediction, if 'weighted_mean', the index is a weighted mean, where the weight of each date is its number from the first anomaly.
+
+    Returns
+    -------
+    stress_index : xarray DataArray
+        Stress index of each stress period, with the type of "cum_diff"
+    """
+    if stress_index_mode == "mean":
+        stress_index = stress_data["cum_diff"]/stress_data["nb_dates"]
+    elif stress_index_mode == "weighted_mean":
+        stress_index = stress_data["cum_diff"]/(stress_data["nb_dates"]*(stress_data["nb_dates"]+1)/2)
+    else:
+        raise Exception("Unrecognized stress_index_mode")
+    return stress_index.astype(stress_data["cum_diff"].dtype) #The number of dates would promote it to float64
@@ -18,6 +18,10 @@ from fordead.cli.utils import empty_to_none
               help = "List of tiles from which to extract reflectance (ex : -t T31UFQ -t T31UGQ). If None, all tiles are extracted.")
 @click.option("--sentinel_source", type = click.Choice(["theia", "scihub", "peps"], case_sensitive=False),
               default = "theia", help = "Source of data, can be 'theia' et 'scihub' et 'peps'", show_default=True)
+@click.option("--decimation", type = int, default = 4,
+              help = "Decimation factor of the reads, set to 1 to compute cloudiness exactly from full resolution rasters", show_default=True)
+@click.option("--n_workers", type = int, default = 1,
+              help = "Number of threads used to compute cloudiness of several dates in parallel", show_default=True)
 def cli_extract_cloudiness(**kwargs):
     """
     
@@ -28,12 +32,13 @@ def cli_extract_cloudiness(**kwargs):
     extract_cloudiness(**kwargs)
 
 
-def extract_cloudiness(sentinel_dir, export_path, tile_selection = None, sentinel_source = "theia"):
+def extract_cloudiness(sentinel_dir, export_path, tile_selection = None, sentinel_source = "theia", decimation = 4, n_workers = 1):
     """
     
     For each acquisition, extracts percentage of pixels in the mask provided by the Sentinel-2 data provider.
     For THEIA, all pixels different of 0 in the CLM mask are considered cloudy
     For Scihub and PEPS, all pixels different of [4, 5] in the SCL mask are considered cloudy
+    Cloudiness is stored in an index "cloudiness.sqlite" in each tile directory, so it is only computed for new or modified acquisitions.
     The results are exported in a csv file, with the columns "area_name", "Date" and "cloudiness", containing the name of the Sentinel-2 tile, the date of acquisition, and the percentage of cloudy pixels.
  
     Parameters
@@ -46,6 +51,10 @@ def extract_cloudiness(sentinel_dir, export_path, tile_selection = None, sentine
         List of tiles from which to extract reflectance (ex : ["T31UFQ", "T31UGQ"]). If None, all tiles are extracted.
     sentinel_source : str
         Source of data, can be 'theia' et 'scihub' et 'peps'
+    decimation : int
+        Decimation factor of the reads, rasters are read with their size divided by this factor, using overviews if they exist. If 1, cloudiness is computed exactly from full resolution rasters.
+    n_workers : int
+        Number of threads used to compute cloudiness of several dates in parallel
     """
     
     sentinel_dir = Path(sentinel_dir)
@@ -65,7 +74,7 @@ def extract_cloudiness(sentinel_dir, export_path, tile_selection = None, sentine
             if len(tile.paths["Sentinel"]) >= 1:
                 area_name = directory.stem
                 # dict_example_raster[directory.stem] = list(list(tile.paths["Sentinel"].values())[0].values())[0]
-                cloudiness = get_cloudiness(sentinel_dir / area_name / "cloudiness", tile.paths["Sentinel"], sentinel_source) #Returns dictionnary with cloud percentage for each date, except if lim_perc_cloud is set as 1, in which case cloud percentage is -1 for every date so source mask is not used and every date is used 
+                cloudiness = get_cloudiness(sentinel_dir / area_name / "cloudiness", tile.paths["Sentinel"], sentinel_source, decimation = decimation, n_workers = n_workers) #Returns dictionnary with cloud percentage for each date, except if lim_perc_cloud is set as 1, in which case cloud percentage is -1 for every date so source mask is not used and every date is used 
         
                 area_cloudiness = pd.DataFrame.from_dict({"area_name" : len(cloudiness)*[area_name], "Date" : cloudiness.keys(), "cloudiness" : cloudiness.values()})
                 cloudiness_list += [area_cloudiness]
@@ -13,7 +13,7 @@ import ast
 from scipy.linalg import lstsq
 import inspect
 
-from fordead.masking_vi import compute_vegetation_index, get_dict_vi
+from fordead.masking_vi import compute_vegetation_index, get_vi_registry
 
 
 def filter_args(func,param_dict,combs):
@@ -299,14 +299,14 @@ def prediction_vegetation_index_dataframe(masked_vi, pixel_info, name_column):
                                 
 def detection_anomalies_dataframe(data_frame, threshold_anomaly, vi, path_dict_vi):
     
-    dict_vi = get_dict_vi(path_dict_vi)
+    dieback_change_direction = get_vi_registry(path_dict_vi)[vi].dieback_change_direction
     
-    if dict_vi[vi]["dieback_change_direction"] == "+":
+    if dieback_change_direction == "+":
         diff_vi = data_frame["vi"] - data_frame["predicted_vi"]
-    elif dict_vi[vi]["dieback_change_direction"] == "-":
+    elif dieback_change_direction == "-":
         diff_vi = data_frame["predicted_vi"] - data_frame["vi"]
     else:
-        raise Exception("Unrecognized dieback_change_direction in " + path_dict_vi + " for vegetation index " + vi)
+        raise Exception("Unrecognized dieback_change_direction in " + str(path_dict_vi) + " for vegetation index " + vi)
     
     anomalies = diff_vi > threshold_anomaly
     
@@ -11,7 +11,7 @@ from rasterio import Affine, transform
 import dask.array as da
 
 from fordead.import_data import TileInfo, import_stackedmaskedVI, import_stress_data, import_stacked_anomalies, import_coeff_model, import_binary_raster, import_first_detection_date_index, import_dieback_data, import_soil_data
-from fordead.model_vegetation_index import compute_HarmonicTerms
+from fordead.model_vegetation_index import get_harmonic_terms
 from fordead.results_visualisation import select_and_plot_time_series
 
 import warnings
@@ -110,7 +110,7 @@ def vi_series_visualisation(data_directory, x= None, y = None, shape_path = None
     dieback_data = import_dieback_data(tile.paths,chunks = chunks)
     forest_mask = import_binary_raster(tile.paths["forest_mask"],chunks = chunks)
     tile.getdict_datepaths("Anomalies",tile.paths["AnomaliesDir"])
-    anomalies = import_stacked_anomalies(tile.paths["Anomalies"],chunks = chunks)
+    anomalies = import_stacked_anomalies(tile.paths["Anomalies"],chunks = chunks, bitplanes_path = tile.paths.get("anomaly_bitplanes"))
     
     tile.add_dirpath("series", tile.data_directory / "TimeSeries")
     tile.save_info()
@@ -119,7 +119,7 @@ def vi_series_visualisation(data_directory, x= None, y = None, shape_path = None
     # xxDate = [date for date in xxDate if tile.parameters["ignored_period"] is None or (date.astype(str)[5:] > min(tile.parameters["ignored_period"]) and date.astype(str)[5:] < max(tile.parameters["ignored_period"]))]
     # xx = np.array([(date - np.datetime64(datetime.datetime.strptime("2015-01-01", '%Y-%m-%d').date())).astype(int) for date in xxDate])
     
-    harmonic_terms = np.array([compute_HarmonicTerms(DateAsNumber) for DateAsNumber in xx])
+    harmonic_terms = get_harmonic_terms([str(date) for date in xxDate])
     harmonic_terms = xr.DataArray(harmonic_terms, coords={"Time" : xxDate, "coeff" : [1,2,3,4,5]},dims=["Time","coeff"])
     
     if tile.parameters["correct_vi"]:
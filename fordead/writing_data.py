@@ -7,31 +7,151 @@ import datetime
 import numpy as np
 import xarray as xr
 import rasterio
+import rasterio.shutil
 from affine import Affine
 import geopandas as gp
 import dask.array as da
+from xarray.conventions import encode_cf_variable
 from fordead.model_vegetation_index import prediction_vegetation_index
 from fordead.masking_vi import get_dict_vi
 from scipy import ndimage
 import json
-from fordead.import_data import import_stress_index, import_coeff_model, import_dieback_data, import_masked_vi, import_first_detection_date_index, TileInfo, import_binary_raster, import_soil_data,import_resampled_sen_stack, import_stress_data
+import os
+import tempfile
+import threading
+import time
+import queue
+from pathlib import Path
+from contextlib import contextmanager
+from fordead.import_data import import_stress_index, import_coeff_model, import_dieback_data, import_masked_vi, import_first_detection_date_index, TileInfo, import_binary_raster, import_soil_data,import_resampled_sen_stack, import_stress_data, get_cube_dates
+
+_UMASK = os.umask(0) #Read once, as changing it while files are written by other threads is unsafe
+os.umask(_UMASK)
+
+@contextmanager
+def atomic_path(path):
+    """
+    Yields a temporary path in the same directory as path, with the same extension, which replaces path once the block is exited without error. 
+    The temporary file is hidden and removed if an error occurs, so a file is never left half-written. 
+    The written file is given the permissions of a file created with open, as the temporary file is only readable by its owner.
 
-def write_raster(data_array, path, compress_vi):
-        
+    Parameters
+    ----------
+    path : str
+        Path of the file to write
+
+    Yields
+    ------
+    str
+        Temporary path to which the file must be written
+
+    """
+    path = Path(path)
+    file_descriptor, temporary_path = tempfile.mkstemp(dir = path.parent, prefix = "." + path.stem + "_", suffix = path.suffix)
+    os.close(file_descriptor)
+    try:
+        yield temporary_path
+        os.chmod(temporary_path, 0o666 & ~_UMASK)
+        os.replace(temporary_path, path)
+    except BaseException:
+        Path(temporary_path).unlink(missing_ok = True)
+        raise
+
+def get_profile_args(profile, dtype, nbits = None):
+    """
+    Converts an output profile into the arguments of rio.to_raster used to write GeoTIFF files
+
+    Parameters
+    ----------
+    profile : dict
+        Output profile, with the optional keys "codec" (None, "DEFLATE", "ZSTD", "LZW" or "LERC"), "predictor" (1 for no predictor, 2 for horizontal differencing, 3 for floating point, or None to choose from the data type), 
+        "blocksize" (size of the internal tiles, or None for the GDAL default), "overviews" (if True, the file is written as a Cloud-Optimized GeoTIFF with internal overviews) and "quantize" (used by prepare_tif).
+        If None, files are tiled GeoTIFF files without compression.
+    dtype : numpy dtype
+        Data type of the written data
+    nbits : int, optional
+        Number of bits per pixel if it is not the size of the data type. The default is None.
+
+    Returns
+    -------
+    args : dict
+        Arguments passed to rio.to_raster
+
+    """
+    if profile is None:
+        return {"tiled" : True}
+    cog = profile.get("overviews", False)
+    args = {"driver" : "COG", "overviews" : "AUTO", "resampling" : "AVERAGE" if np.issubdtype(dtype, np.floating) else "NEAREST"} if cog else {"tiled" : True}
+    if profile.get("blocksize") is not None:
+        if cog:
+            args["blocksize"] = profile["blocksize"]
+        else:
+            args["blockxsize"] = args["blockysize"] = profile["blocksize"]
+    if profile.get("codec") is not None:
+        args["compress"] = profile["codec"]
+        predictor = profile.get("predictor")
+        if predictor is None:
+            predictor = 1 if profile["codec"] == "LERC" else (3 if np.issubdtype(dtype, np.floating) else 2)
+        if nbits is None and predictor != 1: #Predictors are not supported for 1 bit data
+            args["predictor"] = {2 : "STANDARD", 3 : "FLOATING_POINT"}[predictor] if cog else predictor
+    return args
+
+def write_raster(data_array, path, compress_vi, profile = None):
+    """
+    Writes raster to the disk, with the vegetation index stored as small integers if compress_vi is True
+
+    Parameters
+    ----------
+    data_array : xarray DataArray
+        Object to be written
+    path : str
+        Path of the file to which data will be written
+    compress_vi : bool
+        If True, data is stored as small integers with a 0.001 scale factor
+    profile : dict, optional
+        Output profile applied to GeoTIFF files, as described in get_profile_args. Not used for other formats. The default is None.
+
+    """
     # dem = data_array.to_dataset(name="dem")
     # encoding = {"dem": {'zlib': True, "dtype" : "int16", "scale_factor" : 0.001, "_FillValue" : 0}}
     # dem.to_netcdf(path, encoding=encoding)
+    data_array, args = prepare_raster(data_array, path, compress_vi, profile)
+    with atomic_path(path) as temporary_path:
+        data_array.rio.to_raster(temporary_path, windowed = False, **args)
+
+def prepare_raster(data_array, path, compress_vi, profile = None):
+    """
+    Sets the encoding and writing arguments used by write_raster
+
+    Parameters
+    ----------
+    data_array : xarray DataArray
+        Object to be written
+    path : str
+        Path of the file to which data will be written
+    compress_vi : bool
+        If True, data is stored as small integers with a 0.001 scale factor
+    profile : dict, optional
+        Output profile applied to GeoTIFF files, as described in get_profile_args. Not used for other formats. The default is None.
+
+    Returns
+    -------
+    data_array : xarray DataArray
+        Object to be written, with updated encoding
+    args : dict
+        Arguments passed to rio.to_raster
+
+    """
     if compress_vi:
         data_array.encoding["dtype"]="int16"
         data_array.encoding["scale_factor"]=0.001
         data_array.encoding["_FillValue"]=-1
     if str(path).endswith(".nc"):
-        tiled = False
+        return data_array, {"tiled" : False}
     else:
-        tiled = True
-    data_array.rio.to_raster(path, windowed = False, tiled = tiled)
+        return data_array, get_profile_args(profile, data_array.encoding.get("dtype", data_array.dtype))
 
-def write_tif(data_array, attributes, path, nodata = None):
+def write_tif(data_array, attributes, path, nodata = None, profile = None, quantize = False):
     """
     Writes raster to the disk
 
@@ -45,13 +165,47 @@ def write_tif(data_array, attributes, path, nodata = None):
         Path of the file to which data will be written
     nodata : int or float, optional
         Number used as nodata. If None, the nodata attribute of the object will be kept. The default is None.
+    profile : dict, optional
+        Output profile, as described in get_profile_args. If None, the file is tiled without compression. The default is None.
+    quantize : bool, optional
+        If True and the "quantize" key of the profile is True, data is stored as small integers with a 0.001 scale factor. Used for indices which do not need more precision. 
+        Values outside of the representable range, from -32.767 to 32.767, are clipped to this range. The default is False.
 
     Returns
     -------
     None.
 
     """
+    data_array, args = prepare_tif(data_array, attributes, nodata, profile, quantize)
+    with atomic_path(path) as temporary_path:
+        data_array.rio.to_raster(temporary_path,windowed = False, **args)
+
+def prepare_tif(data_array, attributes, nodata = None, profile = None, quantize = False):
+    """
+    Sets the attributes, data type and writing arguments used by write_tif
 
+    Parameters
+    ----------
+    data_array : xarray DataArray
+        Object to be written
+    attributes : dict
+        Dictionnary containing attributes used to write the data_array ("crs","nodata","scales","offsets")
+    nodata : int or float, optional
+        Number used as nodata. If None, the nodata attribute of the object will be kept. The default is None.
+    profile : dict, optional
+        Output profile, as described in get_profile_args. The default is None.
+    quantize : bool, optional
+        If True and the "quantize" key of the profile is True, data is stored as small integers with a 0.001 scale factor, with NaN values stored as the nodata value -32768. 
+        Values outside of the representable range, from -32.767 to 32.767, are clipped to this range instead of wrapping around. The default is False.
+
+    Returns
+    -------
+    data_array : xarray DataArray
+        Object to be written, with updated attributes and data type
+    args : dict
+        Arguments passed to rio.to_raster
+
+    """
         
     data_array.attrs=attributes
     # data_array.rio.crs=data_array.crs.replace("+init=","") #Remove "+init=" which it deprecated
@@ -74,8 +228,295 @@ def write_tif(data_array, attributes, path, nodata = None):
     # data_array.attrs["nodatavals"]=(0,)
     # data_array.attrs["scales"]=(0,)
     # data_array.attrs["offsets"]=(0,)
+    
+    dtype = data_array.dtype
+    if quantize and profile is not None and profile.get("quantize", False):
+        #Replaced by the encoding, NaN values are stored as the lowest integer so they are distinct from values rounded to 0
+        attrs, encoding = data_array.attrs, dict(data_array.encoding)
+        limit = np.iinfo(np.int16).max*0.001
+        data_array = data_array.clip(-limit, limit) #Out of range values would wrap around, NaN values are kept
+        data_array.attrs = {key : value for key, value in attrs.items() if key not in ["scale_factor", "add_offset", "_FillValue", "nodata"]}
+        data_array.encoding = encoding
+        data_array.encoding.update({"dtype" : "int16", "scale_factor" : 0.001, "_FillValue" : np.iinfo(np.int16).min})
+        dtype = "int16"
+    if profile is not None and profile.get("codec") == "LERC":
+        args.pop("nbits", None) #LERC does not support 1 bit data
+    args.update(get_profile_args(profile, dtype, args.get("nbits")))
+
+    return data_array, args
+
+class WindowWriter():
+    """
+    Writes a single band raster window by window, so the whole raster never has to be held in memory.
+    The file is created with the same metadata as write_raster would use (or write_tif if attributes are given) for the whole raster.
+    """
+    def __init__(self, template, path, compress_vi = False, attributes = None, nodata = None, profile = None):
+        """
+        Creates the raster file and opens it for writing. If the profile requires a Cloud-Optimized GeoTIFF, a tiled GeoTIFF is written and converted when the writer is closed.
+
+        Parameters
+        ----------
+        template : xarray DataArray
+            2D DataArray with the coordinates, data type and attributes of the whole raster. Its data is not written, so it can be a lazy dask array.
+        path : str
+            Path of the file to which data will be written
+        compress_vi : bool, optional
+            Used as in write_raster if attributes is None. The default is False.
+        attributes : dict, optional
+            If given, the file is written as with write_tif with these attributes. The default is None.
+        nodata : int or float, optional
+            Used as in write_tif if attributes are given. The default is None.
+        profile : dict, optional
+            Output profile, as described in get_profile_args. The default is None.
+
+        """
+        if attributes is None:
+            template, args = prepare_raster(template, path, compress_vi, profile)
+        else:
+            template, args = prepare_tif(template, attributes, nodata, profile)
+        if not isinstance(template.data, da.Array):
+            template = template.chunk()
+        self.atomic_path = atomic_path(path) #The file is written in a temporary file which replaces path when the writer is closed
+        self.temporary_path = self.atomic_path.__enter__()
+        self.cog_args = None
+        if args.get("driver") == "COG": #COG files can't be written window by window
+            self.cog_args = {key : value for key, value in args.items() if key != "driver"}
+            args = {"tiled" : True, **({"nbits" : args["nbits"]} if "nbits" in args else {})}
+            self.writing_path = self.temporary_path + ".gtiff.tif"
+        else:
+            self.writing_path = self.temporary_path
+        template.rio.to_raster(self.writing_path, windowed = False, lock = True, compute = False, **args) #Only creates the file and writes metadata
+        self.encoding = template.encoding
+        self.dataset = rasterio.open(self.writing_path, "r+")
+        
+    def write(self, data_array, window):
+        """
+        Writes a window of the raster
+
+        Parameters
+        ----------
+        data_array : xarray DataArray
+            2D DataArray containing the data of the window
+        window : rasterio.windows.Window
+            Window of the raster to write
+
+        """
+        if data_array.dtype==bool:
+            data_array=data_array.astype(uint8)
+        data_array = data_array.copy()
+        data_array.attrs = {}
+        data_array.encoding = self.encoding
+        data = encode_cf_variable(data_array.variable).values.astype(self.dataset.dtypes[0])
+        self.dataset.write(data, 1, window = window)
+        
+    def close(self):
+        self.dataset.close()
+        if self.cog_args is not None:
+            rasterio.shutil.copy(self.writing_path, self.temporary_path, driver = "COG", **self.cog_args)
+            Path(self.writing_path).unlink()
+        self.atomic_path.__exit__(None, None, None)
+
+class CheckpointSchedule():
+    """
+    Decides when the state of a step is saved during its computation, every nb_dates computed dates or every minutes minutes.
+    """
+    
+    def __init__(self, nb_dates = None, minutes = None):
+        """
+        Parameters
+        ----------
+        nb_dates : int, optional
+            Number of computed dates between two checkpoints. If None or 0, checkpoints are not saved depending on the number of dates. The default is None.
+        minutes : float, optional
+            Number of minutes between two checkpoints. If None or 0, checkpoints are not saved depending on time. The default is None.
+
+        """
+        self.nb_dates = nb_dates
+        self.minutes = minutes
+        self.reset()
+    
+    def reset(self):
+        self.count = 0
+        self.start = time.monotonic()
+    
+    def due(self):
+        """
+        Counts a computed date, and returns True if a checkpoint must be saved. Counters are then reset.
+        """
+        self.count += 1
+        if (self.nb_dates and self.count >= self.nb_dates) or (self.minutes and time.monotonic() - self.start >= 60*self.minutes):
+            self.reset()
+            return True
+        return False
+
+def write_stress_periods(stress_periods, path, max_nb_stress_periods):
+    """
+    Writes the table of stress periods to a Parquet file
 
-    data_array.rio.to_raster(path,windowed = False, **args, tiled = True)
+    Parameters
+    ----------
+    stress_periods : pandas DataFrame
+        Table of stress periods, as returned by fordead.stress_periods.get_stress_periods
+    path : str
+        Path of the Parquet file
+    max_nb_stress_periods : int
+        Maximum number of stress periods, stored in the metadata of the file so dense stress data can be computed from the table.
+
+    Returns
+    -------
+    None.
+
+    """
+    stress_periods = stress_periods.copy(deep = False)
+    stress_periods.attrs["max_nb_stress_periods"] = int(max_nb_stress_periods)
+    with atomic_path(path) as temporary_path:
+        stress_periods.to_parquet(temporary_path, index = False)
+
+class RasterWriter():
+    """
+    Writes rasters in background threads, so computation loops can go on while finished arrays are compressed and written.
+    Writes are queued in a bounded queue, so the number of arrays waiting to be written, and the memory they use, is limited.
+    Each file is written atomically. Errors raised while writing are raised again by the following call to submit, flush or close.
+    """
+    def __init__(self, n_threads = 1, queue_size = 4):
+        """
+        Starts the writing threads.
+
+        Parameters
+        ----------
+        n_threads : int, optional
+            Number of threads writing files. The default is 1.
+        queue_size : int, optional
+            Maximum number of writes waiting in the queue, after which submitting a write blocks until a thread is available. The default is 4.
+
+        """
+        self.queue = queue.Queue(maxsize = queue_size)
+        self.errors = []
+        self.threads = [threading.Thread(target = self._work, daemon = True) for thread_index in range(n_threads)]
+        for thread in self.threads:
+            thread.start()
+    
+    def _work(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                self.queue.task_done()
+                return
+            function, args, kwargs = task
+            try:
+                function(*args, **kwargs)
+            except Exception as error:
+                self.errors.append(error)
+            finally:
+                self.queue.task_done()
+    
+    def _raise_errors(self):
+        if len(self.errors) > 0:
+            raise self.errors.pop(0)
+    
+    def submit(self, function, *args, **kwargs):
+        """
+        Queues a call to a writing function. The arrays given must not be modified afterwards.
+
+        Parameters
+        ----------
+        function : function
+            Function writing data
+        *args, **kwargs
+            Arguments of the function
+
+        """
+        self._raise_errors()
+        self.queue.put((function, args, kwargs))
+    
+    def write_tif(self, data_array, attributes, path, nodata = None, profile = None, quantize = False):
+        """
+        Queues the writing of a raster with write_tif.
+        """
+        self.submit(write_tif, data_array.copy(deep = False), attributes, path, nodata, profile, quantize)
+    
+    def write_raster(self, data_array, path, compress_vi, profile = None):
+        """
+        Queues the writing of a raster with write_raster.
+        """
+        self.submit(write_raster, data_array.copy(deep = False), path, compress_vi, profile)
+    
+    def flush(self):
+        """
+        Waits until all queued files are written.
+        """
+        self.queue.join()
+        self._raise_errors()
+    
+    def close(self):
+        """
+        Waits until all queued files are written, then stops the threads.
+        """
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self._raise_errors()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.close()
+        except Exception:
+            if exc_type is None: #Errors of the writing threads are not raised over an error of the calling code
+                raise
+
+def write_cube_date(path, date, vegetation_index, mask, chunks = 512, time_chunks = 16, compress_vi = False):
+    """
+    Appends the vegetation index and mask of a date to a time-stacked cube (requires zarr). The cube is created if it does not exist, with the given chunks.
+    Dates must be appended in chronological order. If the date is already in the cube, its data is overwritten.
+
+    Parameters
+    ----------
+    path : str
+        Path of the cube
+    date : str
+        Date in the format "YYYY-MM-DD"
+    vegetation_index : xarray DataArray
+        2D DataArray containing the vegetation index, with coordinates y and x and a CRS
+    mask : xarray DataArray or numpy array
+        2D array containing the mask, with the same shape as vegetation_index. A DataArray backed by a dask array, such as a raster opened with chunks, is written without being loaded in memory.
+    chunks : int, optional
+        Size of the chunks of the cube along x and y, only used when the cube is created. The default is 512.
+    time_chunks : int, optional
+        Size of the chunks of the cube along the Time dimension, only used when the cube is created. The default is 16.
+    compress_vi : bool, optional
+        If True, the vegetation index is stored as small integers with a 0.001 scale factor, only used when the cube is created. The default is False.
+
+    """
+    vegetation_index = vegetation_index.squeeze(drop = True) if "band" in vegetation_index.dims else vegetation_index
+    crs = vegetation_index.rio.crs
+    vegetation_index = vegetation_index.drop_vars([coord for coord in vegetation_index.coords if coord not in ["x","y"]])
+    vegetation_index.attrs, vegetation_index.encoding = {}, {}
+    mask = mask.squeeze(drop = True).data if isinstance(mask, xr.DataArray) else mask
+    cube_date = xr.Dataset({"vegetation_index" : vegetation_index, 
+                            "mask" : vegetation_index.copy(data = mask.astype(bool) if isinstance(mask, da.Array) else np.asarray(mask, dtype = bool))}).rio.write_crs(crs)
+    cube_date = cube_date.expand_dims(Time = [np.datetime64(date, "ns")])
+    
+    existing_dates = get_cube_dates(path)
+    if len(existing_dates) == 0:
+        encoding = {var : {"chunks" : (time_chunks, chunks, chunks)} for var in ["vegetation_index", "mask"]}
+        if compress_vi:
+            encoding["vegetation_index"].update({"dtype" : "int16", "scale_factor" : 0.001, "_FillValue" : -1})
+        cube_date.chunk({"Time" : 1, "y" : chunks, "x" : chunks}).to_zarr(path, mode = "w", encoding = encoding, consolidated = False)
+    else:
+        time_chunks, y_chunks, x_chunks = xr.open_zarr(path, consolidated = False)["mask"].encoding["chunks"]
+        cube_date = cube_date.chunk({"Time" : 1, "y" : y_chunks, "x" : x_chunks})
+        if date in existing_dates:
+            time_index = existing_dates.index(date)
+            #Dask chunks are aligned with the chunks of the cube along x and y, so each chunk of the cube is written by a single task even if the date is only part of a chunk along Time
+            cube_date.drop_vars("spatial_ref").to_zarr(path, region = {"Time" : slice(time_index, time_index + 1), "y" : slice(None), "x" : slice(None)}, consolidated = False, safe_chunks = False)
+        elif date < existing_dates[-1]:
+            raise ValueError("Date " + date + " is anterior to the last date of the cube " + existing_dates[-1] + ", dates can only be appended in chronological order")
+        else:
+            cube_date.to_zarr(path, append_dim = "Time", consolidated = False)
 
 
 
@@ -0,0 +1,41 @@
+import numpy as np
+import xarray as xr
+from fordead.import_data import initialize_dieback_data, initialize_stress_data
+from fordead.dieback_detection import detection_dieback, save_stress, DiebackBatch
+
+def random_dates(nb_dates, shape, coords, seed = 0):
+    """
+    Random anomalies, masks and differences between the vegetation index and its prediction, with a probability of anomaly varying between pixels so dieback is detected and ended.
+    """
+    rng = np.random.default_rng(seed)
+    probability = rng.random(shape)
+    for date_index in range(nb_dates):
+        anomalies = xr.DataArray(rng.random(shape) < probability, coords = coords, dims = ["y","x"])
+        mask = xr.DataArray(rng.random((1,) + shape) < 0.2, coords = {"band" : [1], **coords}, dims = ["band","y","x"])
+        diff_vi = xr.DataArray(rng.standard_normal(shape).astype(np.float32), coords = coords, dims = ["y","x"]).where(~mask.squeeze("band"), 0)
+        yield anomalies, mask, diff_vi, date_index + 3
+
+def test_dieback_batch():
+    """
+    Checks that dieback and stress data updated by batches of 1, 2 and all dates are identical to those updated date by date with detection_dieback and save_stress.
+    """
+    nb_dates, shape = 40, (37, 23)
+    coords = {"y" : np.arange(shape[0]), "x" : np.arange(shape[1])}
+    for stress_index_mode in ["mean", "weighted_mean"]:
+        dieback_data = initialize_dieback_data(shape, coords)
+        stress_data = initialize_stress_data(shape, coords, 2, dtype = "float32")
+        batches = {batch_size : DiebackBatch(dieback_data, stress_data, stress_index_mode, batch_size) for batch_size in [1, 2, nb_dates]}
+        for anomalies, mask, diff_vi, date_index in random_dates(nb_dates, shape, coords):
+            dieback_data, changing_pixels = detection_dieback(dieback_data, anomalies, mask, date_index)
+            stress_data = save_stress(stress_data, dieback_data, changing_pixels, diff_vi, mask, stress_index_mode)
+            for batch in batches.values():
+                batch.add(anomalies, mask, diff_vi, date_index)
+
+        assert int(stress_data["nb_periods"].max()) > 0
+        for batch_size, batch in batches.items():
+            batch_dieback_data, batch_stress_data = batch.result()
+            for var in dieback_data:
+                assert np.array_equal(dieback_data[var].values.squeeze(), batch_dieback_data[var].values), (batch_size, var)
+            for var in stress_data:
+                expected = stress_data[var].transpose("y", "x", ...).values
+                assert expected.dtype == batch_stress_data[var].dtype and np.array_equal(expected, batch_stress_data[var].values, equal_nan = True), (batch_size, var)
@@ -0,0 +1,25 @@
+import numpy as np
+import xarray as xr
+from fordead.masking_vi import compute_pre_masks_fused, get_pre_masks, detect_cloud_candidates
+
+def test_compute_pre_masks_fused():
+    """
+    Checks that the masks computed by compute_pre_masks_fused are identical to those of get_pre_masks and detect_cloud_candidates, 
+    on random bands including zeros, negative values, pixels outside swath and null sums of reflectances.
+    """
+    rng = np.random.default_rng(0)
+    bands = ["B2", "B3", "B4", "B8A", "B11", "B8"]
+    stack = rng.integers(-50, 1600, size = (len(bands), 45, 31)).astype(np.int16)
+    stack[rng.random(stack.shape) < 0.05] = 0
+    stack[:, rng.random(stack.shape[1:]) < 0.05] = -10000
+    stack[1:4, :3, :3] = 0 #B3 + B4 + B8A is null
+    stack_bands = xr.DataArray(stack, coords = {"band" : bands}, dims = ["band", "y", "x"])
+    
+    soil_anomaly, shadows, outside_swath, invalid = get_pre_masks(stack_bands)
+    cloud_candidates = detect_cloud_candidates(stack_bands)
+    for block_rows in [7, 256]:
+        mask, soil_inputs = compute_pre_masks_fused(stack, bands, block_rows = block_rows)
+        assert np.array_equal(mask, (shadows | outside_swath | soil_anomaly.astype(bool)).values)
+        for soil_input, expected in zip(soil_inputs, [soil_anomaly, invalid, cloud_candidates]):
+            assert np.array_equal(soil_input, expected.values.astype(bool))
+    assert mask.any() and not mask.all() and all(soil_input.any() and not soil_input.all() for soil_input in soil_inputs)
@@ -0,0 +1,28 @@
+import numpy as np
+from fordead.model_vegetation_index import censored_lstsq, get_harmonic_terms
+
+def test_censored_lstsq():
+    """
+    Checks that the model of each pixel solved from the normal equations, and its condition number, are those of np.linalg.lstsq on the valid dates of the pixel.
+    Pixels with too few valid dates have no model.
+    """
+    rng = np.random.default_rng(0)
+    dates = [str(np.datetime64("2016-01-01") + int(day)) for day in np.sort(rng.choice(900, size = 30, replace = False))]
+    harmonic_terms = get_harmonic_terms(dates)
+    vegetation_index = rng.random((30, 7, 9))
+    valid = rng.random((30, 7, 9)) < 0.6
+    valid[:, 0, 0] = False
+    valid[:4, 0, 0] = True #Not enough valid dates
+
+    coeff, condition = censored_lstsq(vegetation_index, valid, harmonic_terms, return_condition = True)
+    assert coeff.shape == (5, 7, 9) and condition.shape == (7, 9)
+    assert np.isnan(coeff[:, 0, 0]).all() and np.isnan(condition[0, 0])
+    for row in range(7):
+        for col in range(9):
+            if (row, col) == (0, 0):
+                continue
+            pixel_valid = valid[:, row, col]
+            expected = np.linalg.lstsq(harmonic_terms[pixel_valid], vegetation_index[pixel_valid, row, col], rcond = None)[0]
+            assert np.allclose(coeff[:, row, col], expected, rtol = 1e-6, atol = 1e-8)
+            normal_matrix = harmonic_terms[pixel_valid].T @ harmonic_terms[pixel_valid]
+            assert np.isclose(condition[row, col], np.linalg.cond(normal_matrix), rtol = 1e-6)
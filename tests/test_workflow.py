@@ -2,7 +2,15 @@ import geopandas as gpd
 from path import Path
 from tempfile import TemporaryDirectory
 import re
-from fordead.import_data import TileInfo, get_band_paths
+import datetime
+import pytest
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from fordead.import_data import TileInfo, get_band_paths, import_masked_vi, import_coeff_model, import_first_detection_date_index, import_binary_raster, import_stress_index, import_dieback_data, import_stress_data, initialize_dieback_data, initialize_stress_data, get_stress_index
+from fordead.model_vegetation_index import prediction_vegetation_index, get_harmonic_terms
+from fordead.dieback_detection import detection_anomalies, detection_dieback, save_stress
+from fordead.steps import step1_compute_masked_vegetationindex, step3_dieback_detection
 from fordead.steps.step1_compute_masked_vegetationindex import compute_masked_vegetationindex
 from fordead.steps.step2_train_model import train_model
 from fordead.steps.step3_dieback_detection import dieback_detection
@@ -125,6 +133,62 @@ def test_fordead_steps(input_dir, output_dir):
         conf_threshold_list = [0.265],
         conf_classes_list = ["Low anomaly","Severe anomaly"])
 
+def test_dtype_accuracy(input_dir, output_dir):
+    """
+    Compares the results of steps 1 to 3 computed in float32 (default) and in float64.
+    Observed differences are below 1e-5 for the vegetation index and the model coefficients, 
+    and below 1e-4 for the stress index, so anomalies only differ where the difference 
+    with the prediction is within 1e-5 of threshold_anomaly, which is tolerated for 0.1% of pixels.
+    """
+    test_output_dir = (output_dir / "workflow_dtype").rmtree_p().mkdir()
+    for dtype in ["float32", "float64"]:
+        data_directory = test_output_dir / dtype
+        compute_masked_vegetationindex(
+            input_directory = input_dir / "sentinel_data" / "dieback_detection_tutorial" / "study_area", 
+            data_directory = data_directory,
+            lim_perc_cloud = 0.4, 
+            sentinel_source  = "theia", 
+            soil_detection = True, 
+            vi = "CRSWIR", 
+            apply_source_mask = True,
+            dtype = dtype)
+        train_model(
+            data_directory = data_directory, 
+            nb_min_date = 10, 
+            min_last_date_training="2018-01-01", 
+            max_last_date_training="2018-06-01")
+        dieback_detection(
+            data_directory = data_directory, 
+            threshold_anomaly = 0.16,
+            stress_index_mode = "weighted_mean")
+
+    tile32 = TileInfo(test_output_dir / "float32").import_info()
+    tile64 = TileInfo(test_output_dir / "float64").import_info()
+    assert list(tile32.dates) == list(tile64.dates)
+    
+    date = tile32.dates[-1]
+    vi32, mask32 = import_masked_vi(tile32.paths, date)
+    vi64, mask64 = import_masked_vi(tile64.paths, date)
+    assert vi32.dtype == np.float32 and vi64.dtype == np.float64
+    assert (mask32.values == mask64.values).all()
+    assert np.abs(vi32.values - vi64.values).max() < 1e-5
+
+    coeff32 = import_coeff_model(tile32.paths["coeff_model"])
+    coeff64 = import_coeff_model(tile64.paths["coeff_model"])
+    assert coeff32.dtype == np.float32
+    assert np.nanmax(np.abs(coeff32.values - coeff64.values)) < 1e-5
+    assert (import_first_detection_date_index(tile32.paths["first_detection_date_index"]).values == import_first_detection_date_index(tile64.paths["first_detection_date_index"]).values).all()
+
+    for date in tile32.paths["Anomalies"]:
+        anomalies32 = import_binary_raster(tile32.paths["Anomalies"][date]).values
+        anomalies64 = import_binary_raster(tile64.paths["Anomalies"][date]).values
+        assert (anomalies32 != anomalies64).mean() <= 0.001
+
+    stress_index32 = import_stress_index(tile32.paths["stress_index"]).values
+    stress_index64 = import_stress_index(tile64.paths["stress_index"]).values
+    assert stress_index32.dtype == np.float32
+    assert np.nanmax(np.abs(stress_index32 - stress_index64)) < 1e-4
+
 def test_process_tiles(input_dir, output_dir):
     test_output_dir = (output_dir / "workflow_process_tiles").rmtree_p().mkdir()
     sentinel_dir = input_dir / "sentinel_data" / "dieback_detection_tutorial"
@@ -190,4 +254,307 @@ def test_visualisation(output_dir):
                         ymin = 0, 
                         ymax = 2, 
                         chunks = 100)
-    assert (tile_dir / "TimeSeries" / "0.png").exists()
\ No newline at end of file
+    assert (tile_dir / "TimeSeries" / "0.png").exists()
+
+
+def write_synthetic_theia(directory, size = 64, nb_dates = 50, seed = 0):
+    """
+    Writes a small synthetic THEIA tile, with seasonal reflectances, clouds, bare soil, pixels outside the swath and shadows.
+    Pixels of the upper left corner suffer from dieback between March and October 2018, so stress periods are detected and ended, and pixels below them suffer from dieback from June 2018.
+    Rasters are tiled with 16 pixels blocks, so the steps process several windows.
+    """
+    rng = np.random.default_rng(seed)
+    base = {"B2" : 300, "B3" : 420, "B4" : 300, "B8" : 3000, "B5" : 700, "B6" : 2200, "B7" : 2700, "B8A" : 3000, "B11" : 1100, "B12" : 700}
+    dates = [datetime.date(2016,1,5) + datetime.timedelta(days = int(days)) for days in np.cumsum(rng.integers(15, 35, size = nb_dates))]
+    
+    def write(path, array, resolution, dtype, nodata = None):
+        with rasterio.open(path, "w", driver = "GTiff", height = array.shape[0], width = array.shape[1], count = 1, dtype = dtype, crs = "EPSG:32631", 
+                           transform = from_origin(600000, 5500000, resolution, resolution), nodata = nodata, tiled = True, blockxsize = 16, blockysize = 16) as dst:
+            dst.write(array.astype(dtype), 1)
+    
+    for date_index, date in enumerate(dates):
+        name = "SENTINEL2A_" + date.strftime("%Y%m%d") + "-105851-000_L2A_T31UFQ_D_V2-2"
+        (directory / name / "MASKS").makedirs_p()
+        season = np.sin(2*np.pi*(date - datetime.date(2015,1,1)).days/365.25)
+        for band in base:
+            band_size = size if band in ["B2","B3","B4","B8"] else size//2
+            array = base[band] * (1 + 0.1*season) + rng.normal(0, base[band]*0.05, size = (band_size, band_size))
+            if band == "B11" and datetime.date(2018,3,1) < date < datetime.date(2018,10,1):
+                array[: band_size//4, : band_size//4] *= 1.6
+            if band == "B11" and date > datetime.date(2018,6,1):
+                array[band_size//4 : band_size//2, : band_size//4] *= 1.6
+            if band in ["B2","B3","B4"] and date_index % 7 == 3: #Clouds
+                array[band_size//5 : 2*band_size//5, band_size//5 : 2*band_size//5] += 900
+            if date_index % 9 == 4: #Bare soil
+                array[-band_size//5:, -band_size//5:] = 1400 if band == "B11" else (500 if band in ["B2","B3","B4"] else array[-band_size//5:, -band_size//5:])
+            if date_index % 11 == 5: #Outside swath
+                array[:, : band_size//8] = -10000
+            if band == "B8" and date_index % 13 == 6: #Shadows
+                array[5:9, 5:9] = 0
+            write(directory / name / (name + "_FRE_" + band + ".tif"), np.round(array), 10 if band_size == size else 20, "int16", -10000)
+        clouds = np.zeros((size//2, size//2), dtype = np.uint8)
+        if date_index % 7 == 3:
+            clouds[size//10 : size//5, size//10 : size//5] = 2
+        write(directory / name / "MASKS" / (name + "_CLM_R2.tif"), clouds, 20, "uint8")
+
+@pytest.fixture(scope="module")
+def synthetic_dir(tmp_path_factory):
+    directory = Path(str(tmp_path_factory.mktemp("synthetic")))
+    write_synthetic_theia(directory / "study_area")
+    yield directory
+
+def compute_synthetic_vi(synthetic_dir, name, **step1_args):
+    data_directory = synthetic_dir / name
+    compute_masked_vegetationindex(
+        input_directory = synthetic_dir / "study_area", 
+        data_directory = data_directory,
+        lim_perc_cloud = 0.6, 
+        soil_detection = True, 
+        apply_source_mask = True,
+        progress = False,
+        **{"window_size" : 32, **step1_args})
+    return data_directory
+
+def read_outputs(data_directory, directories):
+    """
+    Reads the rasters of the given directories of a data directory, in a dictionnary where keys are their paths relative to the data directory.
+    """
+    outputs = {}
+    for directory in directories:
+        for path in (data_directory / directory).walkfiles():
+            if path.suffix in [".tif", ".nc"]:
+                with rasterio.open(path) as raster:
+                    outputs[data_directory.relpathto(path)] = raster.read()
+    return outputs
+
+def assert_same_outputs(outputs, expected_outputs):
+    assert len(expected_outputs) > 0 and sorted(outputs) == sorted(expected_outputs)
+    for path in expected_outputs:
+        assert np.array_equal(outputs[path], expected_outputs[path], equal_nan = True), path
+
+def train_synthetic(synthetic_dir, name, forest_mask_source = None, **train_args):
+    data_directory = compute_synthetic_vi(synthetic_dir, name)
+    if forest_mask_source is not None:
+        compute_forest_mask(data_directory, forest_mask_source = forest_mask_source)
+    train_model(
+        data_directory = data_directory, 
+        nb_min_date = 10, 
+        min_last_date_training="2018-01-01", 
+        max_last_date_training="2018-06-01",
+        **train_args)
+    return data_directory
+
+@pytest.mark.parametrize("interpolation_order", [0, 1])
+def test_windowed_vi(synthetic_dir, interpolation_order):
+    """
+    Checks that the vegetation index, masks and soil data computed window by window are identical to those computed with a single window covering the tile.
+    """
+    outputs = {}
+    for window_size in [1024, 32]:
+        data_directory = compute_synthetic_vi(synthetic_dir, "windows_" + str(interpolation_order) + "_" + str(window_size), window_size = window_size, interpolation_order = interpolation_order)
+        outputs[window_size] = read_outputs(data_directory, ["VegetationIndex", "Mask", "DataSoil"])
+    assert_same_outputs(outputs[32], outputs[1024])
+
+def test_parallel_vi(synthetic_dir):
+    """
+    Checks that the vegetation index, masks and soil data computed with several processes are identical to those computed in a single process.
+    """
+    outputs = {}
+    for n_workers in [1, 3]:
+        data_directory = compute_synthetic_vi(synthetic_dir, "vi_workers_" + str(n_workers), n_workers = n_workers)
+        outputs[n_workers] = read_outputs(data_directory, ["VegetationIndex", "Mask", "DataSoil"])
+    assert_same_outputs(outputs[3], outputs[1])
+
+def reference_detection(data_directory, threshold_anomaly = 0.16, stress_index_mode = "weighted_mean", max_nb_stress_periods = 5):
+    """
+    Detection computed date by date on the whole area with detection_anomalies, detection_dieback and save_stress, as done before the detection was batched, sharded or restricted to active pixels.
+    """
+    tile = TileInfo(data_directory).import_info()
+    first_detection_date_index = import_first_detection_date_index(tile.paths["first_detection_date_index"])
+    coeff_model = import_coeff_model(tile.paths["coeff_model"])
+    dieback_data = initialize_dieback_data(first_detection_date_index.shape, first_detection_date_index.coords)
+    stress_data = initialize_stress_data(first_detection_date_index.shape, first_detection_date_index.coords, max_nb_stress_periods, dtype = tile.parameters["dtype"])
+    anomalies = {}
+    for date_index, date in enumerate(tile.dates):
+        if date_index < int(first_detection_date_index.min()):
+            continue
+        vegetation_index, mask = import_masked_vi(tile.paths, date)
+        mask = mask | (date_index < first_detection_date_index)
+        predicted_vi = prediction_vegetation_index(coeff_model, [date])
+        anomalies[date], diff_vi = detection_anomalies(vegetation_index, mask, predicted_vi, threshold_anomaly, vi = tile.parameters["vi"])
+        dieback_data, changing_pixels = detection_dieback(dieback_data, anomalies[date], mask, date_index)
+        stress_data = save_stress(stress_data, dieback_data, changing_pixels, diff_vi, mask, stress_index_mode)
+    return dieback_data, stress_data, anomalies
+
+def assert_same_detection(data_directory, dieback_data, stress_data, anomalies):
+    tile = TileInfo(data_directory).import_info()
+    assert int(dieback_data["state"].sum()) > 0 and int(stress_data["nb_periods"].max()) > 0
+    detected_dieback = import_dieback_data(tile.paths)
+    for var in dieback_data:
+        assert np.array_equal(detected_dieback[var].values.squeeze(), dieback_data[var].values.squeeze()), var
+    detected_stress = import_stress_data(tile.paths)
+    for var in stress_data:
+        assert np.array_equal(detected_stress[var].transpose(..., "y", "x").values, stress_data[var].transpose(..., "y", "x").values, equal_nan = True), var
+    assert len(tile.paths["Anomalies"]) > 0
+    for date in tile.paths["Anomalies"]:
+        assert np.array_equal(import_binary_raster(tile.paths["Anomalies"][date]).values.squeeze(), anomalies[date].values.squeeze()), date
+
+def test_sharded_detection(synthetic_dir):
+    """
+    Checks that the detection sharded by rows between several processes gives the same results as the detection in a single process, and as the detection date by date.
+    """
+    reference = None
+    for n_workers in [1, 3]:
+        data_directory = train_synthetic(synthetic_dir, "sharded_" + str(n_workers))
+        dieback_detection(data_directory = data_directory, threshold_anomaly = 0.16, stress_index_mode = "weighted_mean", n_workers = n_workers, progress = False)
+        if reference is None:
+            reference = reference_detection(data_directory)
+        assert_same_detection(data_directory, *reference)
+
+def test_active_pixels(synthetic_dir):
+    """
+    Checks that training and detection restricted to active pixels give the same results as the dense computation on active pixels, 
+    which are pixels of the forest mask with a sufficient coverage, and without too many stress periods for the detection.
+    """
+    forest_path = synthetic_dir / "forest_mask.tif"
+    rows, cols = np.mgrid[0:64, 0:64]
+    with rasterio.open(forest_path, "w", driver = "GTiff", height = 64, width = 64, count = 1, dtype = "uint8", crs = "EPSG:32631", transform = from_origin(600000, 5500000, 10, 10)) as dst:
+        dst.write(((cols//7 + rows//5) % 3 != 0).astype("uint8"), 1)
+    
+    tiles = {}
+    for active_pixels in [False, True]:
+        data_directory = train_synthetic(synthetic_dir, "active_" + str(active_pixels), forest_mask_source = forest_path, active_pixels = active_pixels)
+        dieback_detection(data_directory = data_directory, threshold_anomaly = 0.16, stress_index_mode = "weighted_mean", progress = False)
+        tiles[active_pixels] = TileInfo(data_directory).import_info()
+    
+    dense, active = tiles[False], tiles[True]
+    assert active.parameters["active_pixels"] and not(dense.parameters["active_pixels"])
+    active_area = import_binary_raster(dense.paths["forest_mask"]).values.squeeze() & import_binary_raster(dense.paths["sufficient_coverage_mask"]).values.squeeze()
+    assert 0 < active_area.sum() < active_area.size
+    assert np.array_equal(import_binary_raster(active.paths["sufficient_coverage_mask"]).values.squeeze()[active_area], import_binary_raster(dense.paths["sufficient_coverage_mask"]).values.squeeze()[active_area])
+    assert np.array_equal(import_first_detection_date_index(active.paths["first_detection_date_index"]).values.squeeze()[active_area], 
+                          import_first_detection_date_index(dense.paths["first_detection_date_index"]).values.squeeze()[active_area])
+    assert np.array_equal(import_coeff_model(active.paths["coeff_model"]).values[:, active_area], import_coeff_model(dense.paths["coeff_model"]).values[:, active_area])
+    
+    detection_area = active_area & import_binary_raster(dense.paths["too_many_stress_periods_mask"]).values.squeeze()
+    dense_dieback, active_dieback = import_dieback_data(dense.paths), import_dieback_data(active.paths)
+    assert int(dense_dieback["state"].values.squeeze()[detection_area].sum()) > 0
+    for var in dense_dieback:
+        assert np.array_equal(active_dieback[var].values.squeeze()[detection_area], dense_dieback[var].values.squeeze()[detection_area]), var
+    dense_stress, active_stress = import_stress_data(dense.paths), import_stress_data(active.paths)
+    for var in dense_stress:
+        assert np.array_equal(active_stress[var].transpose(..., "y", "x").values[..., detection_area], dense_stress[var].transpose(..., "y", "x").values[..., detection_area], equal_nan = True), var
+    assert list(active.paths["Anomalies"]) == list(dense.paths["Anomalies"])
+    for date in dense.paths["Anomalies"]:
+        assert np.array_equal(import_binary_raster(active.paths["Anomalies"][date]).values.squeeze()[detection_area], import_binary_raster(dense.paths["Anomalies"][date]).values.squeeze()[detection_area]), date
+
+def test_stress_table(synthetic_dir):
+    """
+    Checks that the stress periods written to the Parquet table give the same dense stress data and stress index as the stress rasters.
+    """
+    data_directory = train_synthetic(synthetic_dir, "stress_table")
+    dieback_detection(data_directory = data_directory, threshold_anomaly = 0.16, stress_index_mode = "weighted_mean", stress_output_format = "rasters", progress = False)
+    tile = TileInfo(data_directory).import_info()
+    stress_data = import_stress_data(tile.paths).load()
+    stress_index = import_stress_index(tile.paths["stress_index"]).load()
+    assert int(stress_data["nb_periods"].max()) > 0
+    
+    dieback_detection(data_directory = data_directory, threshold_anomaly = 0.16, stress_index_mode = "weighted_mean", stress_output_format = "table", progress = False)
+    tile = TileInfo(data_directory).import_info()
+    assert tile.paths["stress_periods_table"].exists() and not(tile.paths["dates_stress"].exists()) and not(tile.paths["stress_index"].exists())
+    table_stress_data = import_stress_data(tile.paths)
+    for var in stress_data:
+        expected = stress_data[var].transpose(..., "y", "x").values
+        result = table_stress_data[var].transpose(..., "y", "x").values
+        assert expected.dtype == result.dtype and np.array_equal(expected, result, equal_nan = True), var
+    assert np.array_equal(get_stress_index(tile.paths, table_stress_data, "weighted_mean").transpose(..., "y", "x").values, stress_index.transpose(..., "y", "x").values, equal_nan = True)
+
+def test_threshold_sweep(synthetic_dir):
+    """
+    Checks that the dieback data, stress data and too_many_stress_periods_mask of each threshold of a sweep are identical to those of a detection with this single threshold.
+    """
+    data_directory = train_synthetic(synthetic_dir, "threshold_sweep")
+    thresholds = [0.1, 0.16, 0.25]
+    single_results = {}
+    for threshold in thresholds:
+        dieback_detection(data_directory = data_directory, threshold_anomaly = threshold, stress_index_mode = "weighted_mean", progress = False)
+        for directory in ["DataDieback", "DataStress", "TimelessMasks"]:
+            for path in (data_directory / directory).walkfiles("*.tif"):
+                with rasterio.open(path) as raster:
+                    single_results[(threshold, data_directory.relpathto(path))] = raster.read()
+    
+    dieback_detection(data_directory = data_directory, threshold_anomaly = thresholds, stress_index_mode = "weighted_mean", progress = False)
+    nb_files = 0
+    for threshold in thresholds:
+        sweep_directory = data_directory / "ThresholdSweep" / ("threshold_" + str(threshold))
+        for path in sweep_directory.walkfiles("*.tif"):
+            with rasterio.open(path) as raster:
+                assert np.array_equal(raster.read(), single_results[(threshold, sweep_directory.relpathto(path))], equal_nan = True), path
+            nb_files += 1
+    assert nb_files == len([key for key in single_results if "sufficient_coverage_mask" not in key[1]])
+
+def test_condition_number(synthetic_dir):
+    """
+    Checks that the condition number written by the training is the one of the normal matrix of the training dates of each pixel.
+    """
+    data_directory = train_synthetic(synthetic_dir, "condition_number", condition_number = True)
+    tile = TileInfo(data_directory).import_info()
+    with rasterio.open(tile.paths["condition_number"]) as raster:
+        condition = raster.read(1)
+    first_detection_date_index = import_first_detection_date_index(tile.paths["first_detection_date_index"]).values.squeeze()
+    sufficient_coverage = first_detection_date_index != 0
+    assert sufficient_coverage.any() and np.isnan(condition[~sufficient_coverage]).all()
+    
+    harmonic_terms = get_harmonic_terms(tile.dates)
+    valid = np.array([~import_masked_vi(tile.paths, date)[1].values.squeeze() for date in tile.dates])
+    training = valid & (np.arange(len(tile.dates))[:, None, None] < first_detection_date_index)
+    normal_matrices = np.einsum("tk,tl,tp->pkl", harmonic_terms, harmonic_terms, training[:, sufficient_coverage].astype(float))
+    assert np.allclose(condition[sufficient_coverage], np.linalg.cond(normal_matrices), rtol = 1e-5)
+
+class Interruption(Exception):
+    pass
+
+def interrupted(generator_function, nb_items):
+    """
+    Wraps a generator function so an Interruption is raised once nb_items items were yielded by all its calls, as if the computation was killed.
+    """
+    count = 0
+    def wrapper(*args, **kwargs):
+        nonlocal count
+        for item in generator_function(*args, **kwargs):
+            if count == nb_items:
+                raise Interruption()
+            count += 1
+            yield item
+    return wrapper
+
+def test_resume_vi(synthetic_dir, monkeypatch):
+    """
+    Checks that the computation of the vegetation index, interrupted while the mask of a date is written and resumed from its last checkpoint, gives the same results as an uninterrupted computation.
+    """
+    expected_outputs = read_outputs(compute_synthetic_vi(synthetic_dir, "resume_vi_reference"), ["VegetationIndex", "Mask", "DataSoil"])
+    with monkeypatch.context() as patch:
+        patch.setattr(step1_compute_masked_vegetationindex, "_dilate_window_clouds", interrupted(step1_compute_masked_vegetationindex._dilate_window_clouds, 4*12 + 2))
+        with pytest.raises(Interruption):
+            compute_synthetic_vi(synthetic_dir, "resume_vi", checkpoint_dates = 5)
+    assert (synthetic_dir / "resume_vi" / "Checkpoints" / "checkpoint_masked_vi.pickle").exists()
+    data_directory = compute_synthetic_vi(synthetic_dir, "resume_vi", checkpoint_dates = 5)
+    assert_same_outputs(read_outputs(data_directory, ["VegetationIndex", "Mask", "DataSoil"]), expected_outputs)
+
+def test_resume_detection(synthetic_dir, monkeypatch):
+    """
+    Checks that the dieback detection, interrupted and resumed from its last checkpoint, gives the same results as an uninterrupted detection.
+    """
+    directories = ["DataDieback", "DataStress", "DataAnomalies", "TimelessMasks"]
+    data_directory = train_synthetic(synthetic_dir, "resume_detection_reference")
+    dieback_detection(data_directory = data_directory, threshold_anomaly = 0.16, stress_index_mode = "weighted_mean", progress = False)
+    expected_outputs = read_outputs(data_directory, directories)
+    
+    data_directory = train_synthetic(synthetic_dir, "resume_detection")
+    with monkeypatch.context() as patch:
+        patch.setattr(step3_dieback_detection, "_detect_dates", interrupted(step3_dieback_detection._detect_dates, 17))
+        with pytest.raises(Interruption):
+            dieback_detection(data_directory = data_directory, threshold_anomaly = 0.16, stress_index_mode = "weighted_mean", checkpoint_dates = 5, progress = False)
+    assert (data_directory / "Checkpoints" / "checkpoint_dieback.pickle").exists()
+    dieback_detection(data_directory = data_directory, threshold_anomaly = 0.16, stress_index_mode = "weighted_mean", checkpoint_dates = 5, progress = False)
+    assert_same_outputs(read_outputs(data_directory, directories), expected_outputs)